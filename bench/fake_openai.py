@@ -0,0 +1,277 @@
+"""
+Offline stand-in for the parts of the OpenAI API Jinn uses: chat completions
+(with tools), audio transcriptions and speech.
+
+Responses come from fixtures (JSON lines, see fixtures.jsonl) and fall back to
+canned answers good enough to drive every path of services.py: functions get
+crafted, described, called and fixed without a single real API call.
+
+    python bench/fake_openai.py --port 8765 --latency chat=lognormal:-0.7,0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python src/app.py
+
+Latency specs: ``fixed:S``, ``uniform:A,B``, ``normal:MU,SIGMA``,
+``lognormal:MU,SIGMA`` (of the underlying normal) and ``exp:MEAN``, all in
+seconds. Without ``endpoint=`` the spec applies to every endpoint.
+"""
+import re
+import ast
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+ENDPOINTS = ('chat', 'transcriptions', 'speech')
+DISTRIBUTIONS = {
+    'fixed': lambda s: s,
+    'uniform': random.uniform,
+    'normal': lambda mu, sigma: max(0, random.gauss(mu, sigma)),
+    'lognormal': random.lognormvariate,
+    'exp': lambda mean: random.expovariate(1 / mean) if mean else 0,
+}
+
+DEFAULT_CODE = '''def repeat_text(text):
+    return text
+'''
+
+
+def parse_latency(spec):
+    """'lognormal:-0.7,0.5' -> function returning a delay in seconds"""
+    name, _, args = spec.partition(':')
+    try:
+        distribution = DISTRIBUTIONS[name]
+    except KeyError:
+        raise ValueError(f'unknown distribution {name!r}, use one of {", ".join(DISTRIBUTIONS)}')
+    args = [float(arg) for arg in args.split(',') if arg]
+    return lambda: distribution(*args)
+
+
+def load_fixtures(path):
+    """Fixture lines: {"endpoint": "chat", "match": "<regex>", "response": ...}
+
+    For chat the response is the assistant message (``content`` and/or
+    ``tool_calls`` as {"name", "arguments"}), for transcriptions the text and
+    for speech the number of bytes of audio to send back. The first fixture
+    whose regex matches the last user message (the file name for
+    transcriptions, the input for speech) wins.
+    """
+    fixtures = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip() and not line.lstrip().startswith('#'):
+                fixture = json.loads(line)
+                fixture['match'] = re.compile(fixture.get('match', ''), re.S)
+                fixtures.append(fixture)
+    return fixtures
+
+
+def fenced(text, language):
+    return f'```{language}\n{text}\n```'
+
+
+def describe(code):
+    """OpenAI function schema for the first function in `code`, every argument a string"""
+    func = next(node for node in ast.walk(ast.parse(code)) if isinstance(node, ast.FunctionDef))
+    args = [arg.arg for arg in func.args.args]
+    return {
+        'type': 'function',
+        'function': {
+            'name': func.name,
+            'description': func.name.replace('_', ' ').capitalize(),
+            'parameters': {
+                'type': 'object',
+                'properties': {arg: {'type': 'string', 'description': arg} for arg in args},
+                'required': args,
+            },
+        },
+    }
+
+
+def arguments(schema):
+    """Plausible arguments for a tool schema"""
+    samples = {'string': 'jinn', 'number': 2, 'integer': 2, 'boolean': True}
+    properties = schema.get('function', {}).get('parameters', {}).get('properties', {})
+    return {name: samples.get(prop.get('type'), 'jinn') for name, prop in properties.items()}
+
+
+def default_message(prompt, tools):
+    """What services.py expects back for each of its prompts"""
+    if tools:
+        if prompt.rsplit('Request:\n', 1)[-1].lower().startswith('question'):
+            return {'content': 'Forty two.'}
+        tools = [tool for tool in tools if tool['function']['name'] != 'craft_incantation'] or tools
+        tool = random.choice(tools)
+        if tool['function']['name'] == 'craft_incantation':
+            args = {'text': prompt.rsplit('Request:\n', 1)[-1]}
+        else:
+            args = arguments(tool)
+        return {'tool_calls': [{'name': tool['function']['name'], 'arguments': json.dumps(args)}]}
+    if prompt.startswith('Describe this python function: '):
+        code = prompt[len('Describe this python function: '):].rsplit(' in this schema ', 1)[0]
+        return {'content': fenced(json.dumps(describe(code)), 'json')}
+    if prompt.startswith('Write a python function according to the request and describe it as a tool'):
+        schema = describe(DEFAULT_CODE)
+        return {'content': json.dumps({
+            'code': DEFAULT_CODE, 'schema': schema, 'arguments': arguments(schema),
+        })}
+    if prompt.startswith('Write a python function'):
+        return {'content': fenced(DEFAULT_CODE, 'python')}
+    if 'Code:\n' in prompt:  # adjust() and fix() get their code back unchanged
+        code = prompt.split('Code:\n', 1)[1]
+        code = re.split(r'\n(?:Reason|Arguments):\n', code, 1)[0]
+        return {'content': fenced(code, 'python')}
+    return {'content': 'OK'}
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+    quiet = False
+
+    def __init__(self, address, fixtures=(), latency=None, audio_bytes=16 * 1024):
+        super().__init__(address, Handler)
+        self.fixtures = list(fixtures)
+        self.latency = latency or {}
+        self.audio_bytes = audio_bytes
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(ENDPOINTS, 0)
+
+    def fixture(self, endpoint, text):
+        for fixture in self.fixtures:
+            if fixture.get('endpoint', 'chat') == endpoint and fixture['match'].search(text):
+                return fixture['response']
+
+    def delay(self, endpoint):
+        with self.lock:
+            self.counts[endpoint] += 1
+        if endpoint in self.latency:
+            time.sleep(self.latency[endpoint]())
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # the openai client keeps connections alive
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def reply(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, message):
+        self.reply(status, {'error': {'message': message, 'type': 'invalid_request_error', 'code': None}})
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            return self.reply(200, self.server.counts)
+        self.error(404, f'Unknown path {self.path}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if path.endswith('/chat/completions'):
+            self.chat(json.loads(body))
+        elif path.endswith('/audio/transcriptions'):
+            self.transcriptions(body)
+        elif path.endswith('/audio/speech'):
+            self.speech(json.loads(body))
+        else:
+            self.error(404, f'Unknown path {self.path}')
+
+    def chat(self, request):
+        prompt = next(
+            (m['content'] for m in reversed(request['messages']) if m['role'] == 'user'), ''
+        )
+        tools = request.get('tools') or []
+        message = self.server.fixture('chat', prompt) or default_message(prompt, tools)
+        tool_calls = [
+            {
+                'id': 'call_' + hashlib.sha1(f'{prompt}{i}'.encode('utf-8')).hexdigest()[:24],
+                'type': 'function',
+                'function': {'name': call['name'], 'arguments': call['arguments']},
+            }
+            for i, call in enumerate(message.get('tool_calls') or ())
+        ]
+        content = message.get('content')
+        self.server.delay('chat')
+        self.reply(200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-fake'),
+            'choices': [{
+                'index': i,
+                'message': {'role': 'assistant', 'content': content, 'tool_calls': tool_calls or None},
+                'finish_reason': 'tool_calls' if tool_calls else 'stop',
+            } for i in range(request.get('n') or 1)],
+            'usage': {
+                'prompt_tokens': len(prompt) // 4,
+                'completion_tokens': len(content or json.dumps(tool_calls)) // 4,
+                'total_tokens': (len(prompt) + len(content or json.dumps(tool_calls))) // 4,
+            },
+        })
+
+    def transcriptions(self, body):
+        filename = re.search(rb'filename="([^"]*)"', body)
+        filename = filename.group(1).decode('utf-8', 'replace') if filename else ''
+        text = self.server.fixture('transcriptions', filename)
+        self.server.delay('transcriptions')
+        self.reply(200, {'text': text or 'question what is the answer to everything'})
+
+    def speech(self, request):
+        size = self.server.fixture('speech', request.get('input', ''))
+        self.server.delay('speech')
+        audio = b'ID3\x03\x00\x00\x00\x00\x00\x00' + bytes(int(size or self.server.audio_bytes))
+        self.reply(200, audio, content_type='audio/mpeg')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', help='JSON lines file, see load_fixtures()')
+    parser.add_argument(
+        '--latency', action='append', default=[], metavar='[ENDPOINT=]SPEC',
+        help=f'response delay distribution, endpoints: {", ".join(ENDPOINTS)}'
+    )
+    parser.add_argument('--seed', type=int, help='seed for latencies and tool choice')
+    parser.add_argument('--quiet', action='store_true')
+    options = parser.parse_args(argv)
+
+    if options.seed is not None:
+        random.seed(options.seed)
+    latency = {}
+    for spec in options.latency:
+        endpoint, _, spec = spec.rpartition('=')
+        if endpoint and endpoint not in ENDPOINTS:
+            parser.error(f'unknown endpoint {endpoint!r}')
+        try:
+            delay = parse_latency(spec)
+        except ValueError as e:
+            parser.error(str(e))
+        for name in ([endpoint] if endpoint else ENDPOINTS):
+            latency[name] = delay
+
+    fixtures = load_fixtures(options.fixtures) if options.fixtures else ()
+    server = FakeOpenAI((options.host, options.port), fixtures, latency)
+    server.quiet = options.quiet
+    sys.stderr.write(f'Fake OpenAI listening on http://{options.host}:{server.server_port}/v1\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Load generator for the Jinn API: each client thread keeps one HTTP/1.1
+connection open and loops over a mix of /api/wish, /api/prepare and
+/api/proceed (fed with what /api/prepare returned), then p50/p95/p99 latency
+and throughput are reported per endpoint.
+
+    python bench/fake_openai.py --quiet --latency chat=lognormal:-0.7,0.5 &
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 MODE=production python src/app.py &
+    python bench/loadgen.py --clients 16 --duration 30
+
+The API token is read from the admin master in $DATA_PATH/db.sqlite3 unless
+given with --token. Jinn must be configured with some (any) openai_key.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+
+WISHES = (
+    'add two and three',
+    'sum 40 and 2',
+    'what is the weather in Paris',
+    'question: what is the answer to everything',
+    'repeat the word jinn',
+)
+
+
+def admin_token(db_path):
+    with sqlite3.connect(db_path) as db:
+        row = db.execute('SELECT token FROM master WHERE admin = 1 ORDER BY id LIMIT 1').fetchone()
+    if row is None:
+        raise SystemExit(f'No admin master in {db_path}, pass --token')
+    return row[0]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`"""
+    if not values:
+        return float('nan')
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Client(threading.Thread):
+    def __init__(self, url, token, mix, deadline, requests, stats, timeout):
+        super().__init__(daemon=True)
+        self.url = url
+        self.headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+        self.mix = mix
+        self.deadline = deadline
+        self.requests = requests
+        self.stats = stats
+        self.timeout = timeout
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            cls = http.client.HTTPSConnection if self.url.scheme == 'https' else http.client.HTTPConnection
+            self.connection = cls(self.url.hostname, self.url.port, timeout=self.timeout)
+        return self.connection
+
+    def post(self, endpoint, data, accept='text/plain'):
+        body = json.dumps(data).encode('utf-8')
+        started = time.perf_counter()
+        try:
+            connection = self.connect()
+            connection.request(
+                'POST', self.url.path.rstrip('/') + '/api/' + endpoint, body,
+                dict(self.headers, Accept=accept)
+            )
+            response = connection.getresponse()
+            payload = response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            self.stats.record(endpoint, time.perf_counter() - started, type(e).__name__)
+            return None
+        error = None if response.status == 200 else str(response.status)
+        self.stats.record(endpoint, time.perf_counter() - started, error)
+        return payload if error is None else None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def run(self):
+        try:
+            while time.monotonic() < self.deadline and self.requests.take():
+                text = random.choice(WISHES)
+                endpoint = random.choices(('wish', 'prepare'), self.mix)[0]
+                if endpoint == 'wish':
+                    self.post('wish', {'text': text})
+                    continue
+                prepared = self.post('prepare', {'text': text})
+                if prepared is None:
+                    continue
+                prepared = json.loads(prepared)
+                if prepared:  # null when the model just answered
+                    self.post('proceed', prepared)
+        finally:
+            self.close()
+
+
+class Budget:
+    """Shared request counter, unlimited when `total` is None"""
+
+    def __init__(self, total=None):
+        self.left = total
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.left is None:
+            return True
+        with self.lock:
+            self.left -= 1
+            return self.left >= 0
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, endpoint, seconds, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies.setdefault(endpoint, []).append(seconds)
+            else:
+                self.errors.setdefault(endpoint, {}).setdefault(error, 0)
+                self.errors[endpoint][error] += 1
+
+    def report(self, elapsed, out=sys.stdout):
+        out.write(f'{"endpoint":<10}{"ok":>8}{"errors":>8}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}\n')
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(endpoint, ()))
+            errors = sum(self.errors.get(endpoint, {}).values())
+            out.write(
+                f'{endpoint:<10}{len(values):>8}{errors:>8}{len(values) / elapsed:>9.1f}'
+                + ''.join(f'{percentile(values, p) * 1000:>10.1f}' for p in (50, 95, 99))
+                + f'{(values[-1] if values else float("nan")) * 1000:>10.1f}\n'
+            )
+        total = sum(map(len, self.latencies.values()))
+        out.write(f'{total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s\n')
+        for endpoint, errors in sorted(self.errors.items()):
+            out.write(f'{endpoint} errors: {", ".join(f"{k} x{v}" for k, v in sorted(errors.items()))}\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--token', help='API token, default: the admin\'s from --db')
+    parser.add_argument(
+        '--db', default=os.path.join(os.environ.get('DATA_PATH', '/var/www/data'), 'db.sqlite3')
+    )
+    parser.add_argument('--clients', type=int, default=8, help='concurrent connections')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--requests', type=int, help='stop after this many wish/prepare rounds')
+    parser.add_argument('--wish-ratio', type=float, default=0.5, help='share of /api/wish rounds, the rest is prepare+proceed')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args(argv)
+
+    if options.seed is not None:
+        random.seed(options.seed)
+    token = options.token or admin_token(options.db)
+    url = urllib.parse.urlsplit(options.url)
+    stats, budget = Stats(), Budget(options.requests)
+    mix = (options.wish_ratio, 1 - options.wish_ratio)
+
+    started = time.monotonic()
+    clients = [
+        Client(url, token, mix, started + options.duration, budget, stats, options.timeout)
+        for _ in range(options.clients)
+    ]
+    for client in clients:
+        client.start()
+    try:
+        for client in clients:
+            client.join()
+    except KeyboardInterrupt:
+        pass
+    stats.report(time.monotonic() - started)
+
+
+if __name__ == '__main__':
+    main()
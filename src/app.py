@@ -1,23 +1,43 @@
 import os
+import gzip
 import json
+import time
+import logging
 import traceback
+from html import escape
 
 import bottle
 import macaron
 import canister
-from config import DB_PATH, LOG_PATH
-from models import BaseModel, Master, Incident, Config
-
-
-bottle.install(macaron.MacaronPlugin(DB_PATH))
-bottle.install(canister.Canister())
+import server
+import logs
+import tracing
+import metrics
+import usage
+import templates
+from config import DB_PATH, LOG_PATH, LOG_BACKUPS, PRODUCTION, SERVER, THREADS, KEEPALIVE, WORKERS, SQL_CACHED_STATEMENTS, DB_TIMEOUT
+from models import BaseModel, Master, Mishap, Incident, Config, Usage, MATCH_START, MATCH_END
+from utils import read_backwards, follow
+
+
+bottle.default_app().config['canister.session_db'] = str(DB_PATH)
+macaron.SQL_TRACE_HOOK = tracing.sql_span
+bottle.install(metrics.MetricsPlugin())
+bottle.install(tracing.TracingPlugin())
+bottle.install(tracing.TracingPlugin('canister'))
+# outside of macaron: a changed session is written once the request's transaction
+# is committed, writing it while that transaction holds the database lock would block
+sessions = bottle.install(canister.Canister()).sessions
+bottle.install(macaron.MacaronPlugin(DB_PATH, local=True, cached_statements=SQL_CACHED_STATEMENTS, timeout=DB_TIMEOUT))
+metrics.SESSIONS.callback = lambda: len(sessions)
+logs.offload(logging.getLogger('canister'))
 
 
 def require_auth(func):
     def wrapper(*args, **kwargs):
-        if bottle.request.path.startswith('/api'):
+        if bottle.request.path.startswith(('/api', '/metrics')):
             m = api_master()
-        elif bottle.request.path.startswith('/login'):
+        elif bottle.request.path.startswith(('/login', '/static')):
             return func(*args, **kwargs)
         else:
             m = master()
@@ -27,7 +47,11 @@ def require_auth(func):
         if not m.verified and not m.admin:
             return bottle.redirect('/login?error=unverified')
 
-        return func(*args, **kwargs)
+        token = usage.current_master.set(m.id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            usage.current_master.reset(token)
     return wrapper
 
 
@@ -46,7 +70,7 @@ class HTMLDecorator:
                 <html>
                 <head>
                     <link href="https://iosevka-webfonts.github.io/iosevka/iosevka.css" rel="stylesheet"/>
-                    <style>{Config.get_value('css')}</style>
+                    <link href="/static/style.{Config.get_value('css_hash')}.css" rel="stylesheet"/>
                     <title>Jinn</title>
                 </head>
                 <body>
@@ -62,27 +86,76 @@ class HTMLDecorator:
 
 html = HTMLDecorator
 bottle.install(require_auth)
+bottle.install(tracing.TracingPlugin('view'))
 
 
 def master():
     try:
-        return Master.get(canister.session.data['user'])
+        return Master.prepared("id=?").get(canister.session.data['user'])
     except (KeyError, Master.DoesNotExist):
         pass
 
 
 def api_master():
     try:
-        token = bottle.request.headers.get('Authorization').split(' ')[1]
-        return Master.get("token=?", [token])
+        token = bottle.request.headers.get('Authorization', '').split(' ')[1]
+        return Master.prepared("token=?").get(token)
     except (IndexError, Master.DoesNotExist):
         pass
 
 
+def query_int(name, default=None, value=None):
+    """Integer query parameter (or `value`), aborts with 400 when it isn't one
+    (with a JSON error under /api/)"""
+    value = bottle.request.query.get(name) if value is None else value
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        if bottle.request.path.startswith('/api/'):
+            raise bottle.HTTPResponse(json.dumps({'error': f'{name} must be an integer'}), status=400)
+        bottle.abort(400, f'{name} must be an integer')
+
+
+# css_hash -> (css, gzipped css), only for the current stylesheet
+stylesheets = {}
+
+
+@bottle.get('/static/style.<digest>.css')
+def stylesheet_view(digest):
+    current = Config.get_value('css_hash')
+    if digest != current:
+        return bottle.redirect(f'/static/style.{current}.css')
+    if (stylesheet := stylesheets.get(digest)) is None:
+        metrics.CACHE.inc(cache='stylesheet', result='miss')
+        css = Config.get_value('css').encode('utf-8')
+        stylesheet = css, gzip.compress(css, mtime=0)
+        stylesheets.clear()
+        stylesheets[digest] = stylesheet
+    else:
+        metrics.CACHE.inc(cache='stylesheet', result='hit')
+
+    headers = {
+        'Content-Type': 'text/css; charset=utf-8',
+        'Cache-Control': 'public, max-age=31536000, immutable',
+        'ETag': f'"{digest}"',
+        'Vary': 'Accept-Encoding',
+    }
+    if bottle.request.headers.get('If-None-Match', '').strip() in (f'"{digest}"', f'W/"{digest}"', '*'):
+        metrics.CACHE.inc(cache='etag', result='hit')
+        return bottle.HTTPResponse(status=304, headers=headers)
+    metrics.CACHE.inc(cache='etag', result='miss')
+    css, compressed = stylesheet
+    if 'gzip' in bottle.request.headers.get('Accept-Encoding', ''):
+        return bottle.HTTPResponse(compressed, headers=dict(headers, **{'Content-Encoding': 'gzip'}))
+    return bottle.HTTPResponse(css, headers=headers)
+
+
 @bottle.get('/login')
 @html()
 def login_view():
-    return bottle.template('''
+    return templates.template('''
         <p>{{error}}</p>
         <form action="/login" method="post">
             <input type="text" name="username" />
@@ -112,7 +185,7 @@ def logout_view():
 @bottle.get('/config')
 @html()
 def config_view():
-    return bottle.template('''
+    return templates.template('''
     <a href="/">back</a>
 
     % for config in configs:
@@ -147,21 +220,205 @@ def flip_verification_view(id):
     return bottle.redirect('/config')
 
 
+def require_admin():
+    m = master()
+    if not m or not m.admin:
+        bottle.abort(403, 'Admins only')
+
+
+def log_file(number):
+    return LOG_PATH if number == 0 else LOG_PATH.with_name(f'{LOG_PATH.name}.{number}')
+
+
 @bottle.get('/log')
 @html()
 def log_view():
-    with open(LOG_PATH, 'rt') as f:
-        return f.read().replace('\n', '<br>').replace(' ', '&nbsp;')
+    require_admin()
+    number = min(max(query_int('file', 0), 0), LOG_BACKUPS)
+    before = query_int('before')
+    try:
+        lines, start, end = read_backwards(log_file(number), before)
+    except FileNotFoundError:
+        lines, start, end = [], 0, 0
+
+    older = ''
+    if start > 0:
+        older = f'<a href="/log?file={number}&before={start}">older</a>'
+    elif number < LOG_BACKUPS and log_file(number + 1).exists():
+        older = f'<a href="/log?file={number + 1}">older</a>'
+
+    follow_script = ''
+    if bottle.request.query.get('follow') and number == 0 and before is None:
+        follow_script = f'''
+            <script>
+                const log = document.getElementById('log');
+                const source = new EventSource('/log/stream?offset={end}');
+                source.onmessage = (event) => {{
+                    log.append(event.data + '\\n');
+                    window.scrollTo(0, document.body.scrollHeight);
+                }};
+            </script>
+        '''
+
+    return f'''
+        <a href="/">back</a>
+        <a href="/log">latest</a>
+        <a href="/log?follow=1">follow</a>
+        {older}
+        <pre id="log">{escape(''.join(lines))}</pre>
+        {follow_script}
+    '''
+
+
+@bottle.get('/log/stream')
+def log_stream_view():
+    require_admin()
+    offset = query_int('offset', value=bottle.request.headers.get('Last-Event-ID'))
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.headers['Cache-Control'] = 'no-cache'
+
+    def events():
+        yield 'retry: 1000\n\n'
+        idle = time.monotonic()
+        # streams are closed after a while and resumed by EventSource via Last-Event-ID,
+        # so a stream doesn't hold a server thread forever
+        for position, line in follow(LOG_PATH, offset, duration=60):
+            if line is not None:
+                idle = time.monotonic()
+                yield f'id: {position}\ndata: {line.rstrip()}\n\n'
+            elif time.monotonic() - idle > 15:
+                idle = time.monotonic()
+                yield ': keep-alive\n\n'
+
+    return events()
+
+
+@bottle.get('/trace')
+@html()
+def traces_view():
+    require_admin()
+    return templates.template('''
+        <a href="/">back</a>
+        <table>
+        % for trace in traces:
+            <tr>
+                <td>{{time.strftime('%H:%M:%S', time.localtime(trace.time))}}</td>
+                <td><a href="/trace/{{trace.id}}">{{trace.name}}</a></td>
+                <td>{{'%.1f' % (trace.duration * 1000)}}ms</td>
+                <td>{{len(trace.spans)}} spans{{f', {trace.dropped} dropped' if trace.dropped else ''}}</td>
+            </tr>
+        % end
+        </table>
+    ''', traces=tracing.recent(), time=time)
+
+
+@bottle.get('/trace/<trace_id:re:[0-9a-f]+>')
+@html()
+def trace_view(trace_id):
+    require_admin()
+    trace = tracing.get(trace_id) or bottle.abort(404, 'Trace not found (or served by another worker)')
+    trace = trace.export()
+    total = trace['duration_ms'] or 1
+    return templates.template('''
+        <a href="/trace">back</a>
+        <a href="/trace/{{trace['id']}}.json">json</a>
+        <p>{{trace['name']}} {{trace['duration_ms']}}ms</p>
+        % if trace['dropped']:
+            <p>{{trace['dropped']}} more spans dropped, only the first {{len(trace['spans'])}} are kept</p>
+        % end
+        <table style="width: 100%;">
+        % for span in trace['spans']:
+            <tr title="{{span['thread']}} {{span['attrs']}}">
+                <td style="padding-left: {{span['depth']}}em; white-space: nowrap;">
+                    {{span['name']}}
+                    % if span['error']:
+                        <b>{{span['error']}}</b>
+                    % end
+                </td>
+                <td style="white-space: nowrap;">{{span['duration_ms']}}ms</td>
+                <td style="width: 60%;">
+                    <div style="margin-left: {{span['start_ms'] / total * 100}}%;
+                                width: {{max(span['duration_ms'] / total * 100, 0.2)}}%;
+                                height: 1em; background-color: #333;"></div>
+                </td>
+            </tr>
+        % end
+        </table>
+    ''', trace=trace, total=total)
+
+
+@bottle.get('/trace/<trace_id:re:[0-9a-f]+>.json')
+def trace_json_view(trace_id):
+    require_admin()
+    trace = tracing.get(trace_id) or bottle.abort(404, 'Trace not found (or served by another worker)')
+    bottle.response.content_type = 'application/json'
+    return json.dumps(trace.export())
+
+
+@bottle.get('/usage')
+@html()
+def usage_view():
+    require_admin()
+    by = bottle.request.query.get('by', 'day')
+    if by not in Usage.GROUPS:
+        by = 'day'
+    days = max(query_int('days', 30), 1)
+    since = int(time.time()) - days * 86400
+    return templates.template('''
+        <a href="/">back</a>
+        % for group in groups:
+            <a href="/usage?by={{group}}&days={{days}}">by {{group}}</a>
+        % end
+        <p>last {{days}} days, by {{by}}</p>
+        <table>
+            <tr><th>{{by}}</th><th>calls</th><th>prompt tokens</th><th>completion tokens</th>
+                <th>avg tools size</th><th>cost</th></tr>
+        % for row in rows:
+            <tr>
+                <td>{{row['group']}}</td>
+                <td>{{row['calls']}}</td>
+                <td>{{row['prompt_tokens']}}</td>
+                <td>{{row['completion_tokens']}}</td>
+                <td>{{row['tools_size']}}</td>
+                <td>{{'' if row['cost'] is None else '%.4f' % row['cost']}}</td>
+            </tr>
+        % end
+        </table>
+        <p>largest schemas sent along with wishes (size times wishes of their master)</p>
+        <table>
+            <tr><th>incantation</th><th>master</th><th>schema size</th><th>sent</th></tr>
+        % for id, name, moniker, size, total in schemas:
+            <tr>
+                <td>{{name}} #{{id}}</td>
+                <td>{{moniker}}</td>
+                <td>{{size}}</td>
+                <td>{{total}}</td>
+            </tr>
+        % end
+        </table>
+    ''', by=by, days=days, groups=Usage.GROUPS, rows=Usage.aggregate(by, since),
+         schemas=Usage.schema_sizes(since))
+
+
+@bottle.get('/metrics')
+def metrics_view():
+    m = api_master()
+    if not m or not m.admin:
+        bottle.abort(403, 'Admins only')
+    bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.expose()
 
 
 @bottle.get('/')
 @html()
 def index():
-    return bottle.template('''
+    return templates.template('''
     <a href="/incantations">incantations</a>
     % if master.admin:
         <a href='/config'>config</a>
         <a href='/log'>log</a>
+        <a href='/trace'>traces</a>
+        <a href='/usage'>usage</a>
     % end
     <a href="/logout">logout</a>
     % if Config.check('manual_incantation_crafting'):
@@ -178,21 +435,41 @@ def index():
 
 
 
+def highlight(snippet):
+    """HTML of a search snippet: escaped, with the matched terms in <mark>"""
+    return escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
 @bottle.get('/incantations')
 @html()
 def incantations_view():
-    return bottle.template('''
+    q = bottle.request.query.getunicode('q', '').strip()
+    if q:
+        incantations, after = master().search_incantations(q), None
+    else:
+        incantations, after = master().incantations_page(query_int('after', 0))
+    return templates.template('''
         <a href="/">back</a>
+        <form action="/incantations" method="get">
+            <input type="search" name="q" value="{{q}}" />
+            <input type="submit" value="Search" />
+        </form>
         <ul>
         % for incantation in incantations:
             <li>
-                <a href="/incantation/{{incantation.id}}">{{incantation.name}}</a>
-                <a href="/incantation/{{incantation.id}}/delete">delete</a>
-                <p>{{incantation.description}}</p>
+                <a href="/incantation/{{incantation['id']}}">{{incantation['name']}}</a>
+                <a href="/incantation/{{incantation['id']}}/delete">delete</a>
+                <p>{{incantation['description']}}</p>
+                % if 'snippet' in incantation:
+                    <pre>{{!highlight(incantation['snippet'])}}</pre>
+                % end
             </li>
         % end
         </ul>
-    ''', incantations=master().incantations, json=json)
+        % if after:
+            <a href="/incantations?after={{after}}">next</a>
+        % end
+    ''', incantations=incantations, after=after, q=q, highlight=highlight)
 
 
 @bottle.post('/incantation')
@@ -215,9 +492,10 @@ def craft_incantation_view():
 @html()
 def incantation_view(id):
     incantation = master().incantation(id)
+    parameters, overrides = incantation.parameters, incantation.overrides_dict
     form = f'<form action="/incantation/{id}/override" method="post">'
-    for parameter in incantation.parameters:
-        value = incantation.overrides_dict.get(parameter, '')
+    for parameter in parameters:
+        value = overrides.get(parameter, '')
         form += f'''
             <label for="{parameter}">{parameter}</label>
             <input type="text" name="{parameter}" value="{value}" />
@@ -226,16 +504,30 @@ def incantation_view(id):
     form += '<input type="submit" value="Update overrides" />'
     form += '</form>'
     mishaps = ''
-    for mishap in incantation.mishaps:
-        mishap_request = {k: v for k, v in json.loads(mishap.request).items() if k in incantation.parameters}
+    page, after = incantation.mishaps_page(query_int('mishaps_after', 0))
+    for mishap in page:
+        mishap_request = {k: v for k, v in json.loads(mishap.request).items() if k in parameters}
+        seen = time.strftime('%Y-%m-%d %H:%M', time.localtime(mishap.last_seen)) if mishap.last_seen else ''
         mishaps += f'''
         <p>{mishap_request}</p>
+        <p>{mishap.occurrences or 1} times, last {seen}, {len(mishap.samples_list)} sample requests</p>
         <pre>{mishap.traceback}</pre>
         <a href="/mishap/{mishap.id}/fix">fix</a>
         <a href="/mishap/{mishap.id}/retry">retry</a>
         <a href="/mishap/{mishap.id}/erase">erase</a>
         <a href="/mishap/{mishap.id}/fix_and_retry">fix & retry</a>
         '''
+    if after:
+        mishaps += f'<a href="/incantation/{id}?mishaps_after={after}">older mishaps</a>'
+
+    versions = ''.join(
+        f'''<li>
+            v{version.version}, {time.strftime('%Y-%m-%d %H:%M', time.localtime(version.created)) if version.created else ''},
+            {version.code_hash[:12]}
+            <a href="/incantation/{id}/rollback/{version.version}">rollback</a>
+        </li>'''
+        for version in incantation.versions
+    )
 
     adjust = f'''
         <form action="/incantation/{id}/adjust" method="post">
@@ -273,6 +565,10 @@ def incantation_view(id):
             <summary>adjust</summary>
             {adjust}
         </details>
+        <details>
+            <summary>versions</summary>
+            <ul>{versions}</ul>
+        </details>
         {mishaps}
     '''
 
@@ -327,10 +623,21 @@ def incantation_update_schema_view(id):
     return bottle.redirect(f'/incantation/{id}')
 
 
+@bottle.get('/incantation/<id>/rollback/<version:int>')
+def incantation_rollback_view(id, version):
+    incantation = master().incantation(id)
+    incantation.rollback(version)
+    return bottle.redirect(f'/incantation/{id}')
+
+
 @bottle.get('/incantation/<id>/delete')
 def incantation_delete_view(id):
     incantation = master().incantation(id)
+    if pipelines := [pipeline.name for pipeline in incantation.pipelines]:
+        names = ', '.join(pipelines)
+        bottle.abort(409, f'{incantation.name} is used by the pipelines {names}, remove it from them first')
     incantation.mishaps.delete()
+    incantation.versions.delete()
     incantation.delete()
     return bottle.redirect('/incantations')
 
@@ -341,14 +648,10 @@ def wish_view():
     text = bottle.request.forms.get('text')
     match master().wish(text):
         case incantation, request, exception:
-            incantation.mishaps.append(
-                request=request,
-                code=incantation.code,
-                traceback=''.join(traceback.format_exception(exception, limit=-2))
-            )
+            Mishap.record(incantation, request, exception)
             return bottle.redirect(f'/incantation/{incantation.id}?mishap=true')
         case result:
-            return bottle.template('''
+            return templates.template('''
                 <a href="/">back</a>
                 <p>{{result}}</p>
             ''', result=result)
@@ -359,9 +662,9 @@ def mishap_fix_view(id):
     mishap = master().mishap(id)
     result = mishap.fix()
     if isinstance(result, Exception):
-        return bottle.redirect(f'/incantation/{mishap.incantation.id}?mishap=true')
+        return bottle.redirect(f'/incantation/{mishap.incantation_id}?mishap=true')
     else:
-        return bottle.redirect(f'/incantation/{mishap.incantation.id}')
+        return bottle.redirect(f'/incantation/{mishap.incantation_id}')
 
 
 @bottle.get('/mishap/<id>/retry')
@@ -370,9 +673,9 @@ def mishap_retry_view(id):
     mishap = master().mishap(id)
     result = mishap.retry()
     if isinstance(result, Exception):
-        return bottle.redirect(f'/incantation/{mishap.incantation.id}?mishap=true')
+        return bottle.redirect(f'/incantation/{mishap.incantation_id}?mishap=true')
     else:
-        return bottle.template('''
+        return templates.template('''
             <a href="/">back</a>
             <p>{{result}}</p>
         ''', result=result)
@@ -382,7 +685,7 @@ def mishap_retry_view(id):
 def mishap_erase_view(id):
     mishap = master().mishap(id)
     mishap.delete()
-    return bottle.redirect(f'/incantation/{mishap.incantation.id}')
+    return bottle.redirect(f'/incantation/{mishap.incantation_id}')
 
 
 @bottle.get('/mishap/<id>/fix_and_retry')
@@ -391,13 +694,13 @@ def mishap_fix_and_retry_view(id):
     mishap = master().mishap(id)
     result = mishap.fix()
     if isinstance(result, Exception):
-        return bottle.redirect(f'/incantation/{mishap.incantation.id}?mishap=true')
+        return bottle.redirect(f'/incantation/{mishap.incantation_id}?mishap=true')
     else:
         result = mishap.retry()
         if isinstance(result, Exception):
-            return bottle.redirect(f'/incantation/{mishap.incantation.id}?mishap=true')
+            return bottle.redirect(f'/incantation/{mishap.incantation_id}?mishap=true')
         else:
-            return bottle.template('''
+            return templates.template('''
                 <a href="/">back</a>
                 <p>{{result}}</p>
             ''', result=result)
@@ -424,6 +727,61 @@ def api_craft_and_prepare_view():
     return json.dumps(result)
 
 
+@bottle.get('/api/incantations/search')
+def api_incantations_search_view():
+    limit = min(max(query_int('limit', 20), 1), 100)
+    results = api_master().search_incantations(bottle.request.query.getunicode('q', ''), limit)
+    for result in results:
+        result['snippet'] = highlight(result['snippet'])
+    return json.dumps(results)
+
+
+@bottle.get('/api/incantations')
+def api_incantations_view():
+    limit = min(max(query_int('limit', 50), 1), 500)
+    incantations, after = api_master().incantations_page(query_int('after', 0), limit)
+    return json.dumps({'incantations': incantations, 'next': after})
+
+
+@bottle.get('/api/incantations/export')
+def api_incantations_export_view():
+    bottle.response.content_type = 'application/x-ndjson'
+    bottle.response.headers['Content-Disposition'] = 'attachment; filename="incantations.ndjson"'
+    return (json.dumps(entry) + '\n' for entry in api_master().export_incantations())
+
+
+@bottle.post('/api/incantations/import')
+def api_incantations_import_view():
+    try:
+        result = api_master().import_incantations(bottle.request.body)
+    except ValueError as e:
+        macaron.rollback()
+        return bottle.HTTPResponse(json.dumps({'error': str(e)}), status=400)
+    return json.dumps(result)
+
+
+@bottle.get('/api/pipelines')
+def api_pipelines_view():
+    return json.dumps([pipeline.export() for pipeline in api_master().pipelines.prefetch_related('steps')])
+
+
+@bottle.post('/api/pipelines')
+def api_pipeline_create_view():
+    data = json.loads(bottle.request.body.read().decode('utf-8'))
+    try:
+        pipeline = api_master().create_pipeline(data['name'], data['steps'])
+    except (KeyError, TypeError, ValueError) as e:
+        return bottle.HTTPResponse(json.dumps({'error': str(e)}), status=400)
+    return json.dumps(pipeline.export())
+
+
+@bottle.delete('/api/pipelines/<id:int>')
+def api_pipeline_delete_view(id):
+    if api_master().delete_pipeline(id) is None:
+        return bottle.HTTPResponse(json.dumps({'error': f'No pipeline {id}'}), status=404)
+    return json.dumps({'deleted': id})
+
+
 @bottle.post('/api/wish')
 def api_wish_view():
     input_format, voice_in = bottle.request.headers.get('Content-Type'), False
@@ -442,16 +800,14 @@ def api_wish_view():
 
     match api_master().wish(text, voice=voice_in):
         case incantation, request, exception:
-            incantation.mishaps.append(
-                request=request,
-                code=incantation.code,
-                traceback=''.join(traceback.format_exception(exception, limit=-2))
-            )
+            Mishap.record(incantation, request, exception)
             return (api_master().tts if voice_out else str)(f'Error: {exception}')
         case result:
             return (api_master().tts if voice_out else str)(result)
 
 
+templates.precompile(__file__)
+
 if __name__ == '__main__':
     BaseModel.create_tables()
     Master.fetch(
@@ -459,4 +815,11 @@ if __name__ == '__main__':
         os.environ.get('PASSWORD', 'open_sesame'),
         admin=True
     )
-    bottle.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=True)
+    macaron.bake()
+    if PRODUCTION:
+        bottle.run(
+            host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=False,
+            **server.run_options(SERVER, THREADS, KEEPALIVE, WORKERS)
+        )
+    else:
+        bottle.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=True)
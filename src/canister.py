@@ -8,6 +8,8 @@ Canister is a simple plugin for bottle, providing:
 - CORS for cross-domain REST APIs
 """
 import sys
+import json
+import sqlite3
 import logging
 import logging.handlers
 import bottle
@@ -173,6 +175,9 @@ class SessionCache:
     def __contains__(self, sid):
         return sid in self._cache
         
+    def __len__(self):
+        return len(self._cache.keys())
+        
         
     def get(self, sid):
         with self._lock:
@@ -202,6 +207,91 @@ class SessionCache:
             del self._cache[sid]
             
             
+
+class SqliteSessionCache:
+    '''A session cache stored in SQLite, shared by every process using the same file'''
+    
+    def __init__(self, path, timeout=3600):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._pid = os.getpid()
+        log = logging.getLogger('canister')
+        
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS canister_session '
+            '(sid TEXT PRIMARY KEY, user TEXT, data TEXT, touched REAL)'
+        )
+        
+        if timeout <= 0:
+            log.warn('Sessions kept indefinitely! (session timeout is <= 0)')
+            return
+        
+        interval = int(math.sqrt(timeout))
+        log.info('Session timeout is %d seconds. Checking for expired sessions every %d seconds. ' % (timeout, interval))
+        
+        def prune():
+            while True:
+                time.sleep(interval)
+                n = self._conn().execute('DELETE FROM canister_session WHERE touched < ?', (time.time() - timeout,)).rowcount
+                log.debug('%d expired sessions pruned' % n)
+        
+        # Only the process that created the cache prunes it, forked workers share its table.
+        cleaner = threading.Thread(name="SessionCleaner", target=prune)
+        cleaner.daemon = True
+        cleaner.start()
+    
+    def _conn(self):
+        # one autocommit connection per thread, never reused across fork()
+        if self._pid != os.getpid():
+            self._local, self._pid = threading.local(), os.getpid()
+        if not hasattr(self._local, 'conn'):
+            self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self._local.conn
+    
+    def _load(self, sid):
+        row = self._conn().execute('SELECT user, data, touched FROM canister_session WHERE sid = ?', (sid,)).fetchone()
+        if not row or (self.timeout > 0 and time.time() - row[2] >= self.timeout):
+            return None
+        return row
+    
+    def __contains__(self, sid):
+        return self._load(sid) is not None
+        
+    def __len__(self):
+        since = time.time() - self.timeout if self.timeout > 0 else 0
+        return self._conn().execute('SELECT COUNT(*) FROM canister_session WHERE touched >= ?', (since,)).fetchone()[0]
+        
+        
+    def get(self, sid):
+        row = self._load(sid)
+        if not row:
+            return (None, None)
+        now = time.time()
+        if now - row[2] > 60: # keep the hot path read-only, touch at most once a minute
+            self._conn().execute('UPDATE canister_session SET touched = ? WHERE sid = ?', (now, sid))
+        return (json.loads(row[0]), json.loads(row[1]))
+    
+    def set(self, sid, user, data):
+        assert sid
+        self._conn().execute(
+            'INSERT OR REPLACE INTO canister_session (sid, user, data, touched) VALUES (?, ?, ?, ?)',
+            (sid, json.dumps(user), json.dumps(data), time.time())
+        )
+            
+    
+    def create(self, user=None, data=None):
+        sid = base64.b64encode(os.urandom(18)).decode('ascii')
+        if not data:
+            data = {}
+        self.set(sid, user, data)
+        return (sid, user, data)
+    
+    
+    def delete(self, sid):
+        self._conn().execute('DELETE FROM canister_session WHERE sid = ?', (sid,))
+            
+            
             
 class Canister:
     name = 'canister'
@@ -237,8 +327,14 @@ class Canister:
         app.log = log
         
         timeout = int(config.get('canister.session_timeout', '3600'))
-        self.sessions = SessionCache(timeout=timeout)
-        self.session_secret = base64.b64encode(os.urandom(30)).decode('ascii')
+        session_db = config.get('canister.session_db')
+        if session_db:
+            # sessions in SQLite are shared by all (forked) processes of the app
+            self.sessions = SqliteSessionCache(session_db, timeout=timeout)
+            log.info('Sessions stored in ' + session_db)
+        else:
+            self.sessions = SessionCache(timeout=timeout)
+        self.session_secret = config.get('canister.session_secret') or base64.b64encode(os.urandom(30)).decode('ascii')
         
         self.auth_basic = _buildAuthBasic(config)
         if self.auth_basic:
@@ -282,6 +378,7 @@ class Canister:
             
             session.sid = sid
             session.data = data
+            snapshot = dict(data) # views mutate session.data in place
             
             # thread name = <ip>-<session_id[0:6]>
             threading.current_thread().name = req.remote_addr + '-' + sid[0:6]
@@ -314,10 +411,12 @@ class Canister:
                 if a in req.params:
                     kwargs[a] = req.params[a]
                     
-            result = callback(*args, **kwargs)
-            
-            if session.user != user or session.data != data:
-                self.sessions.set(sid, session.user, session.data)
+            try:
+                result = callback(*args, **kwargs)
+            finally:
+                # also on redirects, which are raised as HTTPResponse
+                if session.user != user or session.data != snapshot:
+                    self.sessions.set(sid, session.user, session.data)
                 
             if self.cors:
                 res.headers['Access-Control-Allow-Origin'] = self.cors
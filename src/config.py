@@ -4,3 +4,22 @@ import pathlib
 DATA_PATH = pathlib.Path(os.environ.get('DATA_PATH', '/var/www/data'))
 DB_PATH = DATA_PATH / 'db.sqlite3'
 LOG_PATH = DATA_PATH / 'jinn.log'
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', 5))
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text or json (JSON lines)
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None  # e.g. http://127.0.0.1:8765/v1 for bench/fake_openai.py
+
+DB_TIMEOUT = float(os.environ.get('DB_TIMEOUT', 30))  # seconds a request waits for another writer's lock
+SQL_CACHED_STATEMENTS = int(os.environ.get('SQL_CACHED_STATEMENTS', 128))  # compiled statements kept per connection
+
+TRACE_BUFFER = int(os.environ.get('TRACE_BUFFER', 512))  # traces kept per process, 0 disables tracing
+TRACE_SPANS = int(os.environ.get('TRACE_SPANS', 1000))  # spans kept per trace, the rest are counted
+
+PRODUCTION = os.environ.get('MODE', 'development') == 'production'
+SERVER = os.environ.get('SERVER', 'threaded')
+THREADS = int(os.environ.get('THREADS', 8))
+CALL_THREADS = int(os.environ.get('CALL_THREADS', 16))  # for the tool calls of wishes, as many for smoke checks
+CALL_TIMEOUT = float(os.environ.get('CALL_TIMEOUT', 60))  # seconds a wish waits for its tool calls
+KEEPALIVE = int(os.environ.get('KEEPALIVE', 15))
+WORKERS = int(os.environ.get('WORKERS', 1))
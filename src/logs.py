@@ -0,0 +1,227 @@
+"""
+Non-blocking logging: offloaded loggers only put records on a queue, a single
+writer thread formats and writes them and flushes once per batch.
+"""
+import os
+import copy
+import json
+import queue
+import sqlite3
+import logging
+import logging.handlers
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that is flushed once per batch (see `commit`) instead of once per record"""
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding='utf-8'):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding, delay=True)
+        self.size = os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def flush(self):
+        pass
+
+    def emit(self, record):
+        # keeps track of the size itself, tell() and seek() would flush the buffer
+        try:
+            msg = self.format(record) + self.terminator
+            if self.maxBytes > 0 and self.size and self.size + len(msg) >= self.maxBytes:
+                self.doRollover()
+                self.size = 0
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            self.size += len(msg)
+        except Exception:
+            self.handleError(record)
+
+    def commit(self):
+        if self.stream is None:
+            return
+        self.stream.flush()
+        opened = os.fstat(self.stream.fileno())
+        self.size = opened.st_size
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != opened.st_ino
+        except FileNotFoundError:
+            rotated = True
+        if rotated:  # by another process writing the same log
+            self.stream.close()
+            self.stream = None
+            self.size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+
+
+class SQLiteBatchHandler(logging.Handler):
+    """Inserts the ``row`` attribute of records (``logger.info('', extra={'row': ...})``)
+    with one executemany per batch"""
+
+    def __init__(self, path, statement):
+        super().__init__()
+        self.path = path
+        self.statement = statement
+        self.rows = []
+        self.conn = None
+        self.pid = None
+
+    def emit(self, record):
+        self.rows.append(record.row)
+
+    def commit(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        try:
+            if self.pid != os.getpid():  # never reuse a connection across fork()
+                # the writer thread is replaced around fork() and at shutdown, one uses it at a time
+                self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                self.pid = os.getpid()
+            with self.conn:
+                self.conn.executemany(self.statement, rows)
+        except Exception:
+            logging.getLogger('canister').exception('Lost %d rows for %s', len(rows), self.statement)
+
+    def flush(self):
+        self.commit()
+
+    def close(self):
+        self.commit()
+        if self.conn is not None and self.pid == os.getpid():
+            self.conn.close()
+        self.conn = None
+        super().close()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the shared queue along with the handlers that should write them"""
+
+    def __init__(self, queue, handlers):
+        super().__init__(queue)
+        self.targets = handlers
+
+    def prepare(self, record):
+        # the stdlib version formats the record here, on the logging thread, and drops
+        # exc_info; only the message is resolved (its arguments may change once we
+        # return), formatting is left to the handlers on the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self.queue.put_nowait((self.targets, record))
+
+    def close(self):
+        stop()
+        super().close()
+
+
+class BatchListener(logging.handlers.QueueListener):
+    """QueueListener that handles up to `batch` waiting records before flushing"""
+
+    def __init__(self, queue, batch=256):
+        super().__init__(queue, respect_handler_level=True)
+        self.batch = batch
+
+    def handle(self, item):
+        handlers, record = item
+        record = self.prepare(record)
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            items = [self.dequeue(True)]
+            while items[-1] is not self._sentinel and len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            touched = set()
+            for item in items:
+                if item is self._sentinel:
+                    break
+                self.handle(item)
+                touched.update(item[0])
+            for handler in touched:
+                getattr(handler, 'commit', handler.flush)()
+            if items[-1] is self._sentinel:
+                return
+
+
+_queue = queue.SimpleQueue()
+_listener = None
+_offloaded = []
+_forking = False
+
+
+def offload(logger):
+    """Moves the handlers of `logger` behind the shared queue, logging calls then only enqueue"""
+    handlers = tuple(logger.handlers)
+    if not handlers:
+        return logger
+    for handler in handlers:
+        logger.removeHandler(handler)
+    handler = QueueHandler(_queue, handlers)
+    _offloaded.append(handler)
+    logger.addHandler(handler)
+    start()
+    return logger
+
+
+def start():
+    global _listener
+    if _listener is None:
+        _listener = BatchListener(_queue)
+        _listener.start()
+
+
+def stop():
+    """Writes out everything queued so far and stops the writer thread"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+
+
+def _before_fork():
+    # drain first, so the child doesn't inherit (and write again) buffered records
+    global _forking
+    _forking = _listener is not None
+    stop()
+
+
+def _after_fork_in_parent():
+    if _forking:
+        start()
+
+
+def _after_fork_in_child():
+    # the writer thread doesn't survive fork(), start a new one with a fresh queue
+    global _queue
+    _queue = queue.SimpleQueue()
+    for handler in _offloaded:
+        handler.queue = _queue
+    if _forking:
+        start()
+
+
+os.register_at_fork(
+    before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_after_fork_in_child
+)
@@ -28,10 +28,11 @@ __author__ = "Nobuo Okazaki"
 __version__ = "0.4.0-dev"
 __license__ = "MIT License"
 
-import sqlite3, re, sys
-import copy, warnings
+import sqlite3, re, sys, os
+import warnings
 import logging
 import collections
+import threading
 from datetime import datetime
 
 PY3K = sys.version_info.major >= 3
@@ -58,15 +59,24 @@ _m = None               # Macaron object
 _pre_field_order = []   # Created order of Model field object
 history = None          #: Returns history of SQL execution. You can get history like a list (index:0 is latest).
 SQL_TRACE_OUT = None    # In case of tracing SQL and parameters on CursorWrapper, set output stream(ex. sys.stderr)
+SQL_TRACE_HOOK = None   # Callable(sql, parameters) returning a context manager wrapped around each CursorWrapper.execute
+SQL_CACHE_SIZE = 512    # Max count of SQL strings kept by QuerySet, keyed by clause structure (0 disables)
 sqlite_version_info = sqlite3.sqlite_version_info
 
 #_callbacks_when_connect = [] # TEMPORARY BUG FIX: see the comment of ModelMeta.__init__()
 
+_identity = threading.local()  # per-thread identity map, see identity_map
+_sql_cache = {}         # clause structure -> SQL, see QuerySet._generate_sql
+_prepared = {}          # (Model, args) -> PreparedQuery, see Model.prepared
+
 # --- Module methods
-def macaronage(dbfile=":memory:", lazy=False, autocommit=False, logger=None, history=-1, keep=False, threading=False, regexp=None):
+def macaronage(dbfile=":memory:", lazy=False, autocommit=False, logger=None, history=-1, keep=False, threading=False, regexp=None, local=False, cached_statements=128, timeout=5.0):
     """
     :param dbfile: SQLite database file name.
+    :param cached_statements: Size of the prepared statement cache of each connection.
+    :param timeout: Seconds a connection waits for a lock held by another one (busy timeout).
     :param lazy: Uses :class:`LazyConnection`.
+    :param local: Uses :class:`ThreadLocalConnection` (one connection per thread).
     :param autocommit: Commits automatically when closing database.
     :param logger: Uses for logging SQL execution.
     :param history: Sets max count of SQL execution history (0 is unlimited, -1 is disabled).
@@ -96,11 +106,8 @@ def macaronage(dbfile=":memory:", lazy=False, autocommit=False, logger=None, his
     #   id -1221678384' in <bound method Macaron.__del__ of <macaron.Macaron object at 0xb4a93eec>> ignored
     # But this is NOT a fundamental solution...Maybe.
     # About threadsafety of sqlite3: http://www.sqlite.org/threadsafe.html
-    if lazy: conn = LazyConnection(dbfile, factory=_create_wrapper(logger), check_same_thread=(not threading))
-    else: conn = sqlite3.connect(dbfile, factory=_create_wrapper(logger), check_same_thread=(not threading))
-    if not conn: raise Exception("Can't create connection.")
 
-    # Set REGEXP function
+    # Set REGEXP function (registered by each connection, see ConnectionWrapper)
     if regexp is None:
         def _regexp(expr, item):
             try: return re.search(expr, item) is not None
@@ -109,7 +116,13 @@ def macaronage(dbfile=":memory:", lazy=False, autocommit=False, logger=None, his
         _regexp = regexp
     else:
         raise ValueError("regexp must be 'default' or function.")
-    conn.create_function("REGEXP", 2, _regexp)
+
+    factory = _create_wrapper(logger, _regexp)
+    kw = {"factory": factory, "cached_statements": cached_statements, "timeout": timeout}
+    if local: conn = ThreadLocalConnection(dbfile, **kw)
+    elif lazy: conn = LazyConnection(dbfile, check_same_thread=(not threading), **kw)
+    else: conn = sqlite3.connect(dbfile, check_same_thread=(not threading), **kw)
+    if not conn: raise Exception("Can't create connection.")
 
     _m.connection["default"] = conn
     _m.autocommit = autocommit
@@ -124,6 +137,44 @@ def execute(*args, **kw):
     """Wrapper for ``Cursor#execute()``."""
     return _m.connection["default"].cursor().execute(*args, **kw)
 
+def executemany(*args, **kw):
+    """Wrapper for ``Cursor#executemany()``."""
+    return _m.connection["default"].cursor().executemany(*args, **kw)
+
+class identity_map(object):
+    """Context manager in which relations resolve one object per primary key.
+
+    Inside it, ManyToOne accessors and :meth:`QuerySet.select_related` share
+    the objects they load, so ``mishap.incantation`` queries the database once
+    however many times it is read. :meth:`QuerySet.update` and
+    :meth:`QuerySet.delete` forget the objects of their model, raw SQL does not.
+    """
+    def __enter__(self):
+        self.previous = getattr(_identity, "map", None)
+        _identity.map = {}
+        return _identity.map
+
+    def __exit__(self, *exc_info):
+        _identity.map = self.previous
+
+def _identity_get(cls, pk):
+    objs = getattr(_identity, "map", None)
+    if objs is None or pk is None: return None
+    return objs.get((cls, pk))
+
+def _identity_add(obj):
+    """Registers `obj`, returns the object already known for its key if any"""
+    objs = getattr(_identity, "map", None)
+    if objs is None or obj.pk is None: return obj
+    return objs.setdefault((obj.__class__, obj.pk), obj)
+
+def _identity_forget(cls, pk=None):
+    objs = getattr(_identity, "map", None)
+    if not objs: return
+    if pk is not None: objs.pop((cls, pk), None)
+    else:
+        for key in [k for k in objs if k[0] is cls]: del objs[key]
+
 def bake():     _m.connection["default"].commit()   # Commits
 def rollback(): _m.connection["default"].rollback() # Rollback
 def cleanup():
@@ -224,12 +275,13 @@ class Macaron(object):
         return self.connection[meta_obj.conn_name]
 
 # --- Connection wrappers
-def _create_wrapper(logger):
+def _create_wrapper(logger, regexp=None):
     """Returns ConnectionWrapper class"""
     class ConnectionWrapper(sqlite3.Connection):
         def __init__(self, *args, **kw):
             super(ConnectionWrapper, self).__init__(*args, **kw)
             self.execute("PRAGMA foreign_keys = ON")    # fkey support ON (SQLite>=3.6.19)
+            if regexp: self.create_function("REGEXP", 2, regexp)
             self.warn_pragma = True
 
             # Cache results of PRAGMA table_info() for TRANSACTION
@@ -269,12 +321,32 @@ class CursorWrapper(sqlite3.Cursor):
             SQL_TRACE_OUT.write("[macaron:SQL  ]:%s\n" % sql)
             SQL_TRACE_OUT.write("[macaron:PARAM]:%s\n" % str(parameters))
         try:
+            if SQL_TRACE_HOOK:
+                with SQL_TRACE_HOOK(sql, parameters):
+                    return super(CursorWrapper, self).execute(sql, parameters)
             return super(CursorWrapper, self).execute(sql, parameters)
         except:
             sys.stderr.write("[macaron:Error in SQL  ]\n%s\n" % sql)
             sys.stderr.write("[macaron:Error in PARAM]\n%s\n" % str(parameters))
             raise
 
+    def executemany(self, sql, seq_of_parameters):
+        if self.connection.logger:
+            self.connection.logger.debug("%s\n(executemany)" % sql)
+        if(isinstance(history, ListHandler)):
+            history.lastsql = sql
+            history.lastparams = None
+        if SQL_TRACE_OUT:
+            SQL_TRACE_OUT.write("[macaron:SQL  ]:%s\n" % sql)
+        try:
+            if SQL_TRACE_HOOK:
+                with SQL_TRACE_HOOK(sql, None):
+                    return super(CursorWrapper, self).executemany(sql, seq_of_parameters)
+            return super(CursorWrapper, self).executemany(sql, seq_of_parameters)
+        except:
+            sys.stderr.write("[macaron:Error in SQL  ]\n%s\n" % sql)
+            raise
+
 class LazyConnection(object):
     """Lazy connection wrapper"""
     def __init__(self, *args, **kw):
@@ -289,6 +361,32 @@ class LazyConnection(object):
 
     def noop(self): return  # NO-OP for commit, rollback, close
 
+class ThreadLocalConnection(object):
+    """Lazy connection wrapper holding one connection per thread.
+    Each thread connects on first use, so the wrapper can be shared by
+    multi-threaded servers without 'check_same_thread' errors.
+    After fork() the child starts with fresh connections; the inherited
+    ones are kept referenced but never used or closed by the child.
+    """
+    def __init__(self, *args, **kw):
+        self.args = args
+        self.kwargs = kw
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def __getattr__(self, name):
+        if self._pid != os.getpid():
+            self._inherited.append(self._local)
+            self._local, self._pid = threading.local(), os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if not conn and (name in ["commit", "rollback", "close"]): return self.noop
+        if not conn: conn = self._local.conn = sqlite3.connect(*self.args, **self.kwargs)
+        if name == "close": self._local.conn = None
+        return getattr(conn, name)
+
+    def noop(self): return  # NO-OP for commit, rollback, close
+
 # --- Logging
 class ListHandler(logging.Handler):
     """SQL history listing handler for ``logging``.
@@ -672,7 +770,14 @@ class ManyToOne(Field):
     ref_key = property(_get_ref_key)
 
     def __get__(self, owner, cls):
-        if getattr(owner, self.fkey) is None: return None
+        key = getattr(owner, self.fkey)
+        if key is None: return None
+        loaded = owner.__dict__.get("_related", {}).get(self.name)   # see QuerySet.select_related
+        if loaded is not None and loaded[0] == key: return loaded[1]    # None when the join found nothing
+        by_pk = self.ref_key == self.ref._meta.primary_key.name
+        if by_pk:
+            obj = _identity_get(self.ref, key)
+            if obj is not None: return obj
         reftbl = self.ref._meta.table_name
         clstbl = cls._meta.table_name
 #        sql = 'SELECT "%s".* FROM "%s" LEFT JOIN "%s" ON "%s" = "%s"."%s" WHERE "%s"."%s" = ?' \
@@ -683,8 +788,10 @@ class ManyToOne(Field):
 #        cur = cur.execute(sql, [owner.pk])
         cur = cur.execute(sql, [getattr(owner, self.fkey)])
         row = cur.fetchone()
+        if row is None: return None     # a dangling key, as with select_related
         if cur.fetchone(): raise NotUniqueForeignKey("Reference key '%s.%s' is not unique." % (reftbl, self.ref_key))
-        return self.ref._factory(cur, row)
+        obj = self.ref._factory(cur, row)
+        return _identity_add(obj) if by_pk else obj
 
     def __set__(self, owner, value):
         if value and not isinstance(value, self.ref):
@@ -745,7 +852,9 @@ class _ManyToOne_Rev(property):
 
     def __get__(self, owner, cls):
         qs = self.rev.select("%s = ?" % self.rev_fkey, [getattr(owner, self.ref_key)])
-        return ManyToOneRevSet(qs, owner, self)
+        revset = ManyToOneRevSet(qs, owner, self)
+        revset._prefetched = owner.__dict__.get("_prefetched", {}).get(self)   # see QuerySet.prefetch_related
+        return revset
 
 # --- Many-to-many relationship
 class _ManyToManyBase(property):
@@ -815,7 +924,8 @@ class QuerySet(object):
     def __init__(self, parent):
         if isinstance(parent, QuerySet):
             self.cls = parent.cls
-            self.clauses = copy.deepcopy(parent.clauses)
+            # clauses hold only strings, numbers and lists of them: copying the lists is enough
+            self.clauses = dict([[k, list(v) if isinstance(v, list) else v] for k, v in parent.clauses.items()])
             self.factory = parent.factory   # Factory method converting record to object
             self.wrapper_clause = parent.wrapper_clause
         else:
@@ -835,8 +945,21 @@ class QuerySet(object):
         self.cur = None     # cursor
         self._index = -1    # pointer
         self._cache = []    # cache list
+        self._pending = None    # objects loaded ahead, see prefetch_related
 
     def _generate_sql(self):
+        c = self.clauses
+        key = (self.cls._meta.table_name, self.wrapper_clause, c["distinct"], c["select_fields"],
+               tuple(c["joins"]), tuple(c["where"]), tuple(c["order_by"]), c["limit"], c["offset"])
+        sql = _sql_cache.get(key)
+        if sql is None:
+            sql = self._build_sql()
+            if SQL_CACHE_SIZE:
+                if len(_sql_cache) >= SQL_CACHE_SIZE: _sql_cache.clear()
+                _sql_cache[key] = sql
+        return sql
+
+    def _build_sql(self):
         # To delete: wrapper_clause is set to DELETE...
         if self.clauses["distinct"]: distinct = "DISTINCT "
         else: distinct = ""
@@ -864,6 +987,37 @@ class QuerySet(object):
         """Getting and setting a new cursor"""
         self._initialize_cursor()
         self.cur = self.cls._meta._conn.cursor().execute(self.sql, self.clauses["values"])
+        if self.clauses.get("prefetch") and not self.wrapper_clause:
+            self._pending = collections.deque([self._load(self.cur, row) for row in self.cur.fetchall()])
+            self._prefetch(self._pending)
+
+    def _load(self, cur, row):
+        """Converts a row to an object along with its select_related() objects"""
+        obj = self.factory(cur, row)
+        for name in self.clauses.get("related", ()):
+            fld = self.cls.__dict__[name]
+            prefix = "%s__" % name
+            h = dict([[d[0][len(prefix):], row[i]] for i, d in enumerate(cur.description) if d[0].startswith(prefix)])
+            related = None
+            if h[fld.ref._meta.primary_key.name] is not None:
+                dbrow = sqlite3.Row(cur, row)
+                related = fld.ref(**dict([[f.name, f.to_object(dbrow, h[f.name])] for f in fld.ref._meta.fields]))
+                related = _identity_add(related)
+            obj.__dict__.setdefault("_related", {})[name] = (getattr(obj, fld.fkey), related)
+        return obj
+
+    def _prefetch(self, objs):
+        """Loads the prefetch_related() members of `objs`, one IN query per relation"""
+        for name in self.clauses["prefetch"]:
+            rel = self.cls.__dict__[name]
+            keys = list(set([getattr(obj, rel.ref_key) for obj in objs]))
+            members = collections.defaultdict(list)
+            for i in range(0, len(keys), 500):   # stay below SQLITE_MAX_VARIABLE_NUMBER
+                chunk = keys[i:i + 500]
+                where = '"%s"."%s" IN (%s)' % (rel.rev._meta.table_name, rel.rev_fkey, ", ".join(["?"] * len(chunk)))
+                for member in rel.rev.select(where, chunk): members[getattr(member, rel.rev_fkey)].append(member)
+            for obj in objs:
+                obj.__dict__.setdefault("_prefetched", {})[rel] = members.get(getattr(obj, rel.ref_key), [])
 
     def _convert_order_fields(self, fields):
         """Convert order ['-id', 'name'] to ['"id" DESC', '"name"']"""
@@ -891,7 +1045,7 @@ class QuerySet(object):
             desc = ""
             if n.startswith("-"): n, desc = n[1:], " DESC"
             if re.match(r"(\w+)\.(\w+)", n): n = re.sub(r"(\w+)\.(\w+)", conv, n)
-            else: n = '"%s"' % n
+            else: n = '"%s"."%s"' % (self.cls._meta.table_name, n)
             res.append('%s%s' % (n, desc))
         return res
 
@@ -901,16 +1055,65 @@ class QuerySet(object):
 
     def next(self):
         if not self.cur: self._execute()
+        if self._pending is not None:
+            if not self._pending: raise StopIteration()
+            self._index += 1
+            self._cache.append(self._pending.popleft())
+            return self._cache[-1]
         row = self.cur.fetchone()
         self._index += 1
         if not row: raise StopIteration()
-        self._cache.append(self.factory(self.cur, row))
+        self._cache.append(self._load(self.cur, row))
         return self._cache[-1]
     __next__ = next
 
+    def iterator(self, chunk_size=1000):
+        """Iterating the records without keeping them: rows are fetched
+        `chunk_size` at a time with fetchmany and the objects are not cached,
+        so memory stays flat however large the result is. prefetch_related()
+        is applied to each chunk."""
+        cur = self.cls._meta._conn.cursor().execute(self.sql, self.clauses["values"])
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows: break
+            objs = [self._load(cur, row) for row in rows]
+            if self.clauses.get("prefetch"): self._prefetch(objs)
+            for obj in objs: yield obj
+
+    def values_list(self, *names, **kw):
+        """Selecting only the fields `names` (default: all) as plain tuples, or
+        bare values with ``flat=True`` and a single field, without creating
+        model objects. Combine with iterator() to scan large tables."""
+        flat = kw.pop("flat", False)
+        if kw: raise TypeError("Unexpected keyword arguments: %s" % ", ".join(kw))
+        flds = dict((fld.name, fld) for fld in self.cls._meta.fields)
+        names = names or [fld.name for fld in self.cls._meta.fields]
+        for n in names:
+            if n not in flds: raise ValueError("Invalid column name '%s'." % n)
+        if flat and len(names) != 1: raise ValueError("'flat' requires a single field.")
+        newset = self.__class__(self)
+        newset.clauses["select_fields"] = ", ".join(['"%s"."%s"' % (self.cls._meta.table_name, n) for n in names])
+        newset.clauses.pop("related", None)
+        newset.clauses.pop("prefetch", None)
+        converters = [flds[n].to_object for n in names]
+        def factory(cur, row):
+            dbrow = sqlite3.Row(cur, row)
+            values = tuple([conv(dbrow, v) for conv, v in zip(converters, row)])
+            return values[0] if flat else values
+        newset.factory = factory
+        return newset
+
+    def prepared(self):
+        """Returns a :class:`PreparedQuery` of this query, whose SQL is generated
+        once. Its parameters are bound at each call, so the query itself must not
+        hold values."""
+        if self.clauses["values"]:
+            raise ValueError("A prepared query takes its parameters when called, not from select().")
+        return PreparedQuery(self)
+
     def get(self, *args, **kw):
         if len(args) == 1:
-            args = ('"%s" = ?' % self.cls._meta.primary_key.name, args[0])
+            args = ('"%s"."%s" = ?' % (self.cls._meta.table_name, self.cls._meta.primary_key.name), args[0])
         qs = self.select(*args, **kw)
         try: obj = qs.next()
         except StopIteration: raise self.cls.DoesNotExist("%s object is not found." % self.cls.__name__)
@@ -973,6 +1176,63 @@ class QuerySet(object):
         h = {"tbl": self.cls._meta.table_name, "pk": self.cls._meta.primary_key.name}
         self.wrapper_clause = 'DELETE FROM "%(tbl)s" WHERE "%(pk)s" IN (SELECT "%(pk)s" FROM (\n%%s\n))' % h
         self._execute()
+        _identity_forget(self.cls)
+
+    def update(self, **kw):
+        """Updating the given fields of every selected record with one statement.
+        Hooks and validation are skipped. Returns the number of updated rows."""
+        flds = dict((fld.name, fld) for fld in self.cls._meta.fields)
+        for k in list(kw.keys()):
+            rel = self.cls.__dict__.get(k)
+            if isinstance(rel, ManyToOne):  # update(master=obj) sets "master_id"
+                v = kw.pop(k)
+                kw[rel.fkey] = getattr(v, rel.ref_key) if isinstance(v, Model) else v
+            elif k not in flds: raise ValueError("Invalid column name '%s'." % k)
+        if not kw: raise ValueError("update() requires at least one field.")
+        h = {
+            "tbl": self.cls._meta.table_name, "pk": self.cls._meta.primary_key.name,
+            "set": ", ".join(['"%s" = ?' % k for k in kw]),
+        }
+        newset = self.__class__(self)
+        newset.clauses["type"] = "UPDATE"
+        newset.wrapper_clause = 'UPDATE "%(tbl)s" SET %(set)s WHERE "%(pk)s" IN (SELECT "%(pk)s" FROM (\n%%s\n))' % h
+        values = [flds[k].to_database(None, v) for k, v in kw.items()]
+        cur = self.cls._meta._conn.cursor().execute(newset.sql, values + newset.clauses["values"])
+        _identity_forget(self.cls)
+        return cur.rowcount
+
+    def select_related(self, *names):
+        """Loading the objects of the ManyToOne relations `names` in the same
+        query with a LEFT JOIN, instead of one query per object and relation.
+        A relation whose target is missing reads as None. Conditions on columns
+        of the same name must be qualified with the table name then, as with the
+        joins of select(rel__field=...): an unqualified ``select("id=?")``
+        fails with "ambiguous column name: id"."""
+        newset = self.__class__(self)
+        tbl = self.cls._meta.table_name
+        for name in names:
+            fld = self.cls.__dict__.get(name)
+            if not isinstance(fld, ManyToOne):
+                raise ValueError("'%s' is not a ManyToOne relation of %s." % (name, self.cls.__name__))
+            h = {"reftbl": fld.ref._meta.table_name, "as": "%s.related.%s" % (tbl, name),
+                 "clstbl": tbl, "clskey": fld.fkey, "refkey": fld.ref_key}
+            newset.clauses["joins"].append(
+                'LEFT JOIN "%(reftbl)s" AS "%(as)s" ON "%(clstbl)s"."%(clskey)s" = "%(as)s"."%(refkey)s"' % h)
+            newset.clauses["select_fields"] += "".join(
+                [', "%s"."%s" AS "%s__%s"' % (h["as"], f.name, name, f.name) for f in fld.ref._meta.fields])
+            newset.clauses.setdefault("related", []).append(name)
+        return newset
+
+    def prefetch_related(self, *names):
+        """Loading the members of the reverse (one-to-many) relations `names`
+        of every selected object with one IN query per relation, instead of a
+        query per object. The query is then read at once."""
+        newset = self.__class__(self)
+        for name in names:
+            if not isinstance(self.cls.__dict__.get(name), _ManyToOne_Rev):
+                raise ValueError("'%s' is not a reverse relation of %s." % (name, self.cls.__name__))
+            newset.clauses.setdefault("prefetch", []).append(name)
+        return newset
 
     def distinct(self):
         newset = self.__class__(self)
@@ -1037,6 +1297,28 @@ class QuerySet(object):
         objs = self._cache + [obj for obj in self]
         return str(objs)
 
+class PreparedQuery(object):
+    """Query whose SQL is generated once, calls only bind the parameters
+    (see :meth:`Model.prepared`). Hot lookups skip the QuerySet cloning and
+    SQL generation, and sqlite3 reuses the compiled statement."""
+    def __init__(self, query_set):
+        self.cls = query_set.cls
+        self.sql = query_set.sql
+        self.factory = query_set._load
+
+    def __call__(self, *params):
+        """Returns the list of objects"""
+        cur = self.cls._meta._conn.cursor().execute(self.sql, params)
+        return [self.factory(cur, row) for row in cur.fetchall()]
+
+    def get(self, *params):
+        """Returns the single object, raises DoesNotExist or MultipleObjectsReturned"""
+        cur = self.cls._meta._conn.cursor().execute(self.sql, params)
+        rows = cur.fetchmany(2)
+        if not rows: raise self.cls.DoesNotExist("%s object is not found." % self.cls.__name__)
+        if len(rows) > 1: raise MultipleObjectsReturned("The 'get()' requires single result.")
+        return self.factory(cur, rows[0])
+
 class ManyToOneRevSet(QuerySet):
     """Reverse relationship of ManyToOne"""
     def __init__(self, parent_query, parent_object=None, rel=None):
@@ -1045,12 +1327,35 @@ class ManyToOneRevSet(QuerySet):
             self.parent = parent_object
             self.parent_key = rel.ref_key
             self.cls_fkey = rel.rev_fkey
+            self.rel = rel
+
+    _prefetched = None  # members loaded by QuerySet.prefetch_related
+
+    def __iter__(self):
+        if self._prefetched is not None: return iter(self._prefetched)
+        return super(ManyToOneRevSet, self).__iter__()
+
+    def _forget_prefetched(self):
+        self._prefetched = None
+        self.parent.__dict__.get("_prefetched", {}).pop(self.rel, None)
 
     def append(self, *args, **kw):
         """Append a new member"""
+        self._forget_prefetched()
         kw[self.cls_fkey] = getattr(self.parent, self.parent_key)
         return self.cls.create(*args, **kw)
 
+    def extend(self, objs, **kw):
+        """Append many new members at once, see Model.bulk_create()"""
+        self._forget_prefetched()
+        key = getattr(self.parent, self.parent_key)
+        def members():
+            for obj in objs:
+                if isinstance(obj, dict): obj = dict(obj, **{self.cls_fkey: key})
+                else: setattr(obj, self.cls_fkey, key)
+                yield obj
+        return self.cls.bulk_create(members(), **kw)
+
 class ManyToManySet(QuerySet):
     def __init__(self, parent_query, parent_object=None, ref=None, lnk=None):
         super(ManyToManySet, self).__init__(parent_query)
@@ -1205,6 +1510,15 @@ class Model(HasModelMeta):
     @classmethod
     def select(cls, *args, **kw): return QuerySet(cls).select(*args, **kw)
 
+    @classmethod
+    def prepared(cls, *args):
+        """Returns the :class:`PreparedQuery` of ``select(*args)``, created once
+        per model and condition, e.g. ``Config.prepared("key=?").get(key)``"""
+        key = (cls, args)
+        query = _prepared.get(key)
+        if query is None: query = _prepared[key] = cls.select(*args).prepared()
+        return query
+
     @classmethod
     def create(cls, **kw):
         """Creating new record"""
@@ -1224,6 +1538,55 @@ class Model(HasModelMeta):
         obj.after_create()
         return obj
 
+    @classmethod
+    def bulk_create(cls, objs, batch_size=500, returning=False):
+        """Creating many records, given as dicts or unsaved objects.
+
+        Rows are inserted with ``executemany`` in batches of ``batch_size``
+        within the current transaction and are not read back, so
+        ``after_create()`` is not called and database defaults are not set on
+        the objects. With ``returning`` the primary keys are set on the objects
+        and returned (one INSERT per row, still no SELECT); otherwise the
+        number of inserted rows is returned.
+        """
+        pkname = cls._meta.primary_key.name
+        statements = {}
+        for with_pk in (True, False):
+            names = [fld.name for fld in cls._meta.fields if with_pk or not fld.is_primary_key]
+            holder = ", ".join(["?"] * len(names))
+            sql = 'INSERT INTO "%s" ("%s") VALUES (%s)' % (cls._meta.table_name, '", "'.join(names), holder)
+            statements[with_pk] = (names, sql)
+        pks, count = [], 0
+        objs = iter(objs)
+        while True:
+            batch = []
+            for obj in objs:
+                if isinstance(obj, dict): obj = cls(**obj)
+                Model._before_before_store(obj, "set", AtCreate)            # set value
+                obj.before_create()
+                obj.validate()
+                Model._before_before_store(obj, "to_database", Field)   # convert object to database
+                batch.append(obj)
+                if len(batch) >= batch_size: break
+            if not batch: break
+            cur = cls._meta._conn.cursor()
+            if returning:
+                for obj in batch:
+                    with_pk = bool(getattr(obj, pkname))
+                    names, sql = statements[with_pk]
+                    cur.execute(sql, [getattr(obj, n) for n in names])
+                    if not with_pk: setattr(obj, pkname, cur.lastrowid)
+                    obj._orig_pk = obj.pk
+                    pks.append(obj.pk)
+                continue
+            # rows with and without an explicit primary key need separate statements
+            for with_pk, (names, sql) in statements.items():
+                rows = [[getattr(obj, n) for n in names] for obj in batch
+                        if bool(getattr(obj, pkname)) == with_pk]
+                if rows: cur.executemany(sql, rows)
+                count += len(rows)
+        return pks if returning else count
+
     def save(self):
         """Updating the record"""
         cls = self.__class__
@@ -1249,6 +1612,9 @@ class Model(HasModelMeta):
         else: current_id = obj.pk
         newobj = cls.get(current_id)
         for fld in cls._meta.fields: setattr(obj, fld.name, getattr(newobj, fld.name))
+        if obj._orig_pk is not None and obj._orig_pk != obj.pk: _identity_forget(cls, obj._orig_pk)
+        objs = getattr(_identity, "map", None)
+        if objs is not None and (cls, obj.pk) in objs: objs[cls, obj.pk] = obj   # the saved object is the fresh one
         obj._orig_pk = obj.pk
 
     def delete(self):
@@ -1256,6 +1622,7 @@ class Model(HasModelMeta):
         cls = self.__class__
         sql = 'DELETE FROM "%s" WHERE "%s" = ?' % (cls._meta.table_name, cls._meta.primary_key.name)
         cls._meta._conn.cursor().execute(sql, [self.pk])
+        _identity_forget(cls, self.pk)
 
     @staticmethod
     def _before_before_store(obj, meth_name, at_cls):
@@ -1339,13 +1706,16 @@ class MacaronPlugin(object):
     name = "macaron"
     api = 2
 
-    def __init__(self, dbfile=":memory:", commit_on_success=True):
+    def __init__(self, dbfile=":memory:", commit_on_success=True, local=False, cached_statements=128, timeout=5.0):
         self.dbfile = dbfile
         self.commit_on_success = commit_on_success
+        self.local = local  # one connection per thread, for multi-threaded servers
+        self.cached_statements = cached_statements
+        self.timeout = timeout  # busy timeout of the connections
 
     def setup(self, app):
         # 'macaronage' when MacaronPlugin is installed
-        macaronage(self.dbfile, lazy=True, autocommit=False)
+        macaronage(self.dbfile, lazy=True, autocommit=False, local=self.local, cached_statements=self.cached_statements, timeout=self.timeout)
 
     def apply(self, callback, ctx):
         conf = ctx.config.get("macaron") or {}
@@ -1356,7 +1726,8 @@ class MacaronPlugin(object):
         def wrapper(*args, **kwargs):
 #           macaronage(dbfile, lazy=True, autocommit=False, keep=True)
             try:
-                ret_value = callback(*args, **kwargs)
+                with identity_map():
+                    ret_value = callback(*args, **kwargs)
                 if self.commit_on_success: bake()   # commit
             except sqlite3.IntegrityError as e:
                 rollback()
@@ -0,0 +1,225 @@
+"""
+Metrics registry exposed in the Prometheus text format.
+
+Counters and histograms are sharded per thread: each thread only ever updates
+its own dict, so the hot path takes no lock, and a scrape sums the shards.
+When a thread ends its shard is folded into the metric's totals and dropped.
+Values are per process, with WORKERS > 1 a scrape sees the worker serving it.
+"""
+import time
+import bisect
+import weakref
+import threading
+import contextlib
+
+import bottle
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Owner:
+    """Lives in a thread's local storage only, so it is freed when the thread ends"""
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._ended = {}  # sum of the shards of threads that ended
+        self._lock = threading.RLock()  # _retire() may run in a thread already holding it
+        REGISTRY.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            self._local.owner = _Owner()
+            weakref.finalize(self._local.owner, self._retire, shard)
+            with self._lock:  # once per thread
+                self._shards.append(shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            for i, other in enumerate(self._shards):
+                if other is shard:
+                    del self._shards[i]
+                    break
+            for key, value in shard.items():
+                self._ended[key] = self._add(self._ended.get(key), value)
+
+    @staticmethod
+    def _add(total, value):
+        return value if total is None else total + value
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def _collect(self):
+        """label values -> value, summed over all shards"""
+        with self._lock:
+            shards = [dict(self._ended)] + self._shards
+        totals = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                totals[key] = self._add(totals.get(key), value)
+        return totals
+
+    def samples(self):
+        for key, value in sorted(self._collect().items()):
+            yield self.name, _labels(self.labels, key), value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Either updated with inc/dec or read from ``callback`` (returning a number,
+    or a dict of label values tuple -> number) at scrape time"""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _collect(self):
+        if self.callback is None:
+            return super()._collect()
+        value = self.callback()
+        return value if isinstance(value, dict) else {(): value}
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        try:
+            counts = shard[key]
+        except KeyError:
+            counts = shard[key] = [0] * (len(self.buckets) + 3)  # buckets, +Inf, sum, count
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _add(total, counts):
+        counts = list(counts)  # a live shard's counts change under our feet
+        return counts if total is None else [a + b for a, b in zip(total, counts)]
+
+    def samples(self):
+        for key, counts in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', _labels(self.labels, key, f'le="{_number(bound)}"'), cumulative
+            yield f'{self.name}_sum', _labels(self.labels, key), counts[-2]
+            yield f'{self.name}_count', _labels(self.labels, key), counts[-1]
+
+
+def expose():
+    return '\n'.join(metric.expose() for metric in REGISTRY) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'jinn_request_duration_seconds', 'Time spent serving a request', ('method', 'route', 'status')
+)
+REQUESTS_IN_PROGRESS = Gauge('jinn_requests_in_progress', 'Requests being served')
+OPENAI_SECONDS = Histogram('jinn_openai_duration_seconds', 'OpenAI API call latency', ('call',))
+OPENAI_ERRORS = Counter('jinn_openai_errors_total', 'Failed OpenAI API calls', ('call',))
+INCANTATION_SECONDS = Histogram(
+    'jinn_incantation_duration_seconds', 'Incantation execution time', ('name',)
+)
+CACHE = Counter('jinn_cache_requests_total', 'Cache lookups', ('cache', 'result'))
+MISHAPS = Counter('jinn_mishaps_total', 'Mishaps recorded')
+SESSIONS = Gauge('jinn_sessions', 'Live sessions', callback=lambda: 0)
+THREADS = Gauge('jinn_threads', 'Live threads', callback=threading.active_count)
+
+
+class MetricsPlugin:
+    """Times every request, install it first so it wraps every other plugin"""
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, skip=('/metrics',)):
+        self.skip = skip
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            if bottle.request.path.startswith(self.skip):
+                return callback(*args, **kwargs)
+            status = 500
+            start = time.perf_counter()
+            REQUESTS_IN_PROGRESS.inc()
+            try:
+                ret = callback(*args, **kwargs)
+                status = bottle.response.status_code
+                return ret
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                REQUESTS_IN_PROGRESS.dec()
+                REQUEST_SECONDS.observe(
+                    time.perf_counter() - start,
+                    method=bottle.request.method, route=route.rule, status=status
+                )
+        return wrapper
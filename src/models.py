@@ -1,4 +1,6 @@
+import re
 import json
+import time
 import inspect
 import sqlite3
 import string
@@ -7,9 +9,182 @@ import hashlib
 import traceback
 
 import macaron
+import tracing
+import metrics
 from config import DB_PATH
-from services import craft_incantation, describe_function, wish, fix, adjust, stt, tts
-from utils import define_function, ReplaceVariables
+from services import craft_incantation, craft_combined, describe_function, wish, fix, adjust, stt, tts, CallResults
+from utils import define_function, function_parameters, ReplaceVariables
+
+
+def commit():
+    """Ends the request's write transaction early. Requests share one database
+    and hold its write lock from their first write until they end, so commit
+    before an OpenAI round trip or a run of user code, which take seconds."""
+    macaron.bake()
+
+
+def code_hash(code):
+    return hashlib.sha256((code or '').encode('utf-8')).hexdigest()
+
+
+def _add_code_hash(conn):
+    conn.execute('ALTER TABLE incantation ADD COLUMN code_hash TEXT')
+    rows = conn.execute('SELECT id, code FROM incantation').fetchall()
+    conn.executemany(
+        'UPDATE incantation SET code_hash = ? WHERE id = ?', [(code_hash(code), id) for id, code in rows]
+    )
+
+
+def schema_description(schema):
+    try:
+        return json.loads(schema)['function']['description']
+    except (TypeError, ValueError, KeyError):
+        return ''
+
+
+def _add_description(conn):
+    conn.execute('ALTER TABLE incantation ADD COLUMN description TEXT')
+    rows = conn.execute('SELECT id, schema FROM incantation').fetchall()
+    conn.executemany(
+        'UPDATE incantation SET description = ? WHERE id = ?',
+        [(schema_description(schema), id) for id, schema in rows]
+    )
+
+
+def _add_parameter_names(conn):
+    conn.execute('ALTER TABLE incantation ADD COLUMN parameter_names TEXT')
+    rows = conn.execute('SELECT id, code FROM incantation').fetchall()
+    conn.executemany(
+        'UPDATE incantation SET parameter_names = ? WHERE id = ?',
+        [(json.dumps(function_parameters(code)), id) for id, code in rows]
+    )
+
+
+MISHAP_SAMPLES = 10  # request payloads kept per mishap
+
+
+_FRAME = re.compile(r'^  File "(.*)", line (\d+).*', re.M)
+# addresses, uuids and numbers long enough to be ids or timestamps
+_IDS = re.compile(r'0x[0-9a-fA-F]+|\b[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\b|\b\d{6,}\b')
+
+
+def mishap_fingerprint(incantation_id, code, traceback):
+    """Same incantation, same code and the same exception, type and message, raised
+    at the same file:line of the innermost frame: the same mishap. Only addresses
+    and ids are masked in the message; the frames calling into it are left out."""
+    traceback = traceback or ''
+    where, exception = '', traceback
+    if frames := list(_FRAME.finditer(traceback)):
+        where = '{}:{}'.format(*frames[-1].groups())
+        # what follows the innermost frame's source lines
+        rest = traceback[frames[-1].end():].splitlines()
+        exception = '\n'.join(line for line in rest if line and not line[0].isspace())
+    exception = _IDS.sub('?', exception)
+    return hashlib.sha256(f'{incantation_id}\0{code_hash(code)}\0{where}\0{exception}'.encode('utf-8')).hexdigest()
+
+
+def _group_mishaps(conn):
+    for column in (
+        'fingerprint TEXT', 'occurrences INTEGER DEFAULT 1', 'first_seen INTEGER', 'last_seen INTEGER',
+        'samples TEXT',
+    ):
+        conn.execute(f'ALTER TABLE mishap ADD COLUMN {column}')
+    groups = {}
+    rows = conn.execute('SELECT id, incantation_id, request, code, traceback FROM mishap ORDER BY id')
+    for id, incantation_id, request, code, traceback in rows:
+        groups.setdefault(mishap_fingerprint(incantation_id, code, traceback), []).append((id, request))
+    for fingerprint, rows in groups.items():
+        conn.execute(
+            'UPDATE mishap SET fingerprint = ?, occurrences = ?, request = ?, samples = ? WHERE id = ?', [
+                fingerprint, len(rows), rows[-1][1],
+                json.dumps([request for _, request in rows[-MISHAP_SAMPLES:]]), rows[0][0],
+            ]
+        )
+        conn.executemany('DELETE FROM mishap WHERE id = ?', [(id,) for id, _ in rows[1:]])
+
+
+def _add_code_blobs(conn):
+    conn.execute('INSERT OR IGNORE INTO code_blob (hash, code) SELECT code_hash, code FROM incantation')
+    conn.execute(
+        'INSERT INTO incantation_version (incantation_id, version, code_hash, schema)'
+        ' SELECT id, 1, code_hash, schema FROM incantation'
+    )
+    conn.execute('ALTER TABLE mishap ADD COLUMN code_hash TEXT')
+    rows = conn.execute('SELECT id, code FROM mishap WHERE code IS NOT NULL').fetchall()
+    conn.executemany(
+        'INSERT OR IGNORE INTO code_blob (hash, code) VALUES (?, ?)', [(code_hash(code), code) for _, code in rows]
+    )
+    conn.executemany(
+        'UPDATE mishap SET code_hash = ?, code = NULL WHERE id = ?', [(code_hash(code), id) for id, code in rows]
+    )
+
+
+MIGRATIONS = (
+    (1, (
+        'CREATE INDEX IF NOT EXISTS incantation_master_id ON incantation(master_id)',
+        'CREATE INDEX IF NOT EXISTS mishap_incantation_id ON mishap(incantation_id)',
+        'CREATE INDEX IF NOT EXISTS mishap_traceback_code ON mishap(traceback, code)',
+        'CREATE INDEX IF NOT EXISTS master_token ON master(token)',
+    )),
+    (2, (
+        'CREATE INDEX IF NOT EXISTS pipeline_master_id ON pipeline(master_id)',
+        'CREATE INDEX IF NOT EXISTS pipeline_step_pipeline_id ON pipeline_step(pipeline_id, position)',
+    )),
+    (3, (
+        _add_code_hash,
+        'CREATE INDEX IF NOT EXISTS incantation_master_code_hash ON incantation(master_id, code_hash)',
+    )),
+    (4, (
+        _add_description,
+        'DROP INDEX IF EXISTS incantation_master_id',
+        'CREATE INDEX IF NOT EXISTS incantation_master_id_id ON incantation(master_id, id)',
+    )),
+    (5, (
+        # external content table: the text stays in incantation, triggers keep the index in sync
+        """CREATE VIRTUAL TABLE IF NOT EXISTS incantation_fts USING fts5(
+            name, description, request, code, content='incantation', content_rowid='id'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS incantation_fts_insert AFTER INSERT ON incantation BEGIN
+            INSERT INTO incantation_fts(rowid, name, description, request, code)
+            VALUES (new.id, new.name, new.description, new.request, new.code);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS incantation_fts_delete AFTER DELETE ON incantation BEGIN
+            INSERT INTO incantation_fts(incantation_fts, rowid, name, description, request, code)
+            VALUES ('delete', old.id, old.name, old.description, old.request, old.code);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS incantation_fts_update
+        AFTER UPDATE OF name, description, request, code ON incantation BEGIN
+            INSERT INTO incantation_fts(incantation_fts, rowid, name, description, request, code)
+            VALUES ('delete', old.id, old.name, old.description, old.request, old.code);
+            INSERT INTO incantation_fts(rowid, name, description, request, code)
+            VALUES (new.id, new.name, new.description, new.request, new.code);
+        END""",
+        "INSERT INTO incantation_fts(incantation_fts) VALUES ('rebuild')",
+    )),
+    (6, (
+        _add_parameter_names,
+    )),
+    (7, (
+        _group_mishaps,
+        'DROP INDEX IF EXISTS mishap_traceback_code',
+        'CREATE UNIQUE INDEX IF NOT EXISTS mishap_fingerprint ON mishap(fingerprint)',
+    )),
+    (8, (
+        _add_code_blobs,
+    )),
+)
+
+# snippet() markers around matched terms, replaced by <mark> once the snippet is escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def fts_query(text):
+    """User input as an FTS5 query: every word quoted (no operators), all required,
+    the last one as a prefix"""
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
 
 
 class BaseModel:
@@ -29,11 +204,39 @@ class BaseModel:
         with sqlite3.connect(DB_PATH) as conn:
             conn.execute(cls._DDL_SQL)
 
+    @classmethod
+    def migrate(cls, migrations=MIGRATIONS):
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        try:
+            # readers don't block the writer, needed once requests run in parallel
+            conn.execute('PRAGMA journal_mode = WAL')
+            for version, steps in migrations:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                        conn.execute('ROLLBACK')
+                        continue
+                    for step in steps:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute(f'PRAGMA user_version = {int(version)}')
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            conn.close()
+
     @classmethod
     def create_tables(cls):
         for table in cls.__tables:
             table._create_table()
+        cls.migrate()
+        for table in cls.__tables:
             table._after_create()
+        macaron.bake()
 
 
 class Master(macaron.Model, BaseModel):
@@ -82,21 +285,229 @@ class Master(macaron.Model, BaseModel):
         except Incantation.DoesNotExist:
             pass
 
+    def incantations_page(self, after=0, limit=50):
+        """One page of {id, name, description} after the incantation id `after`, and
+        the id to pass as `after` for the next page (None on the last one). Keyset
+        paginated on the (master_id, id) index, so every page costs the same."""
+        rows = macaron.execute(
+            'SELECT id, name, description FROM incantation WHERE master_id = ? AND id > ?'
+            ' ORDER BY id LIMIT ?', [self.id, int(after or 0), limit + 1]
+        ).fetchall()
+        page = [dict(zip(('id', 'name', 'description'), row)) for row in rows[:limit]]
+        return page, page[-1]['id'] if len(rows) > limit else None
+
+    def search_incantations(self, text, limit=50):
+        """[{id, name, description, snippet}] matching `text`, best first. Matches in
+        the name weigh most, then description, request and code. The snippet has
+        MATCH_START/MATCH_END around the matched terms."""
+        query = fts_query(text)
+        if not query:
+            return []
+        rows = macaron.execute(
+            'SELECT incantation.id, incantation.name, incantation.description,'
+            '       snippet(incantation_fts, -1, ?, ?, ?, 16)'
+            ' FROM incantation_fts JOIN incantation ON incantation.id = incantation_fts.rowid'
+            ' WHERE incantation_fts MATCH ? AND incantation.master_id = ?'
+            ' ORDER BY bm25(incantation_fts, 10.0, 5.0, 2.0, 1.0) LIMIT ?',
+            [MATCH_START, MATCH_END, '...', query, self.id, limit]
+        ).fetchall()
+        return [dict(zip(('id', 'name', 'description', 'snippet'), row)) for row in rows]
+
+    def pipeline(self, id):
+        try:
+            return Pipeline.get("master_id=? AND id=?", [self.id, id])
+        except Pipeline.DoesNotExist:
+            pass
+
+    def create_pipeline(self, name, steps):
+        """``steps``: [{'incantation': id, 'mapping': {...}}, ...], raises ValueError
+        when a step is not this master's incantation or maps an unknown reference"""
+        if not steps:
+            raise ValueError('A pipeline needs at least one step')
+        for position, step in enumerate(steps, 1):
+            if self.incantation(step['incantation']) is None:
+                raise ValueError(f'Step {position}: no incantation {step["incantation"]}')
+            for value in (step.get('mapping') or {}).values():
+                PipelineStep.check_reference(value, position)
+        pipeline = self.pipelines.append(name=name)
+        pipeline.steps.extend(
+            {
+                'incantation_id': int(step['incantation']),
+                'position': position,
+                'mapping': json.dumps(step.get('mapping') or {}),
+            }
+            for position, step in enumerate(steps, 1)
+        )
+        return pipeline
+
+    def delete_pipeline(self, id):
+        pipeline = self.pipeline(id)
+        if pipeline is not None:
+            pipeline.steps.delete()
+            pipeline.delete()
+        return pipeline
+
+    def run_pipeline(self, data):
+        pipeline = self.pipeline(data['pipeline'])
+        if pipeline is None:
+            return {'result': f'Error: unknown pipeline {data["pipeline"]}'}
+        return pipeline.execute(data)
+
     def mishap(self, id):
         try:
-            ret = Mishap.get("id=?", [id])
-            if self.incantation(ret.incantation_id) is None:
+            ret = Mishap.select('mishap.id=?', [id]).select_related('incantation').get()
+            if ret.incantation is None or ret.incantation.master_id != self.id:
                 return None
             return ret
         except Mishap.DoesNotExist:
             pass
 
+    def export_incantations(self):
+        """Yields the master's incantations with their mishaps, oldest first. Reads
+        from one snapshot on its own connection, so it can be streamed lazily and
+        never holds more than one incantation in memory."""
+        conn = sqlite3.connect(DB_PATH, isolation_level=None)
+        try:
+            conn.execute('BEGIN')
+            incantations = conn.execute(
+                'SELECT id, name, request, code, schema, overrides FROM incantation'
+                ' WHERE master_id = ? ORDER BY id', [self.id]
+            )
+            mishaps = conn.execute(
+                'SELECT mishap.incantation_id, mishap.request, code_blob.code, mishap.traceback,'
+                '       mishap.occurrences, mishap.first_seen, mishap.last_seen, mishap.samples FROM mishap'
+                ' JOIN incantation ON incantation.id = mishap.incantation_id'
+                ' LEFT JOIN code_blob ON code_blob.hash = mishap.code_hash'
+                ' WHERE incantation.master_id = ? ORDER BY mishap.incantation_id, mishap.id', [self.id]
+            )
+            mishap = mishaps.fetchone()
+            for id, name, request, code, schema, overrides in incantations:
+                entry = {
+                    'name': name, 'request': request, 'code': code, 'schema': schema,
+                    'overrides': overrides, 'mishaps': [],
+                }
+                while mishap is not None and mishap[0] <= id:
+                    if mishap[0] == id:
+                        entry['mishaps'].append(dict(
+                            zip(('request', 'code', 'traceback', 'occurrences', 'first_seen', 'last_seen'), mishap[1:]),
+                            samples=json.loads(mishap[-1] or '[]')
+                        ))
+                    mishap = mishaps.fetchone()
+                yield entry
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def import_incantations(self, lines, batch_size=500):
+        """Imports NDJSON lines as written by export_incantations, skipping code the
+        master already has. Batches are inserted with executemany in the request's
+        transaction, raises ValueError on a malformed line (the caller rolls back)."""
+        imported = skipped = mishaps = 0
+        batch = []
+
+        def flush():
+            nonlocal imported, skipped, mishaps
+            hashes = list({entry['code_hash'] for entry in batch})
+            known = {
+                row[0] for row in macaron.execute(
+                    f'SELECT code_hash FROM incantation WHERE master_id = ?'
+                    f' AND code_hash IN ({", ".join("?" * len(hashes))})', [self.id] + hashes
+                )
+            }
+            fresh = {}
+            for entry in batch:
+                if entry['code_hash'] in known or entry['code_hash'] in fresh:
+                    skipped += 1
+                else:
+                    fresh[entry['code_hash']] = entry
+            if fresh:
+                macaron.executemany(
+                    'INSERT INTO incantation (master_id, name, request, code, schema, overrides,'
+                    ' code_hash, description, parameter_names) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (
+                            self.id, e['name'], e['request'], e['code'], e['schema'], e['overrides'], h,
+                            schema_description(e['schema']), json.dumps(function_parameters(e['code']))
+                        )
+                        for h, e in fresh.items()
+                    ]
+                )
+                ids = macaron.execute(
+                    f'SELECT code_hash, id FROM incantation WHERE master_id = ?'
+                    f' AND code_hash IN ({", ".join("?" * len(fresh))})', [self.id] + list(fresh)
+                ).fetchall()
+                rows = [
+                    (id, request, code, tb, mishap_fingerprint(id, code, tb), *rest)
+                    for h, id in ids for request, code, tb, *rest in fresh[h]['mishaps']
+                ]
+                # before the versions and mishaps, their code_hash references code_blob
+                macaron.executemany(
+                    'INSERT OR IGNORE INTO code_blob (hash, code) VALUES (?, ?)',
+                    [(h, e['code']) for h, e in fresh.items()]
+                    + [(code_hash(code), code) for _, _, code, *_ in rows if code is not None]
+                )
+                now = int(time.time())
+                macaron.executemany(
+                    'INSERT INTO incantation_version (incantation_id, version, code_hash, schema, created)'
+                    ' VALUES (?, 1, ?, ?, ?)', [(id, h, fresh[h]['schema'], now) for h, id in ids]
+                )
+                macaron.executemany(
+                    Mishap.UPSERT_SQL, [
+                        (id, request, code_hash(code) if code is not None else None, *rest)
+                        for id, request, code, *rest in rows
+                    ]
+                )
+                imported += len(fresh)
+                mishaps += len(rows)
+            batch.clear()
+
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                schema = entry['schema']
+                if not isinstance(schema, str):
+                    schema = json.dumps(schema)
+                overrides = entry.get('overrides') or '{}'
+                if not isinstance(overrides, str):
+                    overrides = json.dumps(overrides)
+                batch.append({
+                    'name': entry.get('name') or json.loads(schema)['function']['name'],
+                    'request': entry.get('request') or '',
+                    'code': entry['code'],
+                    'code_hash': code_hash(entry['code']),
+                    'schema': schema,
+                    'overrides': overrides,
+                    'mishaps': [
+                        (
+                            m.get('request'), m.get('code'), m.get('traceback'), int(m.get('occurrences') or 1),
+                            m.get('first_seen'), m.get('last_seen'),
+                            json.dumps(list(m.get('samples') or [m.get('request')])[-MISHAP_SAMPLES:]),
+                        )
+                        for m in entry.get('mishaps') or ()
+                    ],
+                })
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise ValueError(f'Line {number}: {type(e).__name__}: {e}') from e
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return {'imported': imported, 'skipped': skipped, 'mishaps': mishaps}
+
     def craft_incantation(self, text):
-        name, code = craft_incantation(
+        if Config.check('combined_craft'):
+            incantation, _ = self.craft_combined(text)
+            return incantation
+        result = craft_incantation(
             Config.get_value('openai_key'), Config.get_value('openai_model'),
-            Config.get_value('craft_retries', 3), text
+            Config.get_value('craft_retries', 3), text, Config.get_value('craft_candidates', 1)
         )
-        return self.incantations.append(
+        if isinstance(result, Exception):
+            return result
+        name, code = result
+        incantation = self.incantations.append(
             request=text,
             name=name,
             code=code,
@@ -105,6 +516,25 @@ class Master(macaron.Model, BaseModel):
             ),
             overrides='{}'
         )
+        commit()  # wishing with it next asks the model again
+        return incantation
+
+    def craft_combined(self, text, wish=None):
+        """Crafts an incantation along with its schema and the arguments fulfilling `wish`
+        in a single completion, returns the incantation (or error) and the arguments"""
+        result = craft_combined(
+            Config.get_value('openai_key'), Config.get_value('openai_model'),
+            Config.get_value('craft_retries', 3), text, wish,
+            Config.get_value('craft_candidates', 1), Config.check('craft_smoke_check')
+        )
+        if isinstance(result, Exception):
+            return result, None
+        name, code, schema, args = result
+        incantation = self.incantations.append(
+            request=text, name=name, code=code, schema=schema, overrides='{}'
+        )
+        commit()  # it is run or wished with next
+        return incantation, args
 
     def _wish(self, text, allow_craft=False, call=True):
         incantations = {
@@ -116,15 +546,37 @@ class Master(macaron.Model, BaseModel):
             }
             for incantation in self.incantations
         }
-        return wish(
+        ret = wish(
             Config.get_value('openai_key'), Config.get_value('openai_model'), text,
             incantations, allow_craft=allow_craft, call=call
         )
+        if isinstance(ret, CallResults):
+            return self.combine(ret)
+        return ret
+
+    def combine(self, results):
+        """One answer for the results of several incantations run for a wish,
+        each failure is recorded as a mishap of its incantation"""
+        lines = []
+        for incantation, args, result in results:
+            if isinstance(result, Exception):
+                Mishap.record(incantation, args, result)
+                result = f'Error: {result}'
+            lines.append(f'{incantation.name}: {result}')
+        return '\n'.join(lines)
 
     def wish(self, text, voice=False):
         if voice:
             text = stt(Config.get_value('openai_key'), text)
         match ret := self._wish(text, allow_craft=True):
+            case 'craft_incantation', tool_text if Config.check('combined_craft'):
+                incantation, args = self.craft_combined(json.loads(tool_text)['text'], text)
+                if isinstance(incantation, Exception):
+                    return f'Error: {incantation}'
+                try:
+                    return incantation.execute({'args': args})['result']
+                except Exception as e:
+                    return incantation, args, e
             case 'craft_incantation', tool_text:
                 self.craft_incantation(tool_text)
                 return self._wish(text, allow_craft=False)
@@ -142,11 +594,12 @@ class Master(macaron.Model, BaseModel):
     def prepare(self, text):
         match ret := self._wish(text, allow_craft=True, call=False):
             case 'craft_incantation', tool_text:
-                text = f'craft_incantation("{json.loads(tool_text)["text"]}")'
+                request, text = text, f'craft_incantation("{json.loads(tool_text)["text"]}")'
                 return {
                     'craft_incantation': json.loads(tool_text)['text'],
                     'wish': text,
                     'text': text,
+                    'request': request,
                 }
             case incantation, args:
                 return {
@@ -156,6 +609,11 @@ class Master(macaron.Model, BaseModel):
                 }
 
     def craft_and_prepare(self, data):
+        if Config.check('combined_craft'):
+            incantation, args = self.craft_combined(data['craft_incantation'], data.get('request', data['wish']))
+            if isinstance(incantation, Exception):
+                raise incantation
+            return {'incantation': incantation.id, 'args': args, 'text': f'{incantation.name}({args})'}
         self.craft_incantation(data['craft_incantation'])
         incantation, args = self._wish(data['wish'], allow_craft=False, call=False)
         text = f'{incantation["object"].name}{", ".join(args)}'
@@ -168,6 +626,8 @@ class Master(macaron.Model, BaseModel):
     def proceed(self, data):
         if 'result' in data:
             return data
+        if 'pipeline' in data:
+            return self.run_pipeline(data)
         if 'craft_incantation' in data:
             return self.craft_and_prepare(data)
         elif 'incantation' in data:
@@ -183,6 +643,9 @@ class Incantation(macaron.Model, BaseModel):
     code = macaron.CharField()
     schema = macaron.CharField()
     overrides = macaron.CharField()
+    code_hash = macaron.CharField(null=True)  # added by migration 3, see before_save
+    description = macaron.CharField(null=True)  # added by migration 4, see before_save
+    parameter_names = macaron.CharField(null=True)  # added by migration 6, see before_save
 
     _DDL_SQL = """
         CREATE TABLE IF NOT EXISTS incantation (
@@ -198,10 +661,65 @@ class Incantation(macaron.Model, BaseModel):
         )
     """
 
+    def before_create(self):
+        self.before_save()
+
+    def before_save(self):
+        self.code_hash = code_hash(self.code)
+        self.description = schema_description(self.schema)
+        self.parameter_names = json.dumps(function_parameters(self.code))
+
+    def after_create(self):
+        self.after_save()
+
+    def after_save(self):
+        """Stores the code in code_blob and, when the code or the schema changed,
+        appends a version pointing at it"""
+        CodeBlob.store(self.code_hash, self.code)
+        latest = IncantationVersion.latest(self.id)
+        if latest is None or (latest.code_hash, latest.schema) != (self.code_hash, self.schema):
+            IncantationVersion.create(
+                incantation_id=self.id, version=latest.version + 1 if latest else 1,
+                code_hash=self.code_hash, schema=self.schema, created=int(time.time()),
+            )
+
+    @property
+    def versions(self):
+        return IncantationVersion.select('incantation_id=?', [self.id]).order_by('-version')
+
+    @property
+    def pipelines(self):
+        """Pipelines with a step running this incantation"""
+        return Pipeline.select(
+            'id IN (SELECT pipeline_id FROM pipeline_step WHERE incantation_id=?)', [self.id]
+        ).order_by('name')
+
+    def rollback(self, version):
+        """Makes `version` current again, recorded as a new version. The code is
+        looked up by hash, nothing is regenerated. Nothing changes when `version`
+        is what the incantation runs already."""
+        try:
+            old = IncantationVersion.get('incantation_id=? AND version=?', [self.id, int(version)])
+        except IncantationVersion.DoesNotExist:
+            return None
+        if (old.code_hash, old.schema) == (self.code_hash, self.schema):
+            return self
+        self.code, self.schema = CodeBlob.load(old.code_hash), old.schema
+        self.save()
+        return self
+
     @property
     def parameters(self):
-        _, func = define_function(self.code)
-        return inspect.getfullargspec(func).args
+        return json.loads(self.parameter_names or '[]')
+
+    def mishaps_page(self, after=0, limit=20):
+        """One page of mishaps, newest first, after the mishap id `after` (0 for the
+        first page), and the id to pass as `after` for the next one (None on the last)"""
+        query = Mishap.select('incantation_id=?', [self.id])
+        if after:
+            query = Mishap.select('incantation_id=? AND id<?', [self.id, int(after)])
+        mishaps = list(query.order_by('-id').limit(limit + 1))
+        return mishaps[:limit], mishaps[limit - 1].id if len(mishaps) > limit else None
 
     @property
     def overrides_dict(self):
@@ -226,10 +744,6 @@ class Incantation(macaron.Model, BaseModel):
         self.save()
         return self
 
-    @property
-    def description(self):
-        return json.loads(self.schema)['function']['description']
-
     def redescribe(self):
         self.schema = describe_function(
             Config.get_value('openai_key'), Config.get_value('openai_model'), self.code
@@ -237,24 +751,91 @@ class Incantation(macaron.Model, BaseModel):
         self.save()
 
     def execute(self, data):
-        _, func = define_function(self.code)
-        args = json.loads(data['args'])
-        for key, value in self.overrides_dict.items():
-            try:
-                args[key] = float(value)
-            except ValueError:
+        with tracing.span('incantation.execute', name=self.name), \
+                metrics.INCANTATION_SECONDS.time(name=self.name):
+            _, func = define_function(self.code, self.code_hash)
+            args = json.loads(data['args'])
+            for key, value in self.overrides_dict.items():
                 try:
-                    args[key] = int(value)
+                    args[key] = float(value)
                 except ValueError:
-                    args[key] = value
-        return {'result': func(**args)}
+                    try:
+                        args[key] = int(value)
+                    except ValueError:
+                        args[key] = value
+            with tracing.span('incantation.call'):
+                return {'result': func(**args)}
+
+
+class CodeBlob(macaron.Model, BaseModel):
+    """Content-addressed code: each distinct code once, keyed by its sha256
+    (code_hash()), referenced by incantation versions and mishaps"""
+    hash = macaron.CharField(primary_key=True)
+    code = macaron.CharField()
+
+    _table_name = 'code_blob'
+    _DDL_SQL = """
+        CREATE TABLE IF NOT EXISTS code_blob (
+            hash TEXT PRIMARY KEY,
+            code TEXT
+        ) WITHOUT ROWID
+    """
+
+    @classmethod
+    def store(cls, hash, code):
+        macaron.execute('INSERT OR IGNORE INTO code_blob (hash, code) VALUES (?, ?)', [hash, code])
+
+    @classmethod
+    def load(cls, hash):
+        row = macaron.execute('SELECT code FROM code_blob WHERE hash = ?', [hash]).fetchone()
+        return row[0] if row else None
+
+
+class IncantationVersion(macaron.Model, BaseModel):
+    incantation_id = macaron.IntegerField()
+    version = macaron.IntegerField()
+    code_hash = macaron.CharField()
+    schema = macaron.CharField()
+    created = macaron.IntegerField(null=True)
+
+    _table_name = 'incantation_version'
+    _DDL_SQL = """
+        CREATE TABLE IF NOT EXISTS incantation_version (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            incantation_id INTEGER,
+            version INTEGER,
+            code_hash TEXT,
+            schema TEXT,
+            created INTEGER,
+            UNIQUE (incantation_id, version),
+            FOREIGN KEY (incantation_id) REFERENCES incantation(id),
+            FOREIGN KEY (code_hash) REFERENCES code_blob(hash)
+        )
+    """
+
+    @classmethod
+    def latest(cls, incantation_id):
+        try:
+            return cls.select('incantation_id=?', [incantation_id]).order_by('-version').limit(1).get()
+        except cls.DoesNotExist:
+            return None
+
+    @property
+    def code(self):
+        return CodeBlob.load(self.code_hash)
 
 
 class Mishap(macaron.Model, BaseModel):
     incantation = macaron.ManyToOne(Incantation, fkey='incantation_id', ref_key='id', related_name='mishaps')
     request = macaron.CharField()
-    code = macaron.CharField()
     traceback = macaron.CharField()
+    code_hash = macaron.CharField(null=True)  # the code column is left empty since migration 8
+    # added by migration 7, see record()
+    fingerprint = macaron.CharField(null=True)
+    occurrences = macaron.IntegerField(null=True)
+    first_seen = macaron.IntegerField(null=True)
+    last_seen = macaron.IntegerField(null=True)
+    samples = macaron.CharField(null=True)
 
     _DDL_SQL = """
         CREATE TABLE IF NOT EXISTS mishap (
@@ -267,6 +848,55 @@ class Mishap(macaron.Model, BaseModel):
         )
     """
 
+    # a repeated mishap bumps its group: latest request, occurrences, last seen and
+    # the last MISHAP_SAMPLES requests (samples of both sides merged on import)
+    UPSERT_SQL = f"""
+        INSERT INTO mishap (
+            incantation_id, request, code_hash, traceback, fingerprint, occurrences, first_seen, last_seen, samples
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (fingerprint) DO UPDATE SET
+            request = excluded.request,
+            occurrences = mishap.occurrences + excluded.occurrences,
+            first_seen = min(
+                coalesce(mishap.first_seen, excluded.first_seen), coalesce(excluded.first_seen, mishap.first_seen)
+            ),
+            last_seen = max(
+                coalesce(mishap.last_seen, excluded.last_seen), coalesce(excluded.last_seen, mishap.last_seen)
+            ),
+            samples = (
+                SELECT json_group_array(value) FROM (
+                    SELECT value FROM (
+                        SELECT 0 AS part, key, value FROM json_each(mishap.samples)
+                        UNION ALL
+                        SELECT 1, key, value FROM json_each(excluded.samples)
+                        ORDER BY part DESC, key DESC LIMIT {MISHAP_SAMPLES}
+                    ) ORDER BY part, key
+                )
+            )
+    """
+
+    @classmethod
+    def record(cls, incantation, request, error):
+        """Records `error` (an exception or a formatted traceback) raised by
+        `incantation` for `request`, in one upsert on the mishap's fingerprint"""
+        if isinstance(error, BaseException):
+            error = ''.join(traceback.format_exception(error, limit=-2))
+        now = int(time.time())
+        CodeBlob.store(code_hash(incantation.code), incantation.code)
+        macaron.execute(cls.UPSERT_SQL, [
+            incantation.id, request, code_hash(incantation.code), error,
+            mishap_fingerprint(incantation.id, incantation.code, error), 1, now, now, json.dumps([request]),
+        ])
+        metrics.MISHAPS.inc()
+
+    @property
+    def code(self):
+        return CodeBlob.load(self.code_hash)
+
+    @property
+    def samples_list(self):
+        return json.loads(self.samples or '[]')
+
     def fix(self):
         result = fix(
             Config.get_value('openai_key'), Config.get_value('openai_model'),
@@ -274,31 +904,155 @@ class Mishap(macaron.Model, BaseModel):
         )
         if isinstance(result, Exception):
             return result
-        self.incantation.code = result
-        self.incantation.schema = describe_function(
+        incantation = self.incantation
+        incantation.code = result
+        incantation.schema = describe_function(
             Config.get_value('openai_key'), Config.get_value('openai_model'), result
         )
-        self.incantation.save()
+        incantation.save()
+        commit()  # retry() runs the fixed code next
         return self
 
     def retry(self):
         # reload code
         incantation = Incantation.get("id=?", [self.incantation_id])
         try:
-            _, func = define_function(incantation.code)
+            _, func = define_function(incantation.code, incantation.code_hash)
             arguments = set(inspect.getargspec(func).args)
             ret = func(**{k: v for k, v in json.loads(self.request).items() if k in arguments})
-            Mishap.select("traceback=? AND code=?", [self.traceback, self.code]).delete()
+            self.delete()
             return ret
         except Exception as e:
-            incantation.mishaps.append(
-                request=self.request,
-                code=incantation.code,
-                traceback=''.join(traceback.format_exception(e, limit=-2))
-            )
+            Mishap.record(incantation, self.request, e)
             return e
 
 
+class Pipeline(macaron.Model, BaseModel):
+    """Saved incantations run one after the other, each step's arguments mapped
+    from the pipeline's input and the results of the steps before it"""
+    name = macaron.CharField()
+    master = macaron.ManyToOne(Master, fkey='master_id', ref_key='id', related_name='pipelines')
+
+    _DDL_SQL = """
+        CREATE TABLE IF NOT EXISTS pipeline (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            master_id INTEGER,
+            name TEXT,
+            FOREIGN KEY (master_id) REFERENCES master(id)
+        )
+    """
+
+    @property
+    def ordered_steps(self):
+        return sorted(self.steps, key=lambda step: step.position)
+
+    def export(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'steps': [
+                {'incantation': step.incantation_id, 'mapping': step.mapping_dict}
+                for step in self.ordered_steps
+            ],
+        }
+
+    def execute(self, data):
+        """Returns {'result': <last step's result>, 'results': [...]}, on failure the
+        result is an error naming the step and the mishap is recorded"""
+        inputs = data.get('args') or {}
+        if isinstance(inputs, str):
+            inputs = json.loads(inputs)
+        master, results = self.master, []
+        with tracing.span('pipeline.execute', name=self.name):
+            for number, step in enumerate(self.ordered_steps, 1):
+                incantation = master.incantation(step.incantation_id)
+                if incantation is None:
+                    error = f'Error: step {number}: incantation {step.incantation_id} is gone'
+                    return {'result': error, 'results': results}
+                try:
+                    request = json.dumps(step.arguments(incantation, inputs, results))
+                except (LookupError, TypeError, ValueError) as e:
+                    return {'result': f'Error: step {number}: bad mapping: {e}', 'results': results}
+                try:
+                    result = incantation.execute({'args': request})['result']
+                except Exception as e:
+                    Mishap.record(incantation, request, e)
+                    return {'result': f'Error: step {number} ({incantation.name}): {e}', 'results': results}
+                results.append(result)
+        return {'result': results[-1] if results else None, 'results': results}
+
+
+class PipelineStep(macaron.Model, BaseModel):
+    """``mapping`` is a JSON object of parameter -> value, where a value of
+    ``$prev`` is the previous step's result, ``$N`` step N's (from 1),
+    ``$input.name`` the pipeline's input argument, each optionally followed by
+    ``.key`` to pick from a dict (or list) result. Other values are literals,
+    ``$$`` escapes a leading ``$``. Parameters left out are taken from the input
+    arguments of the same name."""
+    pipeline = macaron.ManyToOne(Pipeline, fkey='pipeline_id', ref_key='id', related_name='steps')
+    incantation_id = macaron.IntegerField()
+    position = macaron.IntegerField()
+    mapping = macaron.CharField()
+
+    _table_name = 'pipeline_step'
+    _DDL_SQL = """
+        CREATE TABLE IF NOT EXISTS pipeline_step (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pipeline_id INTEGER,
+            incantation_id INTEGER,
+            position INTEGER,
+            mapping TEXT,
+            FOREIGN KEY (pipeline_id) REFERENCES pipeline(id),
+            FOREIGN KEY (incantation_id) REFERENCES incantation(id)
+        )
+    """
+
+    @property
+    def mapping_dict(self):
+        return json.loads(self.mapping or '{}')
+
+    @staticmethod
+    def check_reference(value, position):
+        """Raises ValueError unless ``value`` can be resolved at step ``position`` (from 1)"""
+        if not isinstance(value, str) or not value.startswith('$') or value.startswith('$$'):
+            return
+        ref = value[1:].split('.')
+        if ref[0] == 'prev':
+            if position == 1:
+                raise ValueError(f'{value}: the first step has no previous result')
+        elif ref[0] == 'input':
+            if len(ref) < 2:
+                raise ValueError(f'{value}: name the input argument, $input.<name>')
+        elif ref[0].isdigit():
+            if not 1 <= int(ref[0]) < position:
+                raise ValueError(f'{value}: only the results of steps 1 to {position - 1} are known')
+        else:
+            raise ValueError(f'{value}: unknown reference')
+
+    @staticmethod
+    def resolve(value, inputs, results):
+        if not isinstance(value, str) or not value.startswith('$'):
+            return value
+        if value.startswith('$$'):
+            return value[1:]
+        ref, *path = value[1:].split('.')
+        if ref == 'prev':
+            current = results[-1]
+        elif ref == 'input':
+            current = inputs
+        else:
+            current = results[int(ref) - 1]
+        for key in path:
+            current = current[int(key)] if isinstance(current, (list, tuple)) else current[key]
+        return current
+
+    def arguments(self, incantation, inputs, results):
+        mapping = self.mapping_dict
+        args = {name: inputs[name] for name in incantation.parameters if name in inputs and name not in mapping}
+        args.update((name, self.resolve(value, inputs, results)) for name, value in mapping.items())
+        return args
+
+
 class Incident(macaron.Model, BaseModel):
     type = macaron.CharField()
     traceback = macaron.CharField()
@@ -312,6 +1066,83 @@ class Incident(macaron.Model, BaseModel):
     """
 
 
+class Usage(macaron.Model, BaseModel):
+    """Append-only, rows are inserted in batches by usage.record()"""
+    time = macaron.IntegerField()
+    master_id = macaron.IntegerField()
+    call = macaron.CharField()
+    model = macaron.CharField()
+    prompt_tokens = macaron.IntegerField()
+    completion_tokens = macaron.IntegerField()
+    tools = macaron.IntegerField()
+    tools_size = macaron.IntegerField()
+
+    _DDL_SQL = """
+        CREATE TABLE IF NOT EXISTS usage (
+            id INTEGER PRIMARY KEY,
+            time INTEGER,
+            master_id INTEGER,
+            call TEXT,
+            model TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            tools INTEGER,
+            tools_size INTEGER
+        )
+    """
+
+    GROUPS = {
+        'master': "COALESCE((SELECT moniker FROM master WHERE master.id = usage.master_id), '-')",
+        'model': 'model',
+        'call': 'call',
+        'day': "date(time, 'unixepoch')",
+    }
+
+    @classmethod
+    def aggregate(cls, by='day', since=0):
+        """Calls, tokens and cost (with the `token_prices` config) per `by` group, largest first"""
+        prices = json.loads(Config.get_value('token_prices', '{}') or '{}')
+        rows = macaron.execute(f"""
+            SELECT {cls.GROUPS[by]} AS grp, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens),
+                   AVG(tools_size)
+            FROM usage WHERE time >= ? GROUP BY grp, model
+        """, [since]).fetchall()
+        groups = {}
+        for group, model, calls, prompt, completion, tools_size in rows:
+            entry = groups.setdefault(group, {
+                'group': group, 'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                'tools_size': 0, 'cost': None,
+            })
+            entry['calls'] += calls
+            entry['prompt_tokens'] += prompt
+            entry['completion_tokens'] += completion
+            entry['tools_size'] += (tools_size or 0) * calls  # averaged below
+            if model in prices:  # [per 1K prompt tokens, per 1K completion tokens]
+                prompt_price, completion_price = prices[model]
+                cost = (prompt * prompt_price + completion * completion_price) / 1000
+                entry['cost'] = (entry['cost'] or 0) + cost
+        for entry in groups.values():
+            entry['tools_size'] = round(entry['tools_size'] / entry['calls'])
+        key = (lambda e: e['group']) if by == 'day' else (lambda e: e['prompt_tokens'] + e['completion_tokens'])
+        return sorted(groups.values(), key=key, reverse=True)
+
+    @classmethod
+    def schema_sizes(cls, since=0, limit=20):
+        """Incantations whose schemas add the most to wish prompts: schema size times the
+        number of wish calls of its master that carried it"""
+        return macaron.execute("""
+            SELECT incantation.id, incantation.name, master.moniker, length(incantation.schema),
+                   length(incantation.schema) * COALESCE(wishes.n, 0) AS total
+            FROM incantation
+            JOIN master ON master.id = incantation.master_id
+            LEFT JOIN (
+                SELECT master_id, COUNT(*) AS n FROM usage WHERE call = 'wish' AND time >= ? GROUP BY master_id
+            ) AS wishes ON wishes.master_id = incantation.master_id
+            ORDER BY total DESC, length(incantation.schema) DESC
+            LIMIT ?
+        """, [since, limit]).fetchall()
+
+
 class Config(macaron.Model, BaseModel):
     key = macaron.CharField()
     value = macaron.CharField()
@@ -328,19 +1159,21 @@ class Config(macaron.Model, BaseModel):
     @classmethod
     def get_value(cls, key, default=None):
         try:
-            return str(cls.get("key=?", [key]).value)
+            return str(cls.prepared("key=?").get(key).value)
         except cls.DoesNotExist:
             return default
 
     @classmethod
     def set_value(cls, key, value):
         try:
-            obj = cls.get("key=?", [key])
+            obj = cls.prepared("key=?").get(key)
         except cls.DoesNotExist:
             cls.create(key=key, value=value)
         else:
             obj.value = str(value)
             obj.save()
+        if key == 'css':
+            cls.set_value('css_hash', hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:16])
 
     @classmethod
     def check(cls, key):
@@ -348,7 +1181,7 @@ class Config(macaron.Model, BaseModel):
 
     @classmethod
     def editable(cls):
-        return cls.select("key NOT IN ('code_phrase_salt', 'admin')")
+        return cls.select("key NOT IN ('code_phrase_salt', 'admin', 'css_hash')")
 
     @classmethod
     def _after_create(cls):
@@ -361,9 +1194,17 @@ class Config(macaron.Model, BaseModel):
             ('openai_model', 'gpt-4-1106-preview'),
             ('manual_incantation_crafting', '0'),
             ('craft_retries', '3'),
+            ('combined_craft', '0'),  # code, schema and arguments in one completion
+            ('craft_candidates', '1'),  # candidates asked for at once, the first valid one is used
+            # call combined_craft candidates with the wish's arguments in a subprocess first,
+            # side effects (sending, deleting, paying) then happen twice, see utils.smoke_call
+            ('craft_smoke_check', '0'),
             ('css', CSS),
             ('registration_allowed', '0'),
+            ('token_prices', '{}'),  # {"model": [USD per 1K prompt tokens, USD per 1K completion tokens]}
         )
         for key, value in initial_config:
             if cls.get_value(key) is None:
                 cls.set_value(key, value)
+        if cls.get_value('css_hash') is None:
+            cls.set_value('css', cls.get_value('css'))
@@ -0,0 +1,306 @@
+"""
+Server adapters for running Jinn in production.
+
+``ThreadedServer`` is a wsgiref server that hands connections to a fixed pool
+of worker threads and keeps HTTP/1.1 connections alive, so one slow wish no
+longer blocks every other client.
+
+``PreforkServer`` binds the listening socket once and forks several worker
+processes running a ``ThreadedServer`` on it. State shared by the workers
+(config, sessions) lives in SQLite.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+import bottle
+
+
+class RequestBody:
+    """wsgi.input wrapper that stops at Content-Length and tracks the unread rest"""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0:
+            return -1 if self.remaining == float('inf') else self.remaining
+        return min(size, self.remaining)
+
+    def read(self, size=-1):
+        data = self.rfile.read(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.rfile.readline(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        handler = self.request_handler
+        if 'Content-Length' not in self.headers or handler.server.draining:
+            handler.close_connection = True
+        if handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.keepalive
+        super().setup()
+
+    def address_string(self):  # Prevent reverse DNS lookups please.
+        return self.client_address[0]
+
+    def log_request(self, *args, **kw):
+        if not self.server.quiet:
+            return super().log_request(*args, **kw)
+
+    def handle(self):  # wsgiref's handle() serves a single request only
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():  # An error code has been sent, just exit
+            return
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = RequestBody(self.rfile, float('inf'))
+            self.close_connection = True
+        else:
+            body = RequestBody(self.rfile, int(self.headers.get('Content-Length') or 0))
+        handler = KeepAliveServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ(), multithread=True
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+        # leftovers of an unread body would be parsed as the next request
+        if body.remaining > 65536:
+            self.close_connection = True
+        elif body.remaining and not self.close_connection:
+            body.read()
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGIServer serving each connection on a fixed pool of threads"""
+    request_queue_size = 128
+    draining = False
+    quiet = False
+
+    def __init__(self, address, handler_class, threads=8, keepalive=15, bind_and_activate=True):
+        self.keepalive = keepalive
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='jinn')
+        super().__init__(address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self.draining = True
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+class ThreadedServer(bottle.ServerAdapter):
+    """Options: ``threads`` (pool size, default 8), ``keepalive`` (idle seconds, default 15)"""
+
+    def make_server(self, app, bind_and_activate=True):
+        server_cls = ThreadPoolWSGIServer
+        if ':' in self.host:  # Fix wsgiref for IPv6 addresses.
+            class server_cls(server_cls):
+                address_family = socket.AF_INET6
+
+        srv = server_cls(
+            (self.host, self.port), KeepAliveRequestHandler,
+            threads=int(self.options.get('threads', 8)),
+            keepalive=int(self.options.get('keepalive', 15)),
+            bind_and_activate=bind_and_activate,
+        )
+        srv.quiet = self.quiet
+        srv.set_app(app)
+        return srv
+
+    def run(self, app):
+        self.srv = self.make_server(app)
+        self.port = self.srv.server_port
+        try:
+            self.srv.serve_forever()
+        finally:
+            self.srv.server_close()
+
+
+class PreforkServer(ThreadedServer):
+    """Options: ``workers`` (processes, default 2) and ``grace`` (seconds,
+    default 30) plus those of ThreadedServer.
+
+    SIGHUP replaces the workers with fresh ones, the old ones finish their
+    in-flight requests first. SIGTERM/SIGINT drains all workers and exits.
+    Workers still busy ``grace`` seconds after being told to stop are killed.
+    """
+
+    def run(self, app):
+        self.srv = self.make_server(app)
+        self.port = self.srv.server_port
+        self.grace = float(self.options.get('grace', 30))
+        self.workers = {}
+        self.retired = {}  # pid -> time it gets SIGKILL
+        received = []
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: received.append(signum))
+        try:
+            self.spawn(int(self.options.get('workers', 2)))
+            while True:
+                self.reap()
+                self.kill_overdue()
+                while received:
+                    signum = received.pop(0)
+                    if signum == signal.SIGHUP:
+                        self.reload()
+                    else:
+                        return self.stop()
+                time.sleep(0.2)
+        finally:
+            self.srv.server_close()
+
+    def spawn(self, count):
+        for _ in range(count):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self.serve()
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    logging.shutdown()  # os._exit() skips atexit, flush queued records
+                    os._exit(code)
+            self.workers[pid] = time.time()
+
+    def serve(self):
+        def drain(signum, frame):
+            self.srv.draining = True
+            threading.Thread(target=self.srv.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGINT, drain)
+        # serve_forever() checks for shutdown() between accepts: with a blocking
+        # socket a worker losing the race for a connection would sit in accept()
+        # until the next one; socketserver ignores the BlockingIOError instead
+        self.srv.socket.setblocking(False)
+        try:
+            self.srv.serve_forever()
+        finally:
+            self.srv.server_close()  # waits for in-flight requests
+
+    def reap(self):
+        while self.workers or self.retired:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.retired.clear()
+                return
+            if not pid:
+                return
+            self.retired.pop(pid, None)
+            started = self.workers.pop(pid, None)
+            if started is not None:  # died on its own, not retired by reload()
+                sys.stderr.write('Worker %d exited with status %d, restarting.\n' % (pid, status))
+                if time.time() - started < 1:
+                    time.sleep(1)
+                self.spawn(1)
+
+    def retire(self, pids):
+        deadline = time.time() + self.grace
+        for pid in pids:
+            self.retired[pid] = deadline
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill_overdue(self):
+        now = time.time()
+        for pid, deadline in list(self.retired.items()):
+            if now >= deadline:
+                sys.stderr.write('Worker %d did not stop within %gs, killing it.\n' % (pid, self.grace))
+                del self.retired[pid]
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def reload(self):
+        retired = list(self.workers)
+        self.workers = {}
+        self.spawn(len(retired))
+        self.retire(retired)
+
+    def stop(self):
+        self.retire(list(self.workers))
+        self.workers = {}
+        while self.retired:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        while True:
+            try:
+                os.wait()
+            except ChildProcessError:
+                break
+
+
+def run_options(name, threads, keepalive, workers=1):
+    """bottle.run() arguments for a threaded server picked by name"""
+    if name == 'waitress':
+        return {'server': 'waitress', 'threads': threads, 'channel_timeout': keepalive}
+    if name == 'cheroot':
+        return {'server': 'cheroot', 'numthreads': threads, 'timeout': keepalive}
+    if workers > 1:
+        return {'server': PreforkServer, 'threads': threads, 'keepalive': keepalive, 'workers': workers}
+    return {'server': ThreadedServer, 'threads': threads, 'keepalive': keepalive}
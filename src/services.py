@@ -1,98 +1,286 @@
 import json
+import time
 import inspect
 import traceback
 import tempfile
 import logging
 import textwrap
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
 
 from openai import OpenAI
 
+import logs
+import tracing
+import metrics
+import usage
 from constants import OPENAI_FUNCTION_SCHEMA, CRAFT_INCANTATION_SCHEMA
-from utils import unwrap_content, define_function, NoDefaults
-from config import LOG_PATH
+from utils import unwrap_content, define_function, smoke_call, NoDefaults
+from config import LOG_PATH, LOG_MAX_BYTES, LOG_BACKUPS, LOG_FORMAT, OPENAI_BASE_URL, CALL_THREADS, CALL_TIMEOUT
 
 
 logger = logging.getLogger('jinn_openai')
 logger.setLevel(logging.INFO)
-handler = logging.FileHandler(LOG_PATH)
+handler = logs.BatchRotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
 handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(message)s')
+if LOG_FORMAT == 'json':
+    formatter = logs.JSONFormatter()
+else:
+    formatter = logging.Formatter('%(asctime)s - %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
+logs.offload(logger)
+
+# shared by every request, threads start on first use (so after WORKERS are forked);
+# smoke checks have their own, hung incantations can't hold up crafting
+executor = ThreadPoolExecutor(CALL_THREADS, thread_name_prefix='incantation')
+smoke_executor = ThreadPoolExecutor(CALL_THREADS, thread_name_prefix='smoke')
+
+
+@functools.lru_cache(maxsize=8)
+def client(key):
+    # one client per key, so its connection pool is reused across requests
+    return OpenAI(api_key=key, base_url=OPENAI_BASE_URL)
+
+
+@contextlib.contextmanager
+def observed(call, **attrs):
+    """Traces and times an OpenAI API call"""
+    with tracing.span(f'openai.{call}', **attrs), metrics.OPENAI_SECONDS.time(call=call):
+        try:
+            yield
+        except Exception:
+            metrics.OPENAI_ERRORS.inc(call=call)
+            raise
 
 
 def describe_function(key, model, code):
-    response = OpenAI(api_key=key).chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=[{
-            "role": "user",
-            "content": (
-                f"Describe this python function: {code} in this schema {OPENAI_FUNCTION_SCHEMA}. "
-                "I want only json in response, nothing else."
-            )
-        }]
-    )
+    with observed('describe_function', model=model):
+        response = client(key).chat.completions.create(
+            model=model,
+            temperature=0,
+            messages=[{
+                "role": "user",
+                "content": (
+                    f"Describe this python function: {code} in this schema {OPENAI_FUNCTION_SCHEMA}. "
+                    "I want only json in response, nothing else."
+                )
+            }]
+        )
+    usage.record('describe_function', model, response)
     ret = unwrap_content(response.choices[0].message.content, 'json')
     logger.info(f'describe_function({code}) = {ret}')
     return ret
 
 
-def craft_incantation(key, model, retries, text):
+CRAFT_RULES = (
+    "Don't comment the code, don't ask for user's input, don't print anything and "
+    "don't do any exception handling unless it's necessary. "
+    "Don't use keywords, variadic arguments. "
+    "Dont use any types other than numbers, strings and booleans as "
+    "function's arguments. "
+    "Don't use lists, tuples, dictionaries, sets, etc. "
+    "Don't use any global variables. "
+    "Try not to use any external libraries, only built-in ones. "
+    "Function's name should be as descriptive as possible. "
+    "If you're certain that you need to use some external package, "
+    "and that package is not a part of python's standard library, "
+    "import it in the beginning of the function like this:\n"
+    "try:\n"
+    "    import requests\n"
+    "except ImportError:\n"
+    "    import pip\n"
+    "    pip.main(['install', 'requests'])\n"
+    "If function needs any parameters (like credentials,"
+    " configuration, etc), they should be passed as arguments."
+)
+
+
+def _code_incantation(content):
+    code = NoDefaults.in_(unwrap_content(content, 'python'))
+    name, _ = define_function(code)
+    return name, code
+
+
+def _smoke_check(result):
+    """smoke_call for (name, code, schema, arguments), tells None when it passed"""
+    _, code, _, arguments = result
+    return smoke_call(code, json.loads(arguments))
+
+
+def _pick_candidate(contents, validate, smoke=None):
+    """First candidate passing `validate` (and `smoke`, run for all of them in parallel,
+    the first to pass wins). Returns the validated result or a list of (content, error)
+    for the candidates that failed."""
+    valid, failures = [], []
+    for content in contents:
+        try:
+            valid.append((content, validate(content)))
+        except Exception as e:
+            failures.append((content, e))
+    if not valid or smoke is None:
+        return valid[0][1] if valid else failures
+
+    futures = {smoke_executor.submit(smoke, result): (content, result) for content, result in valid}
+    try:
+        for future in as_completed(futures):
+            content, result = futures[future]
+            if (error := future.result()) is None:
+                return result
+            failures.append((content, RuntimeError(error)))
+        return failures
+    finally:
+        for future in futures:
+            future.cancel()  # the ones not started yet
+
+
+def _feedback(messages, failures, instruction):
+    """Appends a failed candidate and its own error to `messages`, for the next attempt
+    to fix, returns the error"""
+    if not failures:
+        return RuntimeError('The response had no candidates')
+    content, error = failures[0]
+    messages.append({"role": "assistant", "content": content})
+    messages.append({
+        "role": "user",
+        "content": f"{''.join(traceback.format_exception(error))}\n{instruction}"
+    })
+    return error
+
+
+def _candidates(key, model, call, messages, candidates, **kwargs):
+    """Completes `messages` with `candidates` choices (n=), returns their contents"""
+    candidates = max(int(candidates), 1)
+    with observed(call, model=model, candidates=candidates):
+        response = client(key).chat.completions.create(
+            model=model,
+            temperature=0 if candidates == 1 else 0.8,  # some variety among candidates
+            n=candidates,
+            messages=messages,
+            **kwargs
+        )
+    usage.record(call, model, response)
+    return [choice.message.content for choice in response.choices]
+
+
+def craft_incantation(key, model, retries, text, candidates=1):
     messages = [{
         "role": "user",
         "content": (
             "Write a python function according to the request. "
             "I want only python code in response, nothing else. "
-            "Don't comment the code, don't ask for user's input, don't print anything and "
-            "don't do any exception handling unless it's necessary. "
-            "Don't use keywords, variadic arguments. "
-            "Dont use any types other than numbers, strings and booleans as "
-            "function's arguments. "
-            "Don't use lists, tuples, dictionaries, sets, etc. "
-            "Don't use any global variables. "
-            "Try not to use any external libraries, only built-in ones. "
-            "Function's name should be as descriptive as possible. "
-            "If you're certain that you need to use some external package, "
-            "and that package is not a part of python's standard library, "
-            "import it in the beginning of the function like this:\n"
-            "try:\n"
-            "    import requests\n"
-            "except ImportError:\n"
-            "    import pip\n"
-            "    pip.main(['install', 'requests'])\n"
-            "If function needs any parameters (like credentials,"
-            " configuration, etc), they should be passed as arguments."
-            f" \nRequest:\n{text}"
+            f"{CRAFT_RULES} \nRequest:\n{text}"
         )
     }]
-    response = OpenAI(api_key=key).chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=messages,
-    )
-    messages.append({"role": "assistant", "content": response.choices[0].message.content})
 
-    last_e = None
-    for i in range(int(retries)):
-        code = unwrap_content(response.choices[0].message.content, 'python')
-        code = NoDefaults.in_(code)
-        try:
-            name, _ = define_function(code)
+    for i in range(max(int(retries), 1)):
+        contents = _candidates(key, model, 'craft_incantation', messages, candidates)
+        result = _pick_candidate(contents, _code_incantation)
+        if isinstance(result, tuple):
+            name, code = result
             logger.info(f'craft_incantation({text}) = {name}, {code}')
             return name, code
-        except Exception as e:
-            last_e = e
-            messages.append({
-                "role": "assistant",
-                "content": (
-                    f"{''.join(traceback.format_exception(e))}\n"
-                    "Fix this error. I want only python code in response, nothing else."
-                )
-            })
-            continue
-    else:
-        return last_e
+        error = _feedback(
+            messages, result, "Fix this error. I want only python code in response, nothing else."
+        )
+    return error
+
+
+def _combined_incantation(content):
+    """Validates a craft_combined answer, returns name, code, schema and arguments (both JSON)"""
+    data = json.loads(unwrap_content(content, 'json'))
+    code = NoDefaults.in_(unwrap_content(data['code'], 'python'))
+    name, func = define_function(code)
+    parameters = set(inspect.getfullargspec(func).args)
+
+    schema = data['schema']
+    schema = json.loads(schema) if isinstance(schema, str) else schema
+    if 'function' not in schema:  # just the function part
+        schema = {'type': 'function', 'function': schema}
+    schema['function']['name'] = name
+    properties = set(schema['function'].get('parameters', {}).get('properties', {}))
+    if properties != parameters:
+        raise ValueError(
+            f"Schema parameters {sorted(properties)} don't match the function's arguments {sorted(parameters)}"
+        )
+
+    arguments = data.get('arguments') or {}
+    if unknown := set(arguments) - parameters:
+        raise ValueError(f"Unknown arguments {sorted(unknown)}")
+    return name, code, json.dumps(schema), json.dumps(arguments)
+
+
+def craft_combined(key, model, retries, text, wish=None, candidates=1, smoke=False):
+    """craft_incantation and describe_function in one completion, along with the arguments
+    fulfilling `wish` when given. Returns name, code, schema, arguments or the last error.
+    With `smoke` candidates are also called with their arguments in a subprocess."""
+    messages = [{
+        "role": "user",
+        "content": (
+            "Write a python function according to the request and describe it as a tool. "
+            f"{CRAFT_RULES} "
+            "Respond with a JSON object with the keys \"code\" (python code of the function),"
+            f" \"schema\" (description of the function in this schema {OPENAI_FUNCTION_SCHEMA}) and"
+            " \"arguments\" (object with the arguments fulfilling the wish, pass empty strings for"
+            " the ones like credentials or configuration that cannot be infered from it)."
+            " I want only json in response, nothing else."
+            f"\nRequest:\n{text}"
+            f"\nWish:\n{wish or text}"
+        )
+    }]
+
+    for i in range(max(int(retries), 1)):
+        contents = _candidates(
+            key, model, 'craft_combined', messages, candidates, response_format={"type": "json_object"}
+        )
+        result = _pick_candidate(contents, _combined_incantation, _smoke_check if smoke else None)
+        if isinstance(result, tuple):
+            name, code, schema, arguments = result
+            logger.info(f'craft_combined({text}, {wish}) = {name}, {code}, {schema}, {arguments}')
+            return name, code, schema, arguments
+        error = _feedback(
+            messages, result, "Fix this error. I want only the same json object in response, nothing else."
+        )
+    return error
+
+
+def _execute_call(incantations, tool_call):
+    incantation, args = incantations[tool_call.function.name]['object'], tool_call.function.arguments
+    try:
+        return incantation, args, incantation.execute({'args': args})['result']
+    except Exception as e:
+        return incantation, args, e
+
+
+class CallResults(list):
+    """What wish() returns for several tool calls: (incantation, arguments, result or error)
+    for each, told apart from a single incantation's result, which may be a list too"""
+
+
+def execute_calls(incantations, tool_calls):
+    """Executes the tool calls concurrently, returns (incantation, arguments, result or error)
+    for each, in order. Unknown tools are skipped. Calls still running after CALL_TIMEOUT
+    seconds are given up on with a TimeoutError (their thread stays busy until they end)."""
+    tool_calls = [call for call in tool_calls if call.function.name in incantations]
+    if len(tool_calls) == 1:
+        return [_execute_call(incantations, tool_calls[0])]
+    # each call runs in a copy of the request's context, so its spans land in the request's trace
+    futures = [
+        executor.submit(contextvars.copy_context().run, _execute_call, incantations, tool_call)
+        for tool_call in tool_calls
+    ]
+    deadline, results = time.monotonic() + CALL_TIMEOUT, []
+    for tool_call, future in zip(tool_calls, futures):
+        try:
+            results.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+        except FutureTimeout:
+            future.cancel()  # in case it is still queued behind hung calls
+            incantation = incantations[tool_call.function.name]['object']
+            error = TimeoutError(f'{tool_call.function.name} did not finish within {CALL_TIMEOUT:g}s')
+            results.append((incantation, tool_call.function.arguments, error))
+    return results
 
 
 def wish(key, model, text, incantations, allow_craft=False, call=True):
@@ -115,29 +303,35 @@ def wish(key, model, text, incantations, allow_craft=False, call=True):
             ' If the request has a word "question" in the beginning, just answer it shortly.'
             f'\nRequest:\n{text}'
         )
-    response = OpenAI(api_key=key).chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=[{
-            "role": "user",
-            "content": instructions
-        }],
-        tools=tools,
-        tool_choice="auto"
-    )
+    with observed('wish', model=model):
+        response = client(key).chat.completions.create(
+            model=model,
+            temperature=0,
+            messages=[{
+                "role": "user",
+                "content": instructions
+            }],
+            tools=tools,
+            tool_choice="auto"
+        )
+    usage.record('wish', model, response, tools)
     response_message = response.choices[0].message
     if tool_calls := response_message.tool_calls:
         if tool_calls[0].function.name == 'craft_incantation':
             logger.info(f'wish({text}) = craft_incantation{tool_calls[0].function.arguments}')
             return 'craft_incantation', tool_calls[0].function.arguments
         elif call:
-            try:
-                incantation = incantations[tool_calls[0].function.name]
-                args = json.loads(tool_calls[0].function.arguments)
-                logger.info(f'wish({text}) = {tool_calls[0].function.name} {args}')
-                return incantation['object'].execute({'args': args})['result']
-            except Exception as e:
-                return incantation['object'], tool_calls[0].function.arguments, e
+            for tool_call in tool_calls:
+                logger.info(f'wish({text}) = {tool_call.function.name}{tool_call.function.arguments}')
+            results = execute_calls(incantations, tool_calls)
+            if not results:
+                return f'Error: unknown tool {tool_calls[0].function.name}'
+            if len(results) > 1:
+                return CallResults(results)
+            incantation, args, result = results[0]
+            if isinstance(result, Exception):
+                return incantation, args, result
+            return result
         else:
             logger.info(f'wish({text}) = {tool_calls[0].function.name}{tool_calls[0].function.arguments}')
             return incantations[tool_calls[0].function.name], tool_calls[0].function.arguments
@@ -156,11 +350,13 @@ def adjust(key, model, code, reason):
         "I want only python code in response, nothing else."
         f" Code:\n{code}\nReason:\n{reason}"
     )
-    response = OpenAI(api_key=key).chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=[{"role": "user", "content": instructions}],
-    )
+    with observed('adjust', model=model):
+        response = client(key).chat.completions.create(
+            model=model,
+            temperature=0,
+            messages=[{"role": "user", "content": instructions}],
+        )
+    usage.record('adjust', model, response)
     code = unwrap_content(response.choices[0].message.content, 'python')
     try:
         name, _ = define_function(code)
@@ -182,11 +378,13 @@ def fix(key, model, code, request, traceback):
     arguments = set(inspect.getargspec(func).args)
     arguments = {k: v for k, v in json.loads(request).items() if k in arguments}
     arguments = json.dumps(arguments)
-    response = OpenAI(api_key=key).chat.completions.create(
-        model=model,
-        temperature=0,
-        messages=[{"role": "user", "content": instructions}],
-    )
+    with observed('fix', model=model):
+        response = client(key).chat.completions.create(
+            model=model,
+            temperature=0,
+            messages=[{"role": "user", "content": instructions}],
+        )
+    usage.record('fix', model, response)
     code = unwrap_content(response.choices[0].message.content, 'python')
     try:
         define_function(code)
@@ -201,18 +399,20 @@ def stt(key, data):
         with open(temp.name, 'wb') as f:
             f.write(data)
         with open(temp.name, 'rb') as temp_read:
-            response = OpenAI(api_key=key).audio.transcriptions.create(
-                model="whisper-1",
-                file=temp_read,
-            )
+            with observed('stt'):
+                response = client(key).audio.transcriptions.create(
+                    model="whisper-1",
+                    file=temp_read,
+                )
         logger.info(f'stt() = {response.text}')
         return response.text
 
 
 def tts(key, text):
-    response = OpenAI(api_key=key).audio.speech.create(
-        model="tts-1-hd",
-        voice="nova",
-        input=text,
-    )
+    with observed('tts'):
+        response = client(key).audio.speech.create(
+            model="tts-1-hd",
+            voice="nova",
+            input=text,
+        )
     return response.content
@@ -0,0 +1,126 @@
+"""
+Registry of the inline SimpleTemplate sources of the views.
+
+bottle.template() keys its cache by the source string and recompiles on every
+call while bottle.DEBUG is set, which is always the case in development. Here
+templates are compiled once, keyed by a hash of their source, regardless of
+DEBUG. ``precompile(path)`` compiles every literal ``template('''...''')`` of
+a module at import, so no request pays for parsing; with DEBUG a module file
+that changed on disk has the templates it no longer contains dropped, the ones
+edited in it are compiled on their first render.
+"""
+import os
+import ast
+import hashlib
+import threading
+
+import bottle
+import metrics
+
+
+_compiled = {}  # source hash -> SimpleTemplate
+_files = {}  # module path -> (mtime, source hashes)
+_names = {}  # source hash -> name shown in tracebacks
+_lock = threading.Lock()
+
+
+def _key(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def _compile(tpl):
+    """Translates `tpl` to python and compiles it now, bottle would do both on its
+    first render (SimpleTemplate.code and .co are cached properties)"""
+    tpl.co = compile(tpl.code, tpl.filename, 'exec')
+
+
+def compiled(source, filename=None):
+    """Returns the SimpleTemplate for `source`, translated and compiled once"""
+    key = _key(source)
+    tpl = _compiled.get(key)
+    metrics.CACHE.inc(cache='template', result='miss' if tpl is None else 'hit')
+    if tpl is None:
+        tpl = bottle.SimpleTemplate(source=source)
+        tpl.filename = filename or _names.get(key, '<template>')  # instead of <string> in tracebacks
+        _compile(tpl)
+        _compiled[key] = tpl
+    return tpl
+
+
+def template(source, /, **kwargs):
+    """bottle.template() for an inline source, without recompiling in debug mode"""
+    if bottle.DEBUG:
+        _check()
+    return compiled(source).render(kwargs)
+
+
+def _sources(path):
+    """(line, source) of every template(<literal>) call in the module at `path`"""
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, 'id', None)
+        if name == 'template' and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            yield node.lineno, node.args[0].value
+
+
+def _scan(path):
+    """Registers the inline templates of the module at `path` under their names,
+    returns their source hash -> source"""
+    mtime = os.stat(path).st_mtime
+    sources = {}
+    for line, source in _sources(path):
+        key = _key(source)
+        _names[key] = f'<template {os.path.basename(path)}:{line}>'
+        sources[key] = source
+    _files[path] = (mtime, set(sources))
+    return sources
+
+
+def precompile(path):
+    """Compiles the inline templates of the module at `path`, returns how many"""
+    path = os.path.abspath(path)
+    with _lock:
+        sources = _scan(path)
+        for source in sources.values():
+            compiled(source)
+        return len(sources)
+
+
+def invalidate(path=None):
+    """Drops the templates of the module at `path`, or all of them"""
+    with _lock:
+        if path is None:
+            _compiled.clear()
+            _files.clear()
+            _names.clear()
+            return
+        _, keys = _files.pop(os.path.abspath(path), (None, ()))
+        for key in keys:
+            _compiled.pop(key, None)
+            _names.pop(key, None)
+
+
+def _rescan(path):
+    """Drops the templates the module at `path` no longer contains. Those unchanged
+    stay compiled, new ones are compiled when they are first rendered."""
+    with _lock:
+        _, old = _files.get(path, (None, set()))
+        for key in old - set(_scan(path)):
+            _compiled.pop(key, None)
+            _names.pop(key, None)
+
+
+def _check():
+    for path, (mtime, _) in list(_files.items()):
+        try:
+            changed = os.stat(path).st_mtime != mtime
+        except OSError:
+            changed = True
+        if changed:
+            if os.path.exists(path):
+                _rescan(path)
+            else:
+                invalidate(path)
@@ -0,0 +1,184 @@
+"""
+In-process request tracing.
+
+A trace is started per request by ``TracingPlugin`` and spans are opened with
+``span(name, **attrs)`` anywhere below it (OpenAI calls, SQL via macaron's
+SQL_TRACE_HOOK, incantation execution). Outside of a traced request ``span``
+is a no-op. A trace keeps its first TRACE_SPANS spans and counts the rest as
+dropped. Finished traces are kept in a ring buffer of TRACE_BUFFER entries,
+per process: with WORKERS > 1 a trace is only found on the worker that served
+the request.
+"""
+import os
+import time
+import threading
+import contextlib
+import contextvars
+from collections import OrderedDict
+
+import bottle
+
+from config import TRACE_BUFFER, TRACE_SPANS
+
+
+_trace = contextvars.ContextVar('trace', default=None)
+_parent = contextvars.ContextVar('span', default=None)
+
+_traces = OrderedDict()  # id -> Trace, oldest first
+_lock = threading.Lock()
+
+
+class Trace:
+    def __init__(self, name):
+        self.id = os.urandom(8).hex()
+        self.name = name
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.dropped = 0  # spans past TRACE_SPANS
+
+    @property
+    def duration(self):
+        return max((s.end for s in self.spans if s.end is not None), default=self.start) - self.start
+
+    def export(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'time': self.time,
+            'duration_ms': round(self.duration * 1000, 3),
+            'spans': [s.export(self.start) for s in self.spans],
+            'dropped': self.dropped,
+        }
+
+
+class Span:
+    def __init__(self, name, parent, attrs):
+        self.id = None
+        self.name = name
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+        self.error = None
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def export(self, origin):
+        return {
+            'id': self.id,
+            'parent': self.parent.id if self.parent else None,
+            'name': self.name,
+            'depth': self.depth,
+            'thread': self.thread,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attrs': self.attrs,
+            'error': self.error,
+        }
+
+
+@contextlib.contextmanager
+def _span(trace, name, attrs):
+    if len(trace.spans) >= TRACE_SPANS:  # e.g. a query per row, the trace would grow without bound
+        trace.dropped += 1
+        yield None
+        return
+    parent = _parent.get()
+    span = Span(name, parent, attrs)
+    span.id = len(trace.spans)
+    trace.spans.append(span)
+    token = _parent.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        if not isinstance(e, bottle.HTTPResponse):  # redirects are not errors
+            span.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        span.end = time.perf_counter()
+        _parent.reset(token)
+
+
+def span(name, /, **attrs):
+    """Context manager timing the enclosed block as a span of the current trace"""
+    trace = _trace.get()
+    if trace is None:
+        return contextlib.nullcontext()
+    return _span(trace, name, attrs)
+
+
+def sql_span(sql, parameters):
+    if _trace.get() is None:
+        return contextlib.nullcontext()
+    return span('sql', sql=' '.join(sql.split())[:500])
+
+
+def current():
+    return _trace.get()
+
+
+def get(trace_id):
+    with _lock:
+        return _traces.get(trace_id)
+
+
+def recent(count=50):
+    with _lock:
+        return list(reversed(_traces.values()))[:count]
+
+
+def _keep(trace):
+    with _lock:
+        _traces[trace.id] = trace
+        while len(_traces) > TRACE_BUFFER:
+            _traces.popitem(last=False)
+
+
+class TracingPlugin:
+    """Traces requests. Without ``span`` it starts the trace (install it first,
+    so it wraps every other plugin), with ``span`` it adds a span for the
+    plugins installed after it.
+    """
+    api = 2
+
+    def __init__(self, span=None, skip=('/static', '/trace')):
+        self.span = span
+        self.name = f'tracing.{span}' if span else 'tracing'
+        self.skip = skip
+
+    def apply(self, callback, route):
+        if TRACE_BUFFER <= 0:
+            return callback
+
+        if self.span:
+            def wrapper(*args, **kwargs):
+                with span(self.span):
+                    return callback(*args, **kwargs)
+            return wrapper
+
+        def wrapper(*args, **kwargs):
+            if bottle.request.path.startswith(self.skip):
+                return callback(*args, **kwargs)
+            trace = Trace(f'{bottle.request.method} {bottle.request.path}')
+            trace_token = _trace.set(trace)
+            try:
+                with _span(trace, 'request', {'route': route.rule}) as request_span:
+                    try:
+                        return callback(*args, **kwargs)
+                    except bottle.HTTPResponse as e:
+                        e.set_header('X-Trace-Id', trace.id)
+                        request_span.attrs['status'] = e.status_code
+                        raise
+                    finally:
+                        if 'status' not in request_span.attrs:
+                            request_span.attrs['status'] = bottle.response.status_code
+                        bottle.response.set_header('X-Trace-Id', trace.id)
+            finally:
+                _trace.reset(trace_token)
+                _keep(trace)
+        return wrapper
@@ -0,0 +1,38 @@
+"""
+Token accounting: the usage block of every chat completion is appended to the
+usage table. Rows go through the logging queue (see logs.py) and are inserted
+in batches by its writer thread, off the request path.
+"""
+import json
+import time
+import logging
+import contextvars
+
+import logs
+from config import DB_PATH
+
+
+# id of the master the current request is served for, set by require_auth
+current_master = contextvars.ContextVar('current_master', default=None)
+
+logger = logging.getLogger('jinn_usage')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logs.SQLiteBatchHandler(
+    DB_PATH,
+    'INSERT INTO usage (time, master_id, call, model, prompt_tokens, completion_tokens, tools, tools_size)'
+    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+))
+logs.offload(logger)
+
+
+def record(call, model, response, tools=()):
+    """Records the usage of a chat completion, `tools` being the tool schemas sent along"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    logger.info(call, extra={'row': (
+        int(time.time()), current_master.get(), call, model,
+        usage.prompt_tokens, usage.completion_tokens,
+        len(tools), len(json.dumps(tools)) if tools else 0,
+    )})
@@ -1,4 +1,14 @@
+import os
 import ast
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+from collections import OrderedDict
+
+import tracing
 
 
 class NoDefaults(ast.NodeTransformer):
@@ -51,7 +61,157 @@ def unwrap_content(text, prefix):
     return text
 
 
-def define_function(code):
+COMPILED_CODE = 256  # code objects kept by _compile
+_compiled = OrderedDict()  # code hash (or the code itself) -> code object, least recently used first
+_compiled_lock = threading.Lock()
+
+
+def _compile(code, code_hash=None):
+    """Code objects are immutable, so one per distinct code is enough. Keyed by the
+    code's hash when the caller has it stored, so a lookup doesn't hash the whole
+    source. Each define_function still runs it in a fresh namespace."""
+    key = ('hash', code_hash) if code_hash else ('code', code)
+    with _compiled_lock:
+        if (compiled := _compiled.get(key)) is not None:
+            _compiled.move_to_end(key)
+            return compiled
+    compiled = compile(code, '<string>', 'exec')
+    with _compiled_lock:
+        _compiled[key] = compiled
+        while len(_compiled) > COMPILED_CODE:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def define_function(code, code_hash=None):
+    """Runs `code`, returns the name and the first callable it defines. `code_hash`
+    must be models.code_hash(code) when given."""
     ns = {}
-    exec(code, ns)
+    with tracing.span('define_function'):
+        exec(_compile(code, code_hash), ns)
     return next(iter((name, obj) for name, obj in ns.items() if callable(obj)))
+
+
+def function_parameters(code):
+    """Argument names of the first function defined in `code`, read from the AST
+    rather than by running it like define_function. [] when there is none or the
+    code doesn't parse."""
+    try:
+        tree = ast.parse(code or '')
+    except SyntaxError:
+        return []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            return [arg.arg for arg in node.args.posonlyargs + node.args.args]
+    return []
+
+
+# errors that mean the code itself is broken, rather than its arguments or environment
+SMOKE_FATAL = ('SyntaxError', 'NameError', 'ImportError', 'ModuleNotFoundError', 'TypeError', 'AttributeError')
+SMOKE_LIMITS = {  # resource limits of a smoke call's process
+    'RLIMIT_AS': 512 * 1024 * 1024,  # bytes of memory
+    'RLIMIT_FSIZE': 16 * 1024 * 1024,  # bytes written to any one file
+    'RLIMIT_NOFILE': 64,
+    'RLIMIT_CORE': 0,
+}
+SMOKE_SCRIPT = '''
+import sys, json, resource
+data = json.load(sys.stdin)
+for name, limit in data['limits'].items():
+    resource.setrlimit(getattr(resource, name), (limit, limit))
+ns = {}
+try:
+    exec(data['code'], ns)
+    func = next(obj for name, obj in ns.items() if callable(obj))
+    func(**data['args'])
+except BaseException as e:
+    print('\\nsmoke_call: ' + type(e).__name__ + ': ' + str(e))
+'''
+
+
+def smoke_call(code, args, timeout=5):
+    """Calls the function defined in `code` with `args` in a separate python process,
+    started in an empty directory with none of the server's environment variables and
+    SMOKE_LIMITS (plus `timeout` seconds of CPU). This is no sandbox: the function has
+    the network and the server user's files, and whatever it does with `args` happens
+    again when it is run for real. Returns None when it passed, the error otherwise.
+    Exceptions that can come from the arguments or the environment (network, missing
+    credentials) pass."""
+    limits = dict(SMOKE_LIMITS, RLIMIT_CPU=timeout)
+    with tracing.span('smoke_call'), tempfile.TemporaryDirectory() as cwd:
+        try:
+            result = subprocess.run(
+                [sys.executable, '-I', '-c', SMOKE_SCRIPT],
+                input=json.dumps({'code': code, 'args': args, 'limits': limits}),
+                capture_output=True, text=True, timeout=timeout, cwd=cwd,
+                env={'PATH': os.defpath, 'HOME': cwd, 'TMPDIR': cwd},  # no API keys, PASSWORD, ...
+            )
+        except subprocess.TimeoutExpired:
+            return f'Timed out after {timeout}s'
+    _, marker, error = result.stdout.rpartition('\nsmoke_call: ')
+    error = error.strip() if marker else ''
+    if result.returncode:
+        return error or result.stderr.strip()[-500:] or f'Exited with {result.returncode}'
+    if error.split(':', 1)[0] in SMOKE_FATAL:
+        return error
+    return None
+
+
+def read_backwards(path, end=None, count=200, block_size=8192, max_bytes=256 * 1024):
+    """Reads up to `count` whole lines ending at byte offset `end` (default: end of file).
+    Returns the lines, the offset of the first one (the `end` of the previous page) and `end`."""
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size if end is None else max(0, min(int(end), size))
+        start, data = end, b''
+        while start > 0 and data.count(b'\n') <= count and end - start < max_bytes:
+            step = min(block_size, start)
+            start -= step
+            f.seek(start)
+            data = f.read(step) + data
+    lines = data.splitlines(keepends=True)
+    if start > 0 and len(lines) > 1:
+        lines = lines[1:]  # possibly cut in the middle
+    # else a line longer than max_bytes: its last max_bytes come back, the rest on the next page
+    lines = lines[-count:]
+    return [line.decode('utf-8', 'replace') for line in lines], end - sum(map(len, lines)), end
+
+
+def follow(path, offset=None, poll=0.5, duration=None):
+    """Yields (offset after the line, line) for lines appended to `path`, starting at `offset`
+    (default: end of file). Starts over when the file is rotated. Yields (offset, None) when idle."""
+    started = time.monotonic()
+    f, inode = None, None
+    try:
+        while duration is None or time.monotonic() - started < duration:
+            if f is None:
+                try:
+                    f = open(path, 'rb')
+                except FileNotFoundError:  # not written yet, or rotated away just now
+                    offset = 0
+                    yield offset, None
+                    time.sleep(poll)
+                    continue
+                inode = os.fstat(f.fileno()).st_ino
+                size = f.seek(0, os.SEEK_END)
+                f.seek(size if offset is None else min(int(offset), size))
+            line = f.readline()
+            if line.endswith(b'\n'):
+                yield f.tell(), line.decode('utf-8', 'replace')
+                continue
+            f.seek(f.tell() - len(line))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != inode or stat.st_size < f.tell():
+                f.close()
+                f, offset = None, 0
+                if stat is None:
+                    time.sleep(poll)
+                continue
+            yield f.tell(), None
+            time.sleep(poll)
+    finally:
+        if f is not None:
+            f.close()
@@ -0,0 +1,45 @@
+"""
+Tests run against a throwaway DATA_PATH, set before the application modules
+read it from the environment:
+
+    python -m unittest discover -s tests -t .
+"""
+import os
+import sys
+import tempfile
+
+os.environ['DATA_PATH'] = tempfile.mkdtemp(prefix='jinn-tests-')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+def fresh_database():
+    """Empty database with every table and migration, connected through macaron"""
+    import macaron
+    from config import DB_PATH
+    from models import BaseModel
+
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(f'{DB_PATH}{suffix}')
+        except FileNotFoundError:
+            pass
+    macaron.macaronage(DB_PATH)
+    BaseModel.create_tables()
+    return DB_PATH
+
+
+def add_incantation(master, name, code=None):
+    """An incantation of `master` whose function `name` upper-cases its text"""
+    import json
+
+    code = code or f'def {name}(text):\n    return text.upper()\n'
+    schema = {
+        'type': 'function',
+        'function': {
+            'name': name, 'description': f'{name} the text',
+            'parameters': {'type': 'object', 'properties': {'text': {'type': 'string'}}},
+        },
+    }
+    return master.incantations.append(
+        name=name, request=name, code=code, schema=json.dumps(schema), overrides='{}'
+    )
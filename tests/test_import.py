@@ -0,0 +1,91 @@
+import json
+import unittest
+
+import macaron
+from tests import fresh_database, add_incantation
+
+
+def failure(code):
+    """The exception `code`'s function raises for an empty text"""
+    namespace = {}
+    exec(code, namespace)
+    function = next(value for key, value in namespace.items() if not key.startswith('__'))
+    try:
+        function('')
+    except Exception as e:
+        return e
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_export_into_empty_database(self):
+        from models import Master, Mishap
+        fresh_database()
+        master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        add_incantation(master, 'shout')
+        broken = add_incantation(master, 'first', 'def first(text):\n    return text[0]\n')
+        Mishap.record(broken, '{"text": ""}', failure(broken.code))
+        macaron.bake()  # the export reads on its own connection
+        exported = list(master.export_incantations())
+
+        fresh_database()  # no code_blob rows for the imported versions to reference yet
+        master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        result = master.import_incantations(json.dumps(entry) for entry in exported)
+        macaron.bake()
+
+        self.assertEqual(result, {'imported': 2, 'skipped': 0, 'mishaps': 1})
+        self.assertEqual(list(master.export_incantations()), exported)
+        self.assertEqual([incantation.versions.count() for incantation in master.incantations], [1, 1])
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        from models import Master
+        fresh_database()
+        self.master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        self.known = add_incantation(self.master, 'shout')
+
+    def entry(self, name, code, mishaps=()):
+        return json.dumps({
+            'name': name, 'request': name, 'code': code, 'overrides': {}, 'mishaps': list(mishaps),
+            'schema': {'type': 'function', 'function': {'name': name, 'parameters': {'type': 'object'}}},
+        })
+
+    def test_new_duplicate_and_mishaps(self):
+        from models import Mishap, CodeBlob
+        code = 'def first(text):\n    return text[0]\n'
+        older = 'def first(text):\n    return text[1]\n'
+        mishaps = [
+            {'request': '{"text": ""}', 'code': code, 'traceback': 'IndexError: string index out of range',
+             'occurrences': 3, 'first_seen': 100, 'last_seen': 300, 'samples': ['{"text": ""}']},
+            {'request': '{"text": "a"}', 'code': older, 'traceback': 'IndexError: string index out of range',
+             'occurrences': 1, 'first_seen': 50, 'last_seen': 50},
+        ]
+        result = self.master.import_incantations([
+            self.entry('shout', self.known.code),  # the master has this code already
+            self.entry('first', code, mishaps),
+            '',
+            self.entry('first_again', code),  # the same code twice in one file
+        ])
+        macaron.bake()
+
+        self.assertEqual(result, {'imported': 1, 'skipped': 2, 'mishaps': 2})
+        self.assertEqual(sorted(i.name for i in self.master.incantations), ['first', 'shout'])
+        first = self.master.incantations.select('name=?', ['first']).get()
+        self.assertEqual(first.parameters, ['text'])
+        self.assertEqual([version.version for version in first.versions], [1])
+        rows = list(first.mishaps.order_by('first_seen'))
+        self.assertEqual([(m.code, m.occurrences, m.first_seen, m.last_seen) for m in rows], [
+            (older, 1, 50, 50), (code, 3, 100, 300)
+        ])
+        self.assertEqual(rows[0].samples_list, ['{"text": "a"}'])
+        self.assertEqual(len({m.fingerprint for m in rows}), 2)
+        self.assertEqual(CodeBlob.load(first.code_hash), code)
+        self.assertEqual(Mishap.select('incantation_id=?', [self.known.id]).count(), 0)
+
+    def test_malformed_line(self):
+        with self.assertRaisesRegex(ValueError, r'^Line 2: KeyError'):
+            self.master.import_incantations([self.entry('first', 'def first(text):\n    pass\n'), '{"name": "x"}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
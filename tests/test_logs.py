@@ -0,0 +1,47 @@
+import io
+import json
+import logging
+import unittest
+
+import logs
+
+
+class OffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        handler = logging.StreamHandler(self.stream)
+        handler.setFormatter(logs.JSONFormatter())
+        self.logger = logging.getLogger('jinn_test_offload')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(handler)
+        logs.offload(self.logger)
+        self.addCleanup(logs._offloaded.remove, self.logger.handlers[0])
+        self.addCleanup(self.logger.handlers.clear)
+
+    def written(self):
+        logs.stop()  # drains the queue
+        logs.start()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_exception_is_formatted_by_the_writer(self):
+        try:
+            {}['missing']
+        except KeyError:
+            self.logger.exception('Failed %s', 'lookup')
+        entry, = self.written()
+        self.assertEqual(entry['message'], 'Failed lookup')
+        self.assertIn("KeyError: 'missing'", entry['exception'])
+        self.assertIn('Traceback', entry['exception'])
+
+    def test_message_resolved_when_logged(self):
+        items = ['a']
+        self.logger.info('items: %s', items)
+        items.append('b')
+        entry, = self.written()
+        self.assertEqual(entry['message'], "items: ['a']")
+        self.assertNotIn('exception', entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,351 @@
+import io
+import sqlite3
+import unittest
+import contextlib
+from unittest import mock
+
+import macaron
+from tests import fresh_database, add_incantation
+
+
+class ModelTestCase(unittest.TestCase):
+    def setUp(self):
+        from models import Master
+        fresh_database()
+        self.master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        self.incantation = add_incantation(self.master, 'shout')
+
+    def mishap(self, incantation, error):
+        from models import Mishap
+        Mishap.record(incantation, '{}', error)
+        return Mishap.select('mishap.fingerprint IS NOT NULL').order_by('-id').limit(1).get()
+
+
+class IdentityMapTest(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = self.mishap(self.incantation, 'KeyError: a')
+        self.second = self.mishap(self.incantation, 'KeyError: b')
+
+    def incantation_of(self, mishap):
+        from models import Mishap
+        return Mishap.get(mishap.id).incantation
+
+    def test_one_object_per_primary_key(self):
+        from models import Mishap
+        self.assertIsNot(self.incantation_of(self.first), self.incantation_of(self.second))
+        with macaron.identity_map():
+            incantation = self.incantation_of(self.first)
+            self.assertIs(self.incantation_of(self.second), incantation)
+            related = Mishap.select('mishap.incantation_id=?', [self.incantation.id]).select_related('incantation')
+            self.assertEqual([mishap.incantation for mishap in related], [incantation, incantation])
+            self.assertTrue(all(mishap.incantation is incantation for mishap in related))
+            with macaron.identity_map():
+                self.assertIsNot(self.incantation_of(self.first), incantation)
+            self.assertIs(self.incantation_of(self.first), incantation)
+
+    def test_fresh_after_save(self):
+        from models import Incantation
+        with macaron.identity_map():
+            stale = self.incantation_of(self.first)
+            saved = Incantation.get(self.incantation.id)
+            saved.request = 'renamed'
+            saved.save()
+            self.assertIs(self.incantation_of(self.first), saved)
+            self.assertEqual(stale.request, 'shout')
+
+    def test_fresh_after_update(self):
+        from models import Incantation
+        with macaron.identity_map():
+            stale = self.incantation_of(self.first)
+            self.assertEqual(Incantation.select('id=?', [self.incantation.id]).update(request='updated'), 1)
+            fresh = self.incantation_of(self.first)
+            self.assertIsNot(fresh, stale)
+            self.assertEqual(fresh.request, 'updated')
+
+    def test_gone_after_delete(self):
+        from models import PipelineStep
+        pipeline = self.master.create_pipeline('p', [{'incantation': self.incantation.id}])
+        with macaron.identity_map():
+            step = PipelineStep.get('pipeline_id=?', [pipeline.id])
+            self.assertEqual(step.pipeline.name, 'p')
+            step.delete()
+            pipeline.delete()
+            self.assertIsNone(step.pipeline)
+
+
+class SelectRelatedTest(ModelTestCase):
+    def test_missing_target(self):
+        from models import Mishap
+        mishap = self.mishap(self.incantation, 'KeyError: a')
+        macaron.bake()
+        macaron.execute('PRAGMA foreign_keys = OFF')
+        self.addCleanup(macaron.execute, 'PRAGMA foreign_keys = ON')
+        macaron.execute('UPDATE mishap SET incantation_id = 999 WHERE id = ?', [mishap.id])
+        loaded = Mishap.select('mishap.id=?', [mishap.id]).select_related('incantation').get()
+        self.assertEqual(loaded.incantation_id, 999)
+        self.assertIsNone(loaded.incantation)
+        self.assertIsNone(Mishap.get(mishap.id).incantation)
+        self.assertIsNone(self.master.mishap(mishap.id))
+
+    def test_changed_key(self):
+        from models import Mishap
+        other = add_incantation(self.master, 'whisper')
+        mishap = Mishap.select('mishap.id=?', [self.mishap(self.incantation, 'E').id]).select_related('incantation').get()
+        mishap.incantation_id = other.id
+        self.assertEqual(mishap.incantation.name, 'whisper')
+
+    def test_qualified_columns(self):
+        from models import Mishap
+        first, second = self.mishap(self.incantation, 'E1'), self.mishap(self.incantation, 'E2')
+        related = Mishap.select().select_related('incantation')
+        self.assertEqual([mishap.id for mishap in related.order_by('-id')], [second.id, first.id])
+        self.assertEqual(related.get(first.id).incantation.name, 'shout')
+        with self.assertRaisesRegex(sqlite3.OperationalError, 'ambiguous column name: id'), \
+                contextlib.redirect_stderr(io.StringIO()):  # macaron prints the failed SQL
+            related.select('id=?', [first.id]).get()
+
+    def test_other_masters_mishap(self):
+        from models import Master
+        mishap = self.mishap(self.incantation, 'KeyError: a')
+        other = Master.create(moniker='o', code_phrase='y', token='u', verified=1)
+        self.assertIsNone(other.mishap(mishap.id))
+        self.assertEqual(self.master.mishap(mishap.id).id, mishap.id)
+        self.assertIsNone(self.master.mishap(mishap.id + 1))
+
+
+class PrefetchRelatedTest(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.master.create_pipeline('p', [{'incantation': self.incantation.id}] * 2)
+
+    def pipeline(self):
+        pipelines = list(self.master.pipelines.prefetch_related('steps'))
+        self.assertIsNotNone(pipelines[0].steps._prefetched)
+        return pipelines[0]
+
+    def test_prefetched(self):
+        pipeline = self.pipeline()
+        self.assertEqual([step.position for step in pipeline.steps], [1, 2])
+
+    def test_append_invalidates(self):
+        pipeline = self.pipeline()
+        pipeline.steps.append(incantation_id=self.incantation.id, position=3, mapping='{}')
+        self.assertIsNone(pipeline.steps._prefetched)
+        self.assertEqual(sorted(step.position for step in pipeline.steps), [1, 2, 3])
+
+    def test_extend_invalidates(self):
+        pipeline = self.pipeline()
+        pipeline.steps.extend([{'incantation_id': self.incantation.id, 'position': 3, 'mapping': '{}'}])
+        self.assertEqual(sorted(step.position for step in pipeline.steps), [1, 2, 3])
+
+
+class UpdateTest(ModelTestCase):
+    def test_update(self):
+        from models import Incantation
+        other = add_incantation(self.master, 'whisper')
+        self.assertEqual(Incantation.select('name=?', ['shout']).update(request='loud'), 1)
+        self.assertEqual(Incantation.all().update(master=self.master, overrides='{"a": 1}'), 2)
+        self.assertEqual([i.request for i in Incantation.all().order_by('id')], ['loud', 'whisper'])
+        self.assertEqual(Incantation.get(other.id).overrides, '{"a": 1}')
+        self.assertEqual(Incantation.select('name=?', ['none']).update(request='x'), 0)
+
+    def test_invalid(self):
+        from models import Incantation
+        with self.assertRaisesRegex(ValueError, 'at least one field'):
+            Incantation.all().update()
+        with self.assertRaisesRegex(ValueError, "Invalid column name 'nope'"):
+            Incantation.all().update(nope=1)
+
+
+class BulkCreateTest(ModelTestCase):
+    def test_count(self):
+        from models import Pipeline
+        pipelines = [{'name': f'p{i}', 'master_id': self.master.id} for i in range(7)]
+        self.assertEqual(Pipeline.bulk_create(pipelines, batch_size=3), 7)
+        self.assertEqual(Pipeline.select('master_id=?', [self.master.id]).count(), 7)
+        self.assertEqual(Pipeline.bulk_create([]), 0)
+
+    def test_returning(self):
+        from models import Pipeline
+        objects = [Pipeline(name='a', master_id=self.master.id), Pipeline(name='b', master_id=self.master.id)]
+        pks = Pipeline.bulk_create(
+            objects + [{'name': 'c', 'master_id': self.master.id}], batch_size=2, returning=True
+        )
+        self.assertEqual(pks, [obj.pk for obj in objects] + [pks[-1]])
+        self.assertEqual([Pipeline.get(pk).name for pk in pks], ['a', 'b', 'c'])
+
+    def test_explicit_and_implicit_keys(self):
+        from models import Pipeline
+        rows = [
+            {'id': 100, 'name': 'explicit', 'master_id': self.master.id},
+            {'name': 'implicit', 'master_id': self.master.id},
+        ]
+        self.assertEqual(Pipeline.bulk_create(rows), 2)
+        self.assertEqual(Pipeline.get(100).name, 'explicit')
+        self.assertEqual(Pipeline.get('name=?', ['implicit']).name, 'implicit')
+        rows = [{'name': 'next', 'master_id': self.master.id}, {'id': 200, 'name': 'x', 'master_id': self.master.id}]
+        self.assertEqual(Pipeline.bulk_create(rows, returning=True), [102, 200])  # 'implicit' got 101
+
+    def test_after_create_skipped(self):
+        from models import Incantation, IncantationVersion
+        code = 'def whisper(text):\n    return text.lower()\n'
+        self.assertEqual(Incantation.bulk_create([{
+            'name': 'whisper', 'master_id': self.master.id, 'request': 'r', 'code': code,
+            'schema': '{"function": {"name": "whisper"}}', 'overrides': '{}',
+        }]), 1)
+        incantation = Incantation.get('name=?', ['whisper'])
+        self.assertEqual(incantation.parameters, ['text'])  # before_save still runs
+        self.assertEqual(IncantationVersion.select('incantation_id=?', [incantation.id]).count(), 0)
+
+    def test_extend(self):
+        pipeline = self.master.pipelines.append(name='p')
+        steps = [{'incantation_id': self.incantation.id, 'position': i, 'mapping': '{}'} for i in (1, 2)]
+        self.assertEqual(pipeline.steps.extend(steps), 2)
+        from models import PipelineStep
+        step = PipelineStep(incantation_id=self.incantation.id, position=3, mapping='{}')
+        self.assertEqual(pipeline.steps.extend([step], returning=True), [step.pk])
+        self.assertEqual(step.pipeline_id, pipeline.id)
+        self.assertEqual(sorted(step.position for step in pipeline.steps), [1, 2, 3])
+
+
+class SQLCacheTest(ModelTestCase):
+    def queries(self):
+        from models import Incantation, Mishap
+        base = Incantation.select('master_id=?', [self.master.id])
+        return [
+            base, base.select('name=?', ['shout']), base.select('name=?', ['shout']).order_by('id'),
+            base.order_by('-id'), base.order_by('-id').limit(1), base.order_by('-id').limit(2),
+            base.limit(1).offset(1), base.distinct(), base.values_list('name', flat=True),
+            Incantation.select(master=self.master), Mishap.select().select_related('incantation'),
+            Mishap.select(incantation__name='shout'), Incantation.select('id > ?', [0]),
+        ]
+
+    def test_different_clauses_different_sql(self):
+        sqls = [query.sql for query in self.queries()]
+        self.assertEqual(len(set(sqls)), len(sqls))
+        for query, sql in zip(self.queries(), sqls):
+            self.assertEqual(sql, query._build_sql())
+
+    def test_cache_cleared_when_full(self):
+        macaron._sql_cache.clear()
+        with mock.patch.object(macaron, 'SQL_CACHE_SIZE', 3):
+            for _ in range(2):
+                for query in self.queries():
+                    self.assertEqual(query.sql, query._build_sql())
+                    self.assertLessEqual(len(macaron._sql_cache), 3)
+            self.assertEqual([i.name for i in self.queries()[1]], ['shout'])
+
+    def test_clauses_are_flat(self):
+        # QuerySet.__init__ copies the clauses shallowly, which is only safe while they hold
+        # nothing but scalars and flat lists of them
+        from models import Pipeline
+        queries = self.queries() + [self.master.pipelines.prefetch_related('steps'), Pipeline.select(steps__position=1)]
+        for query in queries:
+            for name, value in query.clauses.items():
+                for item in value if isinstance(value, list) else [value]:
+                    self.assertIsInstance(item, (str, int, float, bool, type(None)), (name, value))
+        parent = queries[1]
+        before = {name: list(value) if isinstance(value, list) else value for name, value in parent.clauses.items()}
+        parent.select('id=?', [1]).order_by('name').select_related('master').prefetch_related('mishaps')
+        self.assertEqual(parent.clauses, before)
+
+
+class PreparedTest(ModelTestCase):
+    def test_lookups(self):
+        from models import Incantation
+        add_incantation(self.master, 'whisper')
+        query = Incantation.prepared('master_id=?')
+        self.assertIs(Incantation.prepared('master_id=?'), query)
+        self.assertEqual(sorted(i.name for i in query(self.master.id)), ['shout', 'whisper'])
+        self.assertEqual(query(self.master.id + 1), [])
+        self.assertEqual(Incantation.prepared('name=?').get('whisper').master_id, self.master.id)
+        with self.assertRaises(Incantation.DoesNotExist):
+            Incantation.prepared('name=?').get('nothing')
+        with self.assertRaises(macaron.MultipleObjectsReturned):
+            query.get(self.master.id)
+
+    def test_bound_values_rejected(self):
+        from models import Incantation
+        with self.assertRaisesRegex(ValueError, 'takes its parameters when called'):
+            Incantation.select('name=?', ['shout']).prepared()
+        with self.assertRaises(ValueError):
+            Incantation.select(name='shout').prepared()
+
+    def test_select_related(self):
+        from models import Mishap
+        mishap = self.mishap(self.incantation, 'KeyError: a')
+        query = Mishap.select('mishap.id=?').select_related('incantation').prepared()
+        self.assertEqual(query.get(mishap.id).incantation.name, 'shout')
+
+
+class IteratorTest(ModelTestCase):
+    def pipelines(self, count):
+        from models import Pipeline
+        Pipeline.bulk_create({'name': f'p{i}', 'master_id': self.master.id} for i in range(count))
+        return Pipeline.select('master_id=?', [self.master.id]).order_by('id')
+
+    def test_chunk_boundaries(self):
+        from models import Pipeline
+        for count in (0, 2, 3, 4, 6, 7):
+            with self.subTest(count=count):
+                Pipeline.all().delete()
+                query = self.pipelines(count)
+                names = [pipeline.name for pipeline in query.iterator(chunk_size=3)]
+                self.assertEqual(names, [f'p{i}' for i in range(count)])
+                self.assertEqual(query._cache, [])  # nothing kept
+
+    def test_select_related(self):
+        from models import Mishap
+        for error in ('E1', 'E2', 'E3'):
+            self.mishap(self.incantation, error)
+        query = Mishap.select().select_related('incantation').order_by('id')
+        mishaps = list(query.iterator(chunk_size=2))
+        self.assertEqual(len(mishaps), 3)
+        for mishap in mishaps:
+            self.assertIn('incantation', mishap.__dict__['_related'])  # loaded with the chunk
+            self.assertEqual(mishap.incantation.name, 'shout')
+
+    def test_prefetch_related(self):
+        for name in ('a', 'b', 'c'):
+            self.master.create_pipeline(name, [{'incantation': self.incantation.id}] * len(name * 2))
+        query = self.master.pipelines.order_by('id').prefetch_related('steps')
+        pipelines = list(query.iterator(chunk_size=2))
+        self.assertEqual([pipeline.name for pipeline in pipelines], ['a', 'b', 'c'])
+        for pipeline in pipelines:
+            self.assertIsNotNone(pipeline.steps._prefetched)
+            self.assertEqual(len(list(pipeline.steps)), 2)
+
+
+class ValuesListTest(ModelTestCase):
+    def test_tuples_and_flat(self):
+        from models import Incantation
+        add_incantation(self.master, 'whisper')
+        query = Incantation.all().order_by('id')
+        self.assertEqual(list(query.values_list('name', 'master_id')), [('shout', 1), ('whisper', 1)])
+        self.assertEqual(list(query.values_list('name', flat=True)), ['shout', 'whisper'])
+        self.assertEqual(list(query.values_list('name', flat=True).iterator(chunk_size=1)), ['shout', 'whisper'])
+        self.assertEqual(len(next(iter(query.values_list()))), len(Incantation._meta.fields))
+
+    def test_related_loading_dropped(self):
+        from models import Mishap
+        mishap = self.mishap(self.incantation, 'E')
+        query = Mishap.select().select_related('incantation').values_list('id', flat=True)
+        self.assertEqual(list(query), [mishap.id])
+        query = self.master.pipelines.prefetch_related('steps').values_list('name', flat=True)
+        self.assertEqual(list(query), [])
+
+    def test_errors(self):
+        from models import Incantation
+        with self.assertRaisesRegex(ValueError, 'single field'):
+            Incantation.all().values_list('id', 'name', flat=True)
+        with self.assertRaisesRegex(ValueError, 'single field'):
+            Incantation.all().values_list(flat=True)
+        with self.assertRaisesRegex(ValueError, "Invalid column name 'nope'"):
+            Incantation.all().values_list('nope')
+        with self.assertRaisesRegex(TypeError, 'flatten'):
+            Incantation.all().values_list('id', flatten=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
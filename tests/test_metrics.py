@@ -0,0 +1,43 @@
+import gc
+import threading
+import unittest
+
+import metrics
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.counter = metrics.Counter('test_counter_total', 'test', ('kind',))
+        self.histogram = metrics.Histogram('test_seconds', 'test', buckets=(1, 2))
+        self.addCleanup(metrics.REGISTRY.remove, self.counter)
+        self.addCleanup(metrics.REGISTRY.remove, self.histogram)
+
+    def run_threads(self, count):
+        def work():
+            self.counter.inc(kind='a')
+            self.histogram.observe(1.5)
+        threads = [threading.Thread(target=work) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gc.collect()
+
+    def test_ended_threads_are_folded(self):
+        self.run_threads(50)
+        self.run_threads(50)
+        self.assertEqual(len(self.counter._shards), 0)
+        self.assertEqual(len(self.histogram._shards), 0)
+        self.assertEqual(self.counter._collect(), {('a',): 100})
+        self.assertEqual(self.histogram._collect(), {(): [0, 100, 0, 150.0, 100]})
+
+    def test_live_and_ended_shards_add_up(self):
+        self.run_threads(3)
+        self.counter.inc(kind='a')
+        self.counter.inc(kind='b')
+        self.assertEqual(len(self.counter._shards), 1)
+        self.assertEqual(self.counter._collect(), {('a',): 4, ('b',): 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import sqlite3
+import unittest
+
+from tests import fresh_database
+
+
+class IndexUsageTest(unittest.TestCase):
+    """The hot lookups are answered from the indexes added by MIGRATIONS"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = sqlite3.connect(fresh_database())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+
+    def plan(self, sql, params):
+        return ' '.join(row[-1] for row in self.conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+
+    def assertUsesIndex(self, sql, params, index):
+        plan = self.plan(sql, params)
+        self.assertRegex(plan, rf'USING (COVERING )?INDEX {index}\b', plan)
+
+    def test_user_version(self):
+        from models import MIGRATIONS
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        self.assertEqual(version, MIGRATIONS[-1][0])
+
+    def test_master_by_token(self):
+        self.assertUsesIndex('SELECT * FROM master WHERE token = ?', ['t'], 'master_token')
+
+    def test_incantations_page(self):
+        self.assertUsesIndex(
+            'SELECT id, name, description FROM incantation WHERE master_id = ? AND id > ? ORDER BY id LIMIT 50',
+            [1, 0], 'incantation_master_id_id'
+        )
+
+    def test_incantation_of_master(self):
+        # the primary key beats any index here, what matters is that nothing is scanned
+        plan = self.plan('SELECT * FROM incantation WHERE master_id = ? AND id = ?', [1, 1])
+        self.assertIn('SEARCH', plan)
+        self.assertNotIn('SCAN', plan)
+
+    def test_incantation_by_code_hash(self):
+        self.assertUsesIndex(
+            'SELECT id FROM incantation WHERE master_id = ? AND code_hash = ?', [1, 'h'], 'incantation_master_code_hash'
+        )
+
+    def test_mishaps_of_incantation(self):
+        self.assertUsesIndex(
+            'SELECT * FROM mishap WHERE incantation_id = ? AND id < ? ORDER BY id DESC LIMIT 20',
+            [1, 100], 'mishap_incantation_id'
+        )
+
+    def test_mishap_by_fingerprint(self):
+        self.assertUsesIndex('SELECT id FROM mishap WHERE fingerprint = ?', ['f'], 'mishap_fingerprint')
+
+    def test_pipeline_steps(self):
+        self.assertUsesIndex(
+            'SELECT * FROM pipeline_step WHERE pipeline_id = ? ORDER BY position', [1], 'pipeline_step_pipeline_id'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
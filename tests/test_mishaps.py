@@ -0,0 +1,76 @@
+import json
+import unittest
+
+import macaron
+from tests import fresh_database, add_incantation
+from models import mishap_fingerprint
+
+CODE = 'def pick(data, key):\n    return data[key]\n'
+
+
+def traceback(error, line=2, caller='execute', function='pick'):
+    return (
+        'Traceback (most recent call last):\n'
+        f'  File "/srv/jinn/models.py", line 391, in {caller}\n'
+        "    return {'result': func(**args)}\n"
+        f'  File "<string>", line {line}, in {function}\n'
+        f'{error}\n'
+    )
+
+
+class FingerprintTest(unittest.TestCase):
+    def assertSame(self, first, second):
+        self.assertEqual(mishap_fingerprint(1, CODE, first), mishap_fingerprint(1, CODE, second))
+
+    def assertDifferent(self, first, second):
+        self.assertNotEqual(mishap_fingerprint(1, CODE, first), mishap_fingerprint(1, CODE, second))
+
+    def test_grouped(self):
+        self.assertSame(
+            traceback('TypeError: <object object at 0x7f3a2c1e0f30> is not subscriptable'),
+            traceback('TypeError: <object object at 0x7f3a2c1e1b40> is not subscriptable'),
+        )
+        self.assertSame(
+            traceback("KeyError: 'user 1697712345'"),
+            traceback("KeyError: 'user 1697798765'"),
+        )
+        self.assertSame(
+            traceback("KeyError: '6f1c2a9e-3b7d-4e21-9a0c-5d8e7f6a1b2c'"),
+            traceback("KeyError: 'a0b1c2d3-e4f5-4a6b-8c7d-9e0f1a2b3c4d'"),
+        )
+        # the same failure, whichever way the incantation was called
+        self.assertSame(traceback("KeyError: 'a'"), traceback("KeyError: 'a'", caller='retry'))
+
+    def test_separate(self):
+        self.assertDifferent(traceback("KeyError: 'a'"), traceback("KeyError: 'b'"))
+        self.assertDifferent(traceback("KeyError: 'a'"), traceback("IndexError: 'a'"))
+        self.assertDifferent(traceback("KeyError: 'a'", line=2), traceback("KeyError: 'a'", line=3))
+        self.assertDifferent(traceback('ValueError: 12'), traceback('ValueError: 13'))
+        self.assertNotEqual(
+            mishap_fingerprint(1, CODE, traceback("KeyError: 'a'")),
+            mishap_fingerprint(2, CODE, traceback("KeyError: 'a'")),
+        )
+
+    def test_not_a_traceback(self):
+        self.assertSame('Timed out after 5s', 'Timed out after 5s')
+        self.assertDifferent('Timed out after 5s', 'Exited with 1')
+
+
+class RecordTest(unittest.TestCase):
+    def test_occurrences(self):
+        from models import Master, Mishap
+        fresh_database()
+        master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        incantation = add_incantation(master, 'pick', CODE)
+        for data, key in (({}, 'a'), ({}, 'a'), ({}, 'b'), ([], 5)):
+            try:
+                incantation.execute({'args': json.dumps({'data': data, 'key': key})})
+            except Exception as e:
+                Mishap.record(incantation, repr((data, key)), e)
+        macaron.bake()
+        counts = sorted(mishap.occurrences for mishap in incantation.mishaps)
+        self.assertEqual(counts, [1, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from tests import fresh_database, add_incantation
+
+
+class IncantationPipelinesTest(unittest.TestCase):
+    def setUp(self):
+        fresh_database()
+        from models import Master
+        self.master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        self.used, self.unused = add_incantation(self.master, 'used'), add_incantation(self.master, 'unused')
+
+    def test_pipelines_of_incantation(self):
+        self.master.create_pipeline('second', [{'incantation': self.used.id}])
+        self.master.create_pipeline('first', [{'incantation': self.unused.id}, {'incantation': self.used.id}])
+        self.assertEqual([pipeline.name for pipeline in self.used.pipelines], ['first', 'second'])
+        self.assertEqual([pipeline.name for pipeline in self.unused.pipelines], ['first'])
+
+    def test_deleted_pipeline_releases_incantation(self):
+        pipeline = self.master.create_pipeline('only', [{'incantation': self.used.id}])
+        self.master.delete_pipeline(pipeline.id)
+        self.assertEqual(list(self.used.pipelines), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import time
+import threading
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+
+import services
+
+
+class Incantation:
+    def __init__(self, delay, result):
+        self.delay, self.result = delay, result
+
+    def execute(self, request):
+        time.sleep(self.delay)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return {'result': self.result, 'thread': threading.current_thread().name}
+
+
+def tool_call(name, arguments='{}'):
+    return SimpleNamespace(function=SimpleNamespace(name=name, arguments=arguments))
+
+
+class ExecuteCallsTest(unittest.TestCase):
+    def test_results_in_order(self):
+        error = ValueError('nope')
+        incantations = {
+            'slow': {'object': Incantation(0.2, [1, 2])},
+            'fast': {'object': Incantation(0, {'results': 'mine'})},
+            'bad': {'object': Incantation(0, error)},
+        }
+        calls = [tool_call('slow'), tool_call('unknown'), tool_call('fast'), tool_call('bad')]
+        results = services.execute_calls(incantations, calls)
+        self.assertEqual([result for _, _, result in results], [[1, 2], {'results': 'mine'}, error])
+        self.assertNotIsInstance(results[0][2], services.CallResults)
+
+    def test_timeout(self):
+        incantations = {'hung': {'object': Incantation(1, 'late')}, 'fast': {'object': Incantation(0, 'ok')}}
+        start = time.monotonic()
+        with mock.patch.object(services, 'CALL_TIMEOUT', 0.2):
+            results = services.execute_calls(incantations, [tool_call('hung'), tool_call('fast')])
+        self.assertLess(time.monotonic() - start, 0.9)
+        (hung, _, error), (_, _, result) = results
+        self.assertIs(hung, incantations['hung']['object'])
+        self.assertIsInstance(error, TimeoutError)
+        self.assertEqual(str(error), 'hung did not finish within 0.2s')
+        self.assertEqual(result, 'ok')
+
+    def test_calls_share_the_executor(self):
+        incantations = {'a': {'object': Incantation(0, 1)}, 'b': {'object': Incantation(0, 2)}}
+        threads = services.executor._max_workers
+        for _ in range(3 * threads):
+            services.execute_calls(incantations, [tool_call('a'), tool_call('b')])
+        self.assertLessEqual(len(services.executor._threads), threads)
+
+
+class PickCandidateTest(unittest.TestCase):
+    def smoke(self, number):
+        return None if number > 10 else f'{number} is too small'
+
+    def test_errors_stay_with_their_candidate(self):
+        failures = services._pick_candidate(['1', 'x', '2'], int, self.smoke)
+        self.assertEqual(
+            sorted((content, str(error)) for content, error in failures),
+            [('1', '1 is too small'), ('2', '2 is too small'), ('x', "invalid literal for int() with base 10: 'x'")]
+        )
+
+    def test_first_passing(self):
+        self.assertEqual(services._pick_candidate(['x', '5', '20'], int, self.smoke), 20)
+        self.assertEqual(services._pick_candidate(['x', '5'], int), 5)
+        self.assertEqual(services._pick_candidate([], int, self.smoke), [])
+
+
+class CraftRetryTest(unittest.TestCase):
+    def test_retry_shows_the_failing_candidate_its_error(self):
+        answers = [['def broken(:', 'not python at all'], []]
+        with mock.patch.object(services, '_candidates', side_effect=answers) as candidates:
+            error = services.craft_incantation('key', 'model', 2, 'anything', candidates=2)
+        messages = candidates.call_args_list[0].args[3]  # the list the retry appended to
+        self.assertEqual(messages[1], {'role': 'assistant', 'content': 'def broken(:'})
+        self.assertIn('SyntaxError', messages[2]['content'])
+        self.assertIsInstance(error, RuntimeError)  # the second response had no candidates
+        self.assertEqual(str(error), 'The response had no candidates')
+
+
+if __name__ == '__main__':
+    unittest.main()
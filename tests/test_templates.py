@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+import bottle
+import templates
+
+MODULE = '''
+import templates
+
+def one():
+    return templates.template("""one {{value}}""", value=1)
+
+def two():
+    return templates.template("""%s {{value}}""", value=2)
+'''
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.py')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.addCleanup(templates.invalidate)
+        self.write('two')
+        self.assertEqual(templates.precompile(self.path), 2)
+
+    def write(self, second):
+        with open(self.path, 'w') as f:
+            f.write(MODULE % second)
+        os.utime(self.path, (0, os.stat(self.path).st_mtime + 1))  # a distinct mtime on any filesystem
+
+    def test_precompiled(self):
+        tpl = templates._compiled[templates._key('one {{value}}')]
+        self.assertIn('co', vars(tpl))  # compiled before the first render
+        self.assertEqual(tpl.filename, f'<template {os.path.basename(self.path)}:5>')
+
+    def test_edited_module(self):
+        one = templates.compiled('one {{value}}')
+        self.write('deux')
+        debug, bottle.DEBUG = bottle.DEBUG, True
+        self.addCleanup(setattr, bottle, 'DEBUG', debug)
+
+        self.assertEqual(templates.template('one {{value}}', value=1), 'one 1')
+        self.assertIs(templates.compiled('one {{value}}'), one)  # unchanged, not compiled again
+        self.assertNotIn(templates._key('two {{value}}'), templates._compiled)
+        self.assertNotIn(templates._key('deux {{value}}'), templates._compiled)  # until rendered
+
+        self.assertEqual(templates.template('deux {{value}}', value=2), 'deux 2')
+        tpl = templates._compiled[templates._key('deux {{value}}')]
+        self.assertEqual(tpl.filename, f'<template {os.path.basename(self.path)}:8>')
+
+
+if __name__ == '__main__':
+    unittest.main()
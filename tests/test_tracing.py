@@ -0,0 +1,36 @@
+import unittest
+from unittest import mock
+
+import tracing
+
+
+class SpanLimitTest(unittest.TestCase):
+    def trace(self, spans):
+        trace = tracing.Trace('test')
+        token = tracing._trace.set(trace)
+        try:
+            with tracing._span(trace, 'request', {}):
+                for i in range(spans):
+                    with tracing.span('sql', number=i):
+                        with tracing.span('inner'):
+                            pass
+        finally:
+            tracing._trace.reset(token)
+        return trace
+
+    def test_spans_past_the_limit_are_counted(self):
+        with mock.patch.object(tracing, 'TRACE_SPANS', 11):
+            trace = self.trace(10)
+        exported = trace.export()
+        self.assertEqual(len(exported['spans']), 11)
+        self.assertEqual(exported['dropped'], 10)
+        self.assertEqual([span['depth'] for span in exported['spans'][:3]], [0, 1, 2])
+        self.assertEqual(exported['spans'][-1]['name'], 'inner')
+
+    def test_under_the_limit(self):
+        exported = self.trace(3).export()
+        self.assertEqual((len(exported['spans']), exported['dropped']), (7, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from utils import read_backwards, follow, smoke_call
+
+
+class ReadBackwardsTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def pages(self, **kwargs):
+        """Every page from the end, as read_backwards() is paged by the log view"""
+        pages, end = [], None
+        while end != 0:
+            lines, start, _ = read_backwards(self.path, end, **kwargs)
+            self.assertNotEqual(start, end, 'paging is stuck')
+            pages.append(lines)
+            end = start
+        return pages
+
+    def test_pages_whole_lines(self):
+        self.write(b''.join(b'line %d\n' % i for i in range(10)))
+        pages = self.pages(count=4, block_size=8)
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        self.assertEqual(''.join(line for page in reversed(pages) for line in page),
+                         ''.join('line %d\n' % i for i in range(10)))
+
+    def test_line_longer_than_max_bytes(self):
+        self.write(b'first\n' + b'x' * 100 + b'\nlast\n')
+        pages = self.pages(count=10, block_size=16, max_bytes=32)
+        self.assertEqual(pages[0], ['last\n'])
+        self.assertTrue(all(pages), 'no page comes back empty')
+        self.assertEqual(''.join(line for page in reversed(pages) for line in page),
+                         'first\n' + 'x' * 100 + '\nlast\n')
+
+
+class FollowTest(unittest.TestCase):
+    def test_file_created_later(self):
+        path = os.path.join(tempfile.mkdtemp(), 'later.log')
+        lines = follow(path, poll=0.01, duration=5)
+        self.assertEqual(next(lines), (0, None))
+        with open(path, 'w') as f:
+            f.write('hello\n')
+        line = next(line for _, line in lines if line is not None)
+        self.assertEqual(line, 'hello\n')
+        lines.close()
+
+
+class SmokeCallTest(unittest.TestCase):
+    def test_passes_and_fails(self):
+        self.assertIsNone(smoke_call('def f(x):\n    return x + 1\n', {'x': 1}))
+        self.assertIsNone(smoke_call('def f(x):\n    raise ConnectionError(x)\n', {'x': 'down'}))
+        self.assertRegex(smoke_call('def f(x):\n    return y\n', {'x': 1}), r"^NameError: name 'y'")
+
+    def test_environment_is_scrubbed(self):
+        os.environ['SMOKE_SECRET'] = 'hunter2'
+        self.addCleanup(os.environ.pop, 'SMOKE_SECRET')
+        code = 'def f(name):\n    import os\n    if name in os.environ:\n        raise TypeError(os.environ[name])\n'
+        self.assertIsNone(smoke_call(code, {'name': 'SMOKE_SECRET'}))
+        self.assertIsNone(smoke_call(code, {'name': 'OPENAI_API_KEY'}))
+
+    def test_limits(self):
+        code = 'def f():\n    import resource\n    raise TypeError(resource.getrlimit(resource.RLIMIT_AS)[0])\n'
+        self.assertEqual(smoke_call(code, {}), f'TypeError: {512 * 1024 * 1024}')
+        self.assertEqual(smoke_call('def f():\n    while True:\n        pass\n', {}, timeout=1), 'Timed out after 1s')
+
+
+if __name__ == '__main__':
+    unittest.main()
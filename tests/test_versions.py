@@ -0,0 +1,57 @@
+import json
+import unittest
+
+import utils
+from tests import fresh_database, add_incantation
+
+
+class VersionHistoryTest(unittest.TestCase):
+    def setUp(self):
+        from models import Master
+        fresh_database()
+        master = Master.create(moniker='m', code_phrase='x', token='t', verified=1)
+        self.incantation = add_incantation(master, 'shout')
+
+    def adjust(self):
+        incantation = self.incantation
+        incantation.code = 'def shout(text, times):\n    return text.upper() * times\n'
+        schema = json.loads(incantation.schema)
+        schema['function']['parameters']['properties']['times'] = {'type': 'integer'}
+        incantation.schema = json.dumps(schema)
+        incantation.save()
+
+    def versions(self):
+        return [(v.version, v.code_hash) for v in self.incantation.versions]
+
+    def test_rollback(self):
+        from models import Incantation
+        first = self.incantation.code_hash
+        self.assertEqual(self.versions(), [(1, first)])
+        self.adjust()
+        second = self.incantation.code_hash
+        self.assertEqual(self.incantation.parameters, ['text', 'times'])
+        self.assertEqual(self.versions(), [(2, second), (1, first)])
+
+        self.assertIs(self.incantation.rollback(1), self.incantation)
+        self.assertEqual(self.versions(), [(3, first), (2, second), (1, first)])
+        stored = Incantation.get(self.incantation.id)
+        self.assertEqual(stored.code_hash, first)
+        self.assertEqual(stored.parameters, ['text'])
+        self.assertEqual(stored.execute({'args': '{"text": "hi"}'}), {'result': 'HI'})
+
+        self.assertIs(self.incantation.rollback(3), self.incantation)  # current already
+        self.assertIs(self.incantation.rollback(1), self.incantation)  # same code and schema
+        self.assertEqual(len(self.versions()), 3)
+        self.assertIsNone(self.incantation.rollback(4))
+
+    def test_compiled_once_per_hash(self):
+        self.incantation.execute({'args': '{"text": "a"}'})
+        compiled = utils._compiled[('hash', self.incantation.code_hash)]
+        self.incantation.execute({'args': '{"text": "b"}'})
+        self.assertIs(utils._compiled[('hash', self.incantation.code_hash)], compiled)
+        self.adjust()
+        self.assertEqual(self.incantation.execute({'args': '{"text": "a", "times": 2}'}), {'result': 'AA'})
+
+
+if __name__ == '__main__':
+    unittest.main()